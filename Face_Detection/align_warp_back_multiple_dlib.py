@@ -6,8 +6,6 @@ import numpy as np
 import skimage.io as io
 
 # from face_sdk import FaceDetection
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
 from skimage.transform import SimilarityTransform
 from skimage.transform import warp
 from PIL import Image, ImageFilter
@@ -163,6 +161,9 @@ def compute_inverse_transformation_matrix(img, landmark, normalize, side_length,
 
 
 def show_detection(image, box, landmark):
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Rectangle
+
     plt.imshow(image)
     print(box[2] - box[0])
     plt.gca().add_patch(
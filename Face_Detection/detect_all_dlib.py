@@ -4,8 +4,6 @@
 import numpy as np
 import skimage.io as io
 
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
 from skimage.transform import SimilarityTransform
 from skimage.transform import warp
 from PIL import Image
@@ -88,6 +86,10 @@ def compute_transformation_matrix(img, landmark, normalize, side_length, target_
 
 
 def show_detection(image, box, landmark):
+    ## matplotlib is only needed for debugging, keep it out of the inference imports
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Rectangle
+
     plt.imshow(image)
     print(box[2] - box[0])
     plt.gca().add_patch(
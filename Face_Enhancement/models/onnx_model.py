@@ -0,0 +1,38 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import torch
+try:
+    from ...bopbtl_utils import onnx_util
+except ImportError:
+    from bopbtl_utils import onnx_util
+
+
+class GeneratorStage(torch.nn.Module):
+    def __init__(self, netG):
+        super().__init__()
+        self.netG = netG
+
+    def forward(self, label, image):
+        return self.netG(label, image)
+
+
+def export_onnx(model, path, label, image):
+    """Exports the generator of a Pix2PixModel, traced on an example |label| and |image| on the CPU.
+    Inputs the generator does not use, like the label without parsing maps, are left out of the graph."""
+    return onnx_util.export(GeneratorStage(model.netG).eval(), {"label": label, "image": image}, path)
+
+
+class OnnxPix2PixModel:
+    """Runs the generator written by export_onnx from |opt.test_path_G| with onnxruntime on the CPU.
+    Called like Pix2PixModel in its "inference" mode."""
+
+    def __init__(self, opt):
+        self.opt = opt
+        self.quantized = False
+        self.session = onnx_util.create_session(opt.test_path_G, opt.cpu_threads, opt.cpu_interop_threads)
+
+    def __call__(self, data, mode):
+        if mode != "inference":
+            raise ValueError("|mode| is invalid")
+        return torch.from_numpy(onnx_util.run(self.session, {"label": data["label"], "image": data["image"]}))
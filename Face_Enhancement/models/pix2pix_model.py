@@ -9,6 +9,11 @@ except:
     import models.networks as networks
     import util.util as util
 
+try:
+    from ...bopbtl_utils import quantization
+except ImportError:
+    from bopbtl_utils import quantization
+
 
 class Pix2PixModel(torch.nn.Module):
     @staticmethod
@@ -23,6 +28,7 @@ class Pix2PixModel(torch.nn.Module):
         self.ByteTensor = torch.cuda.ByteTensor if self.use_gpu() else torch.ByteTensor
 
         self.netG, self.netD, self.netE = self.initialize_networks(opt)
+        self.quantized = False
 
         # set loss functions
         if opt.isTrain:
@@ -50,12 +56,27 @@ class Pix2PixModel(torch.nn.Module):
             z, mu, logvar = self.encode_z(real_image)
             return mu, logvar
         elif mode == "inference":
-            with torch.no_grad():
+            with torch.inference_mode():
                 fake_image, _ = self.generate_fake(input_semantics, degraded_image, real_image)
             return fake_image
         else:
             raise ValueError("|mode| is invalid")
 
+    def quantize(self, batches):
+        ## Post-training static int8 quantization of the residual blocks of the generator, calibrated
+        ## on the given batches; the first and the last convolution keep running in float
+        if self.use_gpu():
+            raise ValueError("int8 inference is only supported on CPU!")
+        blocks = [block for name, block in self.netG.named_children() if name.startswith(("head_", "G_middle_", "up_"))]
+        for block in blocks:
+            quantization.prepare_int8(block)
+        with torch.inference_mode():
+            for batch in batches:
+                self(batch, mode="inference")
+        for block in blocks:
+            quantization.convert_int8(block)
+        self.quantized = True
+
     def create_optimizers(self, opt):
         G_params = list(self.netG.parameters())
         if opt.use_vae:
@@ -106,17 +127,16 @@ class Pix2PixModel(torch.nn.Module):
         # move to GPU and change data types
         # data['label'] = data['label'].long()
 
+        device = next(self.netG.parameters()).device
         if not self.opt.isTrain:
-            if self.use_gpu():
-                data["label"] = data["label"].cuda()
-                data["image"] = data["image"].cuda()
+            data["label"] = data["label"].to(device)
+            data["image"] = data["image"].to(device)
             return data["label"], data["image"], data["image"]
 
         ## While testing, the input image is the degraded face
-        if self.use_gpu():
-            data["label"] = data["label"].cuda()
-            data["degraded_image"] = data["degraded_image"].cuda()
-            data["image"] = data["image"].cuda()
+        data["label"] = data["label"].to(device)
+        data["degraded_image"] = data["degraded_image"].to(device)
+        data["image"] = data["image"].to(device)
 
         # # create one-hot label map
         # label_map = data['label']
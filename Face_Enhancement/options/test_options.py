@@ -9,8 +9,13 @@ class TestOptions(BaseOptions):
         BaseOptions.initialize(self, parser)
         parser.add_argument("--results_dir", type=str, default="./results/", help="saves results here.")
         parser.add_argument("--which_epoch", type=str, default="latest", help="which epoch to load? set to latest to use latest cached model")
-        parser.add_argument("--test_path_G", type=str, default="", help="model G; overrides 'which_epoch'")
+        parser.add_argument("--test_path_G", type=str, default="", help="model G; overrides 'which_epoch'. A .onnx file written by export_onnx.py runs with onnxruntime on CPU")
         parser.add_argument("--how_many", type=int, default=float("inf"), help="how many test images to run")
+        parser.add_argument("--cpu_threads", type=int, default=0, help="intra-op threads of CPU inference, 0 uses the torch default")
+        parser.add_argument("--cpu_interop_threads", type=int, default=0, help="inter-op threads of CPU inference, 0 uses the torch default")
+        parser.add_argument("--no_channels_last", action="store_true", help="keep the NCHW memory format on CPU instead of channels_last")
+        parser.add_argument("--quantize", type=str, default="none", choices=["none", "int8"], help="int8: post-training static quantization of the generator, CPU only")
+        parser.add_argument("--quantize_samples", type=int, default=8, help="number of batches the int8 generator is calibrated on")
 
         parser.set_defaults(preprocess_mode="scale_width_and_crop", crop_size=256, load_size=256, display_winsize=256)
         parser.set_defaults(serial_batches=True)
@@ -2,16 +2,27 @@
 # Licensed under the MIT License.
 
 import os
+import itertools
 
 try:
     from .options.test_options import TestOptions
     from .models.pix2pix_model import Pix2PixModel
+    from .models.onnx_model import OnnxPix2PixModel
     from .data.face_dataset import FaceTestDataset
+    from .util import util
 except:
     from options.test_options import TestOptions
     from models.pix2pix_model import Pix2PixModel
+    from models.onnx_model import OnnxPix2PixModel
     from data.face_dataset import FaceTestDataset
+    import util.util as util
 
+try:
+    from ..bopbtl_utils.cpu_threads import set_cpu_threads
+except ImportError:
+    from bopbtl_utils.cpu_threads import set_cpu_threads
+
+import torch
 import torchvision.utils as vutils
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -34,8 +45,18 @@ def create_directory_dataloader(opt):
 
 
 def load_model(opt):
+    if opt.test_path_G.endswith(".onnx"):
+        if opt.gpu_ids or opt.quantize != "none":
+            raise ValueError("ONNX models only run on CPU without --quantize; use --gpu_ids -1")
+        return OnnxPix2PixModel(opt)
+    if opt.quantize == "int8" and opt.gpu_ids:
+        raise ValueError("int8 inference is only supported on CPU; use --gpu_ids -1")
+    if not opt.gpu_ids:
+        set_cpu_threads(opt.cpu_threads, opt.cpu_interop_threads)
     model = Pix2PixModel(opt)
     model.eval()
+    if not opt.gpu_ids and not opt.no_channels_last:
+        model.to(memory_format=torch.channels_last)
     return model
 
 
@@ -48,9 +69,10 @@ def main(model: Pix2PixModel, dataloader: DataLoader, output_dir: str, batch_siz
             break
 
         # enhance faces
-        enhanced_faces = model(batch, mode="inference")
-        for i in range(len(enhanced_faces)):
-            enhanced_faces[i] = (enhanced_faces[i] + 1) / 2
+        with torch.inference_mode():
+            enhanced_faces = model(batch, mode="inference")
+            for i in range(len(enhanced_faces)):
+                enhanced_faces[i] = (enhanced_faces[i] + 1) / 2
 
         # save image
         for path, enhanced_face in zip(batch["path"], enhanced_faces):
@@ -63,4 +85,6 @@ if __name__ == "__main__":
     opt = TestOptions().parse()
     model = load_model(opt)
     dataloader = create_directory_dataloader(opt)
+    if opt.quantize == "int8":
+        model.quantize(itertools.islice(dataloader, opt.quantize_samples))
     main(model, dataloader, opt.results_dir, opt.batchSize, opt.how_many)
\ No newline at end of file
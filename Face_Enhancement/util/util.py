@@ -12,6 +12,11 @@ import argparse
 #import dill as pickle
 import pickle
 
+try:
+    from ...bopbtl_utils import checkpoint
+except ImportError:
+    from bopbtl_utils import checkpoint
+
 
 def save_obj(obj, name):
     with open(name, "wb") as f:
@@ -175,8 +180,7 @@ def save_network(net, label, epoch, opt):
 
 def load_network_from_path(net, save_path):
     if os.path.exists(save_path):
-        weights = torch.load(save_path)
-        net.load_state_dict(weights)
+        checkpoint.load_network_from_path(net, save_path, strict=True)
     else:
         raise RuntimeError("Unable to find network!")
     return net
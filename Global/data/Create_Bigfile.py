@@ -2,8 +2,22 @@
 # Licensed under the MIT License.
 
 import os
-import struct
-from PIL import Image
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from .Load_Bigfile import (BIGFILE_V2_INDEX, BIGFILE_WRITE_BUFFER, BigFileMemoryLoader, BigFileWriter, checksum,
+                               index_sidecar_path, open_bigfile, read_image_size, shard_path, write_index)
+except ImportError:
+    from Load_Bigfile import (BIGFILE_V2_INDEX, BIGFILE_WRITE_BUFFER, BigFileMemoryLoader, BigFileWriter, checksum,
+                              index_sidecar_path, open_bigfile, read_image_size, shard_path, write_index)
+
+try:
+    from ...bopbtl_utils.prefetch import map_ordered
+except ImportError:
+    from bopbtl_utils.prefetch import map_ordered
 
 IMG_EXTENSIONS = [
     '.jpg', '.JPG', '.jpeg', '.JPEG',
@@ -28,36 +42,109 @@ def make_dataset(dir):
 
     return images
 
-### Modify these 3 lines in your own environment
-indir="/home/ziyuwan/workspace/data/temp_old"
-target_folders=['VOC','Real_L_old','Real_RGB_old']
-out_dir ="/home/ziyuwan/workspace/data/temp_old"
-###
-
-if os.path.exists(out_dir) is False:
-    os.makedirs(out_dir)
-
-#
-for target_folder in target_folders:
-    curr_indir = os.path.join(indir, target_folder)
-    curr_out_file = os.path.join(os.path.join(out_dir, '%s.bigfile'%(target_folder)))
-    image_lists = make_dataset(curr_indir)
-    image_lists.sort()
-    with open(curr_out_file, 'wb') as wfid:
-        # write total image number
-        wfid.write(struct.pack('i', len(image_lists)))
-        for i, img_path in enumerate(image_lists):
-             # write file name first
-             img_name = os.path.basename(img_path)
-             img_name_bytes = img_name.encode('utf-8')
-             wfid.write(struct.pack('i', len(img_name_bytes)))
-             wfid.write(img_name_bytes)
-    #
-    #             # write image data in
-             with open(img_path, 'rb') as img_fid:
-                 img_bytes = img_fid.read()
-             wfid.write(struct.pack('i', len(img_bytes)))
-             wfid.write(img_bytes)
-
-             if i % 1000 == 0:
-                 print('write %d images done' % i)
\ No newline at end of file
+def read_image(img_path):
+    with open(img_path, 'rb') as img_fid:
+        img_bytes = img_fid.read()
+    return img_bytes, read_image_size(img_bytes), checksum(img_bytes)
+
+
+def write_bigfile(out_file, image_lists, executor=None, resume=False, checkpoint_every=10000,
+                  buffer_size=BIGFILE_WRITE_BUFFER):
+    """Writes |image_lists| to a v2 bigfile, reading the images on |executor| while writing.
+
+    With |resume| an interrupted write continues from its last checkpoint, which is saved every
+    |checkpoint_every| images; |image_lists| must be the same list as before."""
+    if resume and os.path.isfile(out_file) and not os.path.isfile(out_file + '.partial'):
+        print('%s is complete, skipping' % out_file)
+        return
+    with BigFileWriter(out_file, buffer_size=buffer_size, resume=resume) as writer:
+        done = len(writer)
+        if done > 0:
+            if done > len(image_lists) or writer.name(done - 1) != os.path.basename(image_lists[done - 1]):
+                raise RuntimeError('%s was started from other images, it cannot be resumed' % out_file)
+            print('resume %s after %d images' % (out_file, done))
+        todo = image_lists[done:]
+        images = map_ordered(executor, read_image, todo, 64) if executor is not None else map(read_image, todo)
+        for i, (img_path, (img_bytes, size, crc32)) in enumerate(zip(todo, images), done):
+            writer.add(os.path.basename(img_path), img_bytes, size, crc32)
+            if (i + 1) % checkpoint_every == 0:
+                writer.checkpoint()
+            if i % 1000 == 0:
+                print('write %d images done' % i)
+
+
+def write_sharded_bigfile(out_file, image_lists, num_shards, **kwargs):
+    """Splits |image_lists| into |num_shards| consecutive bigfiles that open_bigfile(out_file) reads as one."""
+    if num_shards <= 1:
+        write_bigfile(out_file, image_lists, **kwargs)
+        return
+    for shard in range(num_shards):
+        shard_lists = image_lists[shard * len(image_lists) // num_shards:(shard + 1) * len(image_lists) // num_shards]
+        write_bigfile(shard_path(out_file, shard, num_shards), shard_lists, **kwargs)
+
+
+def write_index_sidecar(file_path, executor=None):
+    """Indexes a v1 bigfile into its '.index' sidecar, with the sizes and checksums of its images."""
+    sidecar_path = index_sidecar_path(file_path)
+    if os.path.isfile(sidecar_path):
+        os.remove(sidecar_path)
+    loader = BigFileMemoryLoader(file_path)
+    if loader.checksums_known:
+        print('%s is already indexed' % file_path)
+        return
+    index = np.array(loader.index, dtype=BIGFILE_V2_INDEX)
+
+    def describe(i):
+        img_bytes = loader.img_bytes(i)
+        return read_image_size(img_bytes), checksum(img_bytes)
+
+    indices = range(len(loader))
+    described = map_ordered(executor, describe, indices, 64) if executor is not None else map(describe, indices)
+    for i, ((width, height), crc32) in enumerate(described):
+        index['width'][i], index['height'][i], index['crc32'][i] = width, height, crc32
+    write_index(sidecar_path, index, os.path.getsize(file_path))
+    print('write %s done' % sidecar_path)
+
+
+def verify_bigfile(file_path):
+    loader = open_bigfile(file_path)
+    corrupted = [i for i in range(len(loader)) if not loader.verify(i)]
+    for i in corrupted:
+        print('checksum mismatch for index %d: %s' % (i, loader.name(i)))
+    print('%d of %d images in %s are corrupted' % (len(corrupted), len(loader), file_path))
+    return not corrupted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack image folders into bigfiles, index v1 bigfiles or verify bigfiles')
+    parser.add_argument('--indir', type=str, default='', help='the root of the image folders')
+    parser.add_argument('--target_folders', type=str, nargs='+', default=['VOC', 'Real_L_old', 'Real_RGB_old'],
+                        help='folders of |indir| written to <out_dir>/<folder>.bigfile')
+    parser.add_argument('--out_dir', type=str, default='', help='|indir| when it is not given')
+    parser.add_argument('--threads', type=int, default=8, help='threads reading the images')
+    parser.add_argument('--shards', type=int, default=1, help='write every bigfile as this many files')
+    parser.add_argument('--resume', action='store_true', help='continue interrupted bigfiles and skip finished ones')
+    parser.add_argument('--checkpoint_every', type=int, default=10000, help='images between resume checkpoints')
+    parser.add_argument('--buffer_mb', type=int, default=BIGFILE_WRITE_BUFFER // (1024 * 1024), help='write buffer size')
+    parser.add_argument('--index_only', type=str, nargs='+', default=[], help='v1 bigfiles to write an index sidecar for')
+    parser.add_argument('--verify', type=str, nargs='+', default=[], help='bigfiles to check against their checksums')
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(max_workers=max(args.threads, 1)) as executor:
+        if args.index_only or args.verify:
+            for file_path in args.index_only:
+                write_index_sidecar(file_path, executor)
+            if not all([verify_bigfile(file_path) for file_path in args.verify]):
+                raise SystemExit(1)
+        else:
+            out_dir = args.out_dir or args.indir
+            if os.path.exists(out_dir) is False:
+                os.makedirs(out_dir)
+
+            for target_folder in args.target_folders:
+                curr_indir = os.path.join(args.indir, target_folder)
+                curr_out_file = os.path.join(os.path.join(out_dir, '%s.bigfile'%(target_folder)))
+                image_lists = make_dataset(curr_indir)
+                image_lists.sort()
+                write_sharded_bigfile(curr_out_file, image_lists, args.shards, executor=executor, resume=args.resume,
+                                      checkpoint_every=args.checkpoint_every, buffer_size=args.buffer_mb * 1024 * 1024)
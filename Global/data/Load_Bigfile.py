@@ -1,42 +1,350 @@
-# Copyright (c) Microsoft Corporation.
-# Licensed under the MIT License.
-
 import io
 import os
+import re
+import mmap
+import zlib
 import struct
+import numpy as np
 from PIL import Image
 
+## v1: int32 count, then int32 name length, name, int32 image length, image for every image.
+## v2: magic, layout, names and images back to back, the index below, uint64 index offset, magic.
+## The index also keeps the size of every image, 0 x 0 if its header cannot be read, and its crc32.
+## A v1 file can be given the same index in a '.index' sidecar: magic, layout, uint64 size of the bigfile, index.
+## The layout is uint32 BIGFILE_V2_VERSION and uint32 index entry size; files with another layout are rejected.
+BIGFILE_V2_MAGIC = b'BIGFILE2'
+BIGFILE_INDEX_MAGIC = b'BIGINDEX'
+BIGFILE_V2_VERSION = 1
+BIGFILE_V2_LAYOUT = struct.Struct('<II')
+BIGFILE_V2_INDEX = np.dtype([
+    ('name_offset', '<u8'),
+    ('name_length', '<u4'),
+    ('offset', '<u8'),
+    ('length', '<u8'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('crc32', '<u4'),
+])
+BIGFILE_WRITE_BUFFER = 16 * 1024 * 1024
+
+
+def read_image_size(img_bytes):
+    ## PIL only parses the header until the pixels are accessed
+    try:
+        return Image.open(io.BytesIO(img_bytes)).size
+    except Exception:
+        return 0, 0
+
+
+def pack_layout():
+    return BIGFILE_V2_LAYOUT.pack(BIGFILE_V2_VERSION, BIGFILE_V2_INDEX.itemsize)
+
+
+def check_layout(path, buffer, offset):
+    version, itemsize = BIGFILE_V2_LAYOUT.unpack_from(buffer, offset)
+    if version != BIGFILE_V2_VERSION or itemsize != BIGFILE_V2_INDEX.itemsize:
+        raise ValueError('%s has index layout %d with %d byte entries, expected %d with %d byte entries; write it again with Create_Bigfile.py'
+                         % (path, version, itemsize, BIGFILE_V2_VERSION, BIGFILE_V2_INDEX.itemsize))
+
+
+def checksum(img_bytes):
+    return zlib.crc32(img_bytes) & 0xffffffff
+
+
+def index_sidecar_path(file_path):
+    return file_path + '.index'
+
+
+def write_index(path, index, size):
+    ## written next to the target and renamed, so a crash never leaves a truncated index
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fid:
+        fid.write(BIGFILE_INDEX_MAGIC)
+        fid.write(pack_layout())
+        fid.write(struct.pack('<Q', size))
+        fid.write(np.asarray(index, dtype=BIGFILE_V2_INDEX).tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_index(path):
+    """(index, size) of an index file written by write_index, the index mapped read-only."""
+    with open(path, 'rb') as fid:
+        header = fid.read(24)
+    if len(header) < 24 or header[:8] != BIGFILE_INDEX_MAGIC:
+        raise ValueError('%s is not a bigfile index' % path)
+    check_layout(path, header, 8)
+    size = struct.unpack('<Q', header[16:])[0]
+    if os.path.getsize(path) == 24:
+        return np.empty(0, dtype=BIGFILE_V2_INDEX), size
+    return np.memmap(path, dtype=BIGFILE_V2_INDEX, mode='r', offset=24), size
+
+
+def shard_path(file_path, shard, num_shards):
+    root, ext = os.path.splitext(file_path)
+    return '%s.%05d-of-%05d%s' % (root, shard, num_shards, ext)
+
+
+def find_shards(file_path):
+    """The shard paths written for |file_path| in order, [] if there are none."""
+    root, ext = os.path.splitext(file_path)
+    directory = os.path.dirname(file_path) or '.'
+    pattern = re.compile(re.escape(os.path.basename(root)) + r'\.(\d{5})-of-(\d{5})' + re.escape(ext) + '$')
+    shards = {}
+    for fname in os.listdir(directory):
+        match = pattern.match(fname)
+        if match:
+            shards[(int(match.group(1)), int(match.group(2)))] = os.path.join(directory, fname)
+    if not shards:
+        return []
+    num_shards = max(n for _, n in shards)
+    paths = [shards.get((i, num_shards)) for i in range(num_shards)]
+    if None in paths:
+        raise IOError('%s is missing shards of %d' % (file_path, num_shards))
+    return paths
+
+
+class BigFileWriter(object):
+    """Writes a v2 bigfile: add() every image, then close(), or use it as a context manager.
+
+    checkpoint() saves the index of the images written so far to a '.partial' file; a writer
+    opened with |resume| continues after the last checkpoint instead of starting over."""
+
+    def __init__(self, file_path, buffer_size=BIGFILE_WRITE_BUFFER, resume=False):
+        self.file_path = file_path
+        self.partial_path = file_path + '.partial'
+        self.index = []
+        if resume and os.path.isfile(self.partial_path) and os.path.isfile(file_path):
+            index, end = read_index(self.partial_path)
+            self.index = index.tolist()
+            del index
+            self.fid = open(file_path, 'r+b', buffering=buffer_size)
+            ## drop whatever was written after the checkpoint
+            self.fid.truncate(end)
+            self.fid.seek(end)
+        else:
+            self.fid = open(file_path, 'wb', buffering=buffer_size)
+            self.fid.write(BIGFILE_V2_MAGIC)
+            self.fid.write(pack_layout())
+            self.checkpoint()
+
+    def add(self, img_name, img_bytes, size=None, crc32=None):
+        """|size| and |crc32| of the image are computed when they are not given."""
+        name_bytes = img_name.encode('utf-8')
+        name_offset = self.fid.tell()
+        self.fid.write(name_bytes)
+        offset = self.fid.tell()
+        self.fid.write(img_bytes)
+        width, height = read_image_size(img_bytes) if size is None else size
+        crc32 = checksum(img_bytes) if crc32 is None else crc32
+        self.index.append((name_offset, len(name_bytes), offset, len(img_bytes), width, height, crc32))
+
+    def name(self, index):
+        entry = self.index[index]
+        self.fid.flush()
+        with open(self.file_path, 'rb') as fid:
+            fid.seek(entry[0])
+            return fid.read(entry[1]).decode('utf-8')
+
+    def checkpoint(self):
+        self.fid.flush()
+        os.fsync(self.fid.fileno())
+        write_index(self.partial_path, self.index, self.fid.tell())
+
+    def close(self):
+        if self.fid is None:
+            return
+        index_offset = self.fid.tell()
+        self.fid.write(np.array(self.index, dtype=BIGFILE_V2_INDEX).tobytes())
+        self.fid.write(struct.pack('<Q', index_offset))
+        self.fid.write(BIGFILE_V2_MAGIC)
+        self.fid.close()
+        self.fid = None
+        if os.path.isfile(self.partial_path):
+            os.remove(self.partial_path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        elif self.fid is not None:
+            ## keep the last checkpoint to resume from instead of finishing a broken file
+            self.fid.close()
+            self.fid = None
+
+
 class BigFileMemoryLoader(object):
-    def __load_bigfile(self):
-        print('start load bigfile (%0.02f GB) into memory' % (os.path.getsize(self.file_path)/1024/1024/1024))
+    """Random access to the images of a v1 or v2 bigfile through a read-only memory map.
+
+    A v2 file is indexed by its trailing table, a v1 file by its '.index' sidecar or else one pass
+    over the record headers; names and images are sliced from the map when they are read, so
+    opening a file costs the index and the pages of the file are shared between DataLoader workers."""
+
+    def __open(self):
         with open(self.file_path, 'rb') as fid:
-            self.img_num = struct.unpack('i', fid.read(4))[0]
-            self.img_names = []
-            self.img_bytes = []
-            print('find total %d images' % self.img_num)
-            for i in range(self.img_num):
-                img_name_len = struct.unpack('i', fid.read(4))[0]
-                img_name = fid.read(img_name_len).decode('utf-8')
-                self.img_names.append(img_name)
-                img_bytes_len = struct.unpack('i', fid.read(4))[0]
-                self.img_bytes.append(fid.read(img_bytes_len))
-                if i % 5000 == 0:
-                    print('load %d images done' % i)
-            print('load all %d images done' % self.img_num)
+            size = os.fstat(fid.fileno()).st_size
+            self.map = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+        if size > 0 and hasattr(mmap, 'MADV_RANDOM'):
+            ## images are read in shuffled order, reading ahead would only page in other images
+            self.map.madvise(mmap.MADV_RANDOM)
+        self.buffer = memoryview(self.map)
+        if self.index is not None:
+            return
+        if size >= 32 and self.map[:8] == BIGFILE_V2_MAGIC and self.map[-8:] == BIGFILE_V2_MAGIC:
+            check_layout(self.file_path, self.map, 8)
+            index_offset = struct.unpack_from('<Q', self.map, size - 16)[0]
+            count = (size - 16 - index_offset) // BIGFILE_V2_INDEX.itemsize
+            self.index = np.frombuffer(self.map, dtype=BIGFILE_V2_INDEX, count=count, offset=index_offset)
+        else:
+            self.index = self.__read_sidecar(size)
+            if self.index is None:
+                self.index = self.__scan_v1()
+        self.img_num = len(self.index)
+
+    def __read_sidecar(self, size):
+        sidecar_path = index_sidecar_path(self.file_path)
+        if not os.path.isfile(sidecar_path):
+            return None
+        try:
+            index, indexed_size = read_index(sidecar_path)
+        except ValueError as error:
+            print('%s, ignoring it' % error)
+            return None
+        if indexed_size != size:
+            print('%s does not match %s, ignoring it' % (sidecar_path, self.file_path))
+            return None
+        return index
+
+    def __scan_v1(self):
+        img_num = struct.unpack_from('i', self.map, 0)[0]
+        index = np.empty(img_num, dtype=BIGFILE_V2_INDEX)
+        position = 4
+        for i in range(img_num):
+            img_name_len = struct.unpack_from('i', self.map, position)[0]
+            img_bytes_len = struct.unpack_from('i', self.map, position + 4 + img_name_len)[0]
+            index[i] = (position + 4, img_name_len, position + 8 + img_name_len, img_bytes_len, 0, 0, 0)
+            position += 8 + img_name_len + img_bytes_len
+        self.sizes_known = False
+        self.checksums_known = False
+        return index
 
     def __init__(self, file_path):
         super(BigFileMemoryLoader, self).__init__()
         self.file_path = file_path
-        self.__load_bigfile()
+        self.index = None
+        self.sizes_known = True
+        self.checksums_known = True
+        self.__open()
+        print('find total %d images in %s' % (self.img_num, file_path))
+
+    def __getstate__(self):
+        ## the map cannot be pickled for spawned DataLoader workers, they map the file again
+        state = self.__dict__.copy()
+        del state['map'], state['buffer']
+        if not self.index.flags.owndata:
+            state['index'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open()
+
+    def name(self, index):
+        entry = self.index[index]
+        start = int(entry['name_offset'])
+        return bytes(self.buffer[start:start + int(entry['name_length'])]).decode('utf-8')
+
+    def img_bytes(self, index):
+        """The encoded image as a memoryview into the file, without a copy."""
+        entry = self.index[index]
+        start = int(entry['offset'])
+        return self.buffer[start:start + int(entry['length'])]
+
+    def sizes(self):
+        """(width, height) of every image, from the index or, for v1 files, the image headers."""
+        if not self.sizes_known:
+            for i in range(self.img_num):
+                self.index['width'][i], self.index['height'][i] = read_image_size(self.img_bytes(i))
+            self.sizes_known = True
+        return np.stack([self.index['width'], self.index['height']], axis=1)
+
+    def verify(self, index):
+        """Whether the image matches its checksum; True for v1 files without an index sidecar."""
+        if not self.checksums_known:
+            return True
+        return checksum(self.img_bytes(index)) == int(self.index[index]['crc32'])
 
     def __getitem__(self, index):
         try:
-            img = Image.open(io.BytesIO(self.img_bytes[index])).convert('RGB')
-            return self.img_names[index], img
+            img = Image.open(io.BytesIO(self.img_bytes(index))).convert('RGB')
+            return self.name(index), img
         except Exception:
-            print('Image read error for index %d: %s' % (index, self.img_names[index]))
+            print('Image read error for index %d: %s' % (index, self.name(index)))
             return self.__getitem__((index+1)%self.img_num)
 
 
     def __len__(self):
         return self.img_num
+
+
+class BigFileSubset(object):
+    """The images of |loader| at |indices|, decoded when they are read."""
+
+    def __init__(self, loader, indices):
+        self.loader = loader
+        self.indices = indices
+
+    def __getitem__(self, index):
+        return self.loader[int(self.indices[index])]
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class BigFileShards(object):
+    """The images of the shards of a bigfile as one loader, in the order of the shards."""
+
+    def __init__(self, shard_paths):
+        self.shards = [BigFileMemoryLoader(path) for path in shard_paths]
+        self.starts = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.img_num = int(self.starts[-1])
+
+    def __locate(self, index):
+        shard = int(np.searchsorted(self.starts, index, side='right')) - 1
+        return self.shards[shard], index - int(self.starts[shard])
+
+    def name(self, index):
+        shard, index = self.__locate(index)
+        return shard.name(index)
+
+    def img_bytes(self, index):
+        shard, index = self.__locate(index)
+        return shard.img_bytes(index)
+
+    def sizes(self):
+        return np.concatenate([shard.sizes() for shard in self.shards])
+
+    def verify(self, index):
+        shard, index = self.__locate(index)
+        return shard.verify(index)
+
+    def __getitem__(self, index):
+        shard, index = self.__locate(index)
+        return shard[index]
+
+    def __len__(self):
+        return self.img_num
+
+
+def open_bigfile(file_path):
+    """A loader for |file_path|, or for its shards when it was written as several files."""
+    if os.path.exists(file_path):
+        return BigFileMemoryLoader(file_path)
+    shard_paths = find_shards(file_path)
+    if not shard_paths:
+        raise IOError('%s does not exist' % file_path)
+    return BigFileShards(shard_paths)
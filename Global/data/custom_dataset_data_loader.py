@@ -27,15 +27,27 @@ class CustomDatasetDataLoader(BaseDataLoader):
     def initialize(self, opt):
         BaseDataLoader.initialize(self, opt)
         self.dataset = CreateDataset(opt)
+        ## in a distributed run every rank loads its own share of the images, batchSize per rank
+        self.sampler = None
+        if getattr(opt, 'distributed', False):
+            self.sampler = torch.utils.data.distributed.DistributedSampler(
+                self.dataset, num_replicas=opt.world_size, rank=opt.rank, shuffle=not opt.serial_batches)
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset,
             batch_size=opt.batchSize,
-            shuffle=not opt.serial_batches,
+            shuffle=not opt.serial_batches and self.sampler is None,
+            sampler=self.sampler,
             num_workers=int(opt.nThreads),
+            pin_memory=opt.gpu_degradation,
             drop_last=True)
 
     def load_data(self):
         return self.dataloader
 
+    def set_epoch(self, epoch):
+        ## reshuffles the shares of the ranks, which the sampler only does for a new epoch
+        if self.sampler is not None:
+            self.sampler.set_epoch(epoch)
+
     def __len__(self):
         return min(len(self.dataset), self.opt.max_dataset_size)
@@ -0,0 +1,242 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torchvision.io import decode_jpeg, encode_jpeg
+
+## The degradations of online_add_degradation_v2 on batches of (N, C, H, W) tensors, on the device of
+## the images. Every image draws its choices and its noise from its own seed, so a batch is reproducible
+## whatever the worker, device or batch it is degraded in. Images stay uint8 between the steps, as the
+## PIL images of online_add_degradation_v2 do.
+BLUR, NOISE, LOW_RESOLUTION, JPEG = range(4)
+KERNEL_SIZES = (3, 5, 7)
+MAX_SEED = 2 ** 62
+
+
+def sample_degradation(generator, height, width):
+    """The random choices of online_add_degradation_v2 for one |height| x |width| image."""
+
+    def uniform(low, high):
+        return low + (high - low) * torch.rand((), generator=generator, dtype=torch.float64).item()
+
+    def randint(low, high):
+        ## both ends included, like random.randint
+        return int(torch.randint(low, high + 1, (), generator=generator))
+
+    return {
+        "order": torch.randperm(4, generator=generator).tolist(),
+        "apply": (torch.rand(4, generator=generator, dtype=torch.float64) < 0.7).tolist(),
+        "kernel_size": KERNEL_SIZES[randint(0, len(KERNEL_SIZES) - 1)],
+        "blur_std": uniform(1.0, 5.0),
+        "noise": randint(1, 3),
+        "noise_std": uniform(5 / 255.0, 50 / 255.0),
+        "amount": uniform(0, 0.01),
+        "salt_vs_pepper": uniform(0.3, 0.8),
+        "size": (randint(int(height / 2), height), randint(int(width / 2), width)),
+        "nearest": uniform(0, 1) < 0.5,
+        "quality": randint(40, 100),
+        "noise_seed": randint(0, MAX_SEED),
+    }
+
+
+def noise_generator(seed, device):
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+
+def gaussian_blur(images, params):
+    ## cv2.GaussianBlur with BORDER_REFLECT_101 for every image; smaller kernels are 7 taps with zeros outside
+    n, c, h, w = images.shape
+    radius = max(KERNEL_SIZES) // 2
+    taps = torch.arange(-radius, radius + 1, device=images.device, dtype=torch.float32)
+    sizes = torch.tensor([p["kernel_size"] for p in params], device=images.device).view(n, 1)
+    stds = torch.tensor([p["blur_std"] for p in params], device=images.device, dtype=torch.float32).view(n, 1)
+    kernel = torch.exp(-taps ** 2 / (2 * stds ** 2)) * (taps.abs() <= sizes // 2)
+    kernel = (kernel / kernel.sum(1, keepdim=True)).repeat_interleave(c, 0)
+    x = F.pad(images.reshape(1, n * c, h, w), (radius, radius, radius, radius), mode="reflect")
+    x = F.conv2d(x, kernel.view(n * c, 1, -1, 1), groups=n * c)
+    x = F.conv2d(x, kernel.view(n * c, 1, 1, -1), groups=n * c)
+    return x.view(n, c, h, w).round_().clamp_(0, 255)
+
+
+def add_noise(images, params):
+    ## synthesize_gaussian, synthesize_speckle or synthesize_salt_pepper for every image
+    noisy = []
+    for image, p in zip(images, params):
+        generator = noise_generator(p["noise_seed"], images.device)
+        if p["noise"] == 3:
+            flipped = torch.rand(image.shape, generator=generator, device=images.device) < p["amount"]
+            salted = torch.rand(image.shape, generator=generator, device=images.device) < p["salt_vs_pepper"]
+            noisy.append(torch.where(flipped, salted.float() * 255, image))
+            continue
+        gauss = torch.randn(image.shape, generator=generator, device=images.device) * p["noise_std"]
+        if p["noise"] == 1:
+            image = image + gauss * 255
+        else:
+            image = image + gauss * image
+        noisy.append(image.clamp_(0, 255).floor_())
+    return torch.stack(noisy)
+
+
+def low_resolution(images, params):
+    ## synthesize_low_resolution: a bicubic downsample like PIL's, then a nearest or bilinear upsample
+    h, w = images.shape[2:]
+    degraded = []
+    for image, p in zip(images, params):
+        image = F.interpolate(image[None], size=p["size"], mode="bicubic", align_corners=False, antialias=True)
+        image = image.round_().clamp_(0, 255)
+        if p["nearest"]:
+            image = F.interpolate(image, size=(h, w), mode="nearest-exact")
+        else:
+            image = F.interpolate(image, size=(h, w), mode="bilinear", align_corners=False).round_()
+        degraded.append(image[0])
+    return torch.stack(degraded)
+
+
+def jpeg(images, params):
+    ## convertToJpeg; encoded with libjpeg on the CPU
+    compressed = [
+        decode_jpeg(encode_jpeg(image.to("cpu", torch.uint8), quality=p["quality"]))
+        for image, p in zip(images, params)
+    ]
+    return torch.stack(compressed).to(images.device, torch.float32)
+
+
+## the quantization tables of the JPEG standard, scaled by the quality like libjpeg does
+JPEG_LUMA_TABLE = [
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99],
+]
+JPEG_CHROMA_TABLE = [
+    [17, 18, 24, 47, 99, 99, 99, 99],
+    [18, 21, 26, 66, 99, 99, 99, 99],
+    [24, 26, 56, 99, 99, 99, 99, 99],
+    [47, 66, 99, 99, 99, 99, 99, 99],
+] + [[99] * 8] * 4
+
+
+def jpeg_tables(table, qualities, device):
+    qualities = torch.tensor(qualities, device=device).clamp(1, 100)
+    scale = torch.where(qualities < 50, torch.div(5000, qualities, rounding_mode="floor"), 200 - qualities * 2)
+    table = torch.tensor(table, device=device)
+    return torch.div(table * scale.view(-1, 1, 1) + 50, 100, rounding_mode="floor").clamp(1, 255).float()
+
+
+def dct_matrix(device):
+    ## the orthonormal DCT-II, which has the scale of the JPEG DCT
+    k = torch.arange(8, device=device, dtype=torch.float32).view(8, 1)
+    n = torch.arange(8, device=device, dtype=torch.float32).view(1, 8)
+    matrix = torch.cos((2 * n + 1) * k * torch.pi / 16) * 0.5
+    matrix[0] /= 2 ** 0.5
+    return matrix
+
+
+def quantize_blocks(plane, tables):
+    ## |plane| (N, H, W) with H and W multiples of 8, through the quantized DCT of its 8x8 blocks
+    n, h, w = plane.shape
+    dct = dct_matrix(plane.device)
+    blocks = (plane - 128).view(n, h // 8, 8, w // 8, 8).transpose(2, 3)
+    tables = tables.view(n, 1, 1, 8, 8)
+    coefficients = (dct @ blocks @ dct.T / tables).round_() * tables
+    blocks = dct.T @ coefficients @ dct
+    return (blocks.transpose(2, 3).reshape(n, h, w) + 128).round_().clamp_(0, 255)
+
+
+def simulated_jpeg(images, params):
+    ## convertToJpeg without leaving the device: 4:2:0 YCbCr with the quantized DCT of libjpeg, decoded
+    ## with the triangle chroma upsampling of libjpeg, which is a bilinear upsampling by 2; only the
+    ## lossless entropy coding is left out, and the integer arithmetic of libjpeg is done in float
+    h, w = images.shape[2:]
+    x = F.pad(images, (0, (-w) % 16, 0, (-h) % 16), mode="replicate")
+    r, g, b = x.unbind(1)
+    y = (0.299 * r + 0.587 * g + 0.114 * b).round_()
+    cb = -0.168736 * r - 0.331264 * g + 0.5 * b + 128
+    cr = 0.5 * r - 0.418688 * g - 0.081312 * b + 128
+    chroma = F.avg_pool2d(torch.stack([cb, cr], 1), 2).round_()
+
+    qualities = [p["quality"] for p in params]
+    y = quantize_blocks(y, jpeg_tables(JPEG_LUMA_TABLE, qualities, images.device))
+    chroma_tables = jpeg_tables(JPEG_CHROMA_TABLE, qualities, images.device)
+    chroma = torch.stack([quantize_blocks(plane, chroma_tables) for plane in chroma.unbind(1)], 1)
+    cb, cr = (F.interpolate(chroma, scale_factor=2, mode="bilinear", align_corners=False) - 128).unbind(1)
+
+    rgb = torch.stack([y + 1.402 * cr, y - 0.344136 * cb - 0.714136 * cr, y + 1.772 * cb], 1)
+    return rgb[:, :, :h, :w].round_().clamp_(0, 255)
+
+
+DEGRADATIONS = {BLUR: gaussian_blur, NOISE: add_noise, LOW_RESOLUTION: low_resolution, JPEG: jpeg}
+
+
+def random_seeds(count):
+    ## from the torch RNG, which DataLoader seeds differently in every worker
+    return torch.randint(0, MAX_SEED, (count,)).tolist()
+
+
+def degrade(images, seeds=None):
+    """online_add_degradation_v2 on a batch of uint8 |images| (N, 3, H, W), returned as uint8 on their device.
+
+    |seeds| gives the seed of every image, random ones are drawn from the torch RNG without it. Off the
+    CPU, JPEG is simulated on the device instead of being encoded by libjpeg."""
+    n, _, h, w = images.shape
+    if seeds is None:
+        seeds = random_seeds(n)
+    params = [sample_degradation(torch.Generator().manual_seed(int(seed)), h, w) for seed in seeds]
+    degradations = dict(DEGRADATIONS)
+    if images.device.type != "cpu":
+        degradations[JPEG] = simulated_jpeg
+    x = images.float()
+    for step in range(4):
+        for task, degradation in degradations.items():
+            selected = [i for i, p in enumerate(params) if p["order"][step] == task and p["apply"][task]]
+            if len(selected) == n:
+                x = degradation(x, params)
+            elif selected:
+                index = torch.tensor(selected, device=x.device)
+                x.index_copy_(0, index, degradation(x.index_select(0, index), [params[i] for i in selected]))
+    return x.to(torch.uint8)
+
+
+def degrade_image(img, seed=None):
+    """degrade() for one RGB PIL image."""
+    x = torch.from_numpy(np.array(img)).permute(2, 0, 1)[None]
+    x = degrade(x, None if seed is None else [seed])
+    return Image.fromarray(x[0].permute(1, 2, 0).numpy())
+
+
+def to_grayscale(images):
+    ## PIL's convert("L") then convert("RGB") on uint8 images
+    r, g, b = images.int().unbind(1)
+    gray = (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+    return gray.to(torch.uint8).unsqueeze(1).expand_as(images)
+
+
+def degrade_training_batch(data, device, paired):
+    """The degradation and grayscale augmentation that datasets built with --gpu_degradation leave to
+    the training loop, on |device|. data['degrade_on_gpu'] marks the images to degrade; the degraded
+    images become data['label'], and data['image'] too unless the batch is |paired| with clean targets."""
+    if "degrade_on_gpu" not in data:
+        return data
+    ## the datasets normalize the clean crops to [-1, 1]
+    clean = data["image"].to(device, non_blocking=True).add(1).mul_(127.5).round_().to(torch.uint8)
+    degraded = clean.clone()
+    selected = torch.nonzero(data["degrade_on_gpu"]).view(-1).to(device)
+    if len(selected) > 0:
+        degraded.index_copy_(0, selected, degrade(clean.index_select(0, selected)))
+    gray = (torch.rand(len(clean)) < 0.1).to(device).view(-1, 1, 1, 1)
+    degraded = torch.where(gray, to_grayscale(degraded), degraded)
+    clean = torch.where(gray, to_grayscale(clean), clean)
+
+    data = dict(data)
+    data["label"] = degraded.float().div_(127.5).sub_(1)
+    data["image"] = clean.float().div_(127.5).sub_(1) if paired else data["label"]
+    return data
@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import random
+import struct
+
+import numpy as np
+from PIL import Image
+
+try:
+    from .Load_Bigfile import open_bigfile
+except ImportError:
+    from Load_Bigfile import open_bigfile
+
+## magic, uint32 count, uint32 size, then every mask as size rows of np.packbits bits, 1 for a hole
+MASK_BANK_MAGIC = b'MASKBNK1'
+MASK_BANK_HEADER = 16
+
+
+def write_mask_bank(masks, path, size):
+    """Rasterizes the masks of the bigfile loader |masks| to |size| x |size| bits at |path|. As in
+    PairOldPhotos_with_hole the masks are resized with NEAREST; pixels of 128 or more are holes."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fid:
+        fid.write(MASK_BANK_MAGIC)
+        fid.write(struct.pack('<II', len(masks), size))
+        for i in range(len(masks)):
+            _, mask = masks[i]
+            hole = np.array(mask.convert('L').resize((size, size), Image.NEAREST)) >= 128
+            fid.write(np.packbits(hole, axis=-1).tobytes())
+    os.replace(tmp_path, path)
+
+
+class MaskBank(object):
+    """The masks of a bank written by write_mask_bank, mapped read-only and unpacked when read."""
+
+    def __open(self):
+        with open(self.path, 'rb') as fid:
+            header = fid.read(MASK_BANK_HEADER)
+        if len(header) < MASK_BANK_HEADER or header[:8] != MASK_BANK_MAGIC:
+            raise ValueError('%s is not a mask bank' % self.path)
+        self.count, self.size = struct.unpack('<II', header[8:])
+        self.bits = np.memmap(self.path, dtype=np.uint8, mode='r', offset=MASK_BANK_HEADER,
+                              shape=(self.count, self.size, (self.size + 7) // 8))
+
+    def __init__(self, path):
+        self.path = path
+        self.__open()
+        print('find total %d masks of %dx%d in %s' % (self.count, self.size, self.size, path))
+
+    def __getstate__(self):
+        ## the map is not pickled for spawned DataLoader workers, they map the bank again
+        state = self.__dict__.copy()
+        del state['bits']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open()
+
+    def __hole(self, index, size):
+        if size > self.size:
+            raise ValueError('%s holds %dx%d masks, %dx%d masks were requested' % (self.path, self.size, self.size, size, size))
+        return np.unpackbits(self.bits[index], axis=-1, count=self.size).view(np.bool_)
+
+    def mask(self, index, size=0):
+        """The bool holes of mask |index| as size x size x 3, like the RGB masks of the bigfile, cropped
+        to its center |size| x |size| when it is given."""
+        hole = self.__hole(index, size)
+        if 0 < size < self.size:
+            start = (self.size - size) // 2
+            hole = hole[start:start + size, start:start + size]
+        return np.repeat(hole[:, :, None], 3, axis=2)
+
+    def random_mask(self, size):
+        """A random mask as |size| x |size| x 3, cropped at a random position, rotated by a multiple of
+        90 degrees and maybe flipped."""
+        hole = self.__hole(random.randint(0, self.count - 1), size)
+        if self.size > size:
+            y = random.randint(0, self.size - size)
+            x = random.randint(0, self.size - size)
+            hole = hole[y:y + size, x:x + size]
+        hole = np.rot90(hole, random.randint(0, 3))
+        if random.random() > 0.5:
+            hole = hole[:, ::-1]
+        return np.repeat(hole[:, :, None], 3, axis=2)
+
+    def __len__(self):
+        return self.count
+
+
+def load_mask_bank(path, masks_path, size):
+    """The bank at |path|, written from the mask bigfile at |masks_path| first if it does not exist."""
+    if not os.path.isfile(path):
+        print('rasterize the masks of %s into %s' % (masks_path, path))
+        write_mask_bank(open_bigfile(masks_path), path, size)
+    return MaskBank(path)
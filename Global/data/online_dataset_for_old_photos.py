@@ -9,7 +9,10 @@ from data.image_folder import make_dataset
 from PIL import Image
 import torchvision.transforms as transforms
 import numpy as np
-from data.Load_Bigfile import BigFileMemoryLoader
+from data.Load_Bigfile import BigFileSubset, open_bigfile
+from data.degradation import degrade_image
+from data.mask_bank import load_mask_bank
+import torch
 import random
 import cv2
 from io import BytesIO
@@ -153,6 +156,12 @@ def online_add_degradation_v2(img):
     return img
 
 
+def add_degradation(img, opt):
+    if opt.degradation_engine == "torch":
+        return degrade_image(img)
+    return online_add_degradation_v2(img)
+
+
 def irregular_hole_synthesize(img,mask):
 
     img_np=np.array(img).astype('uint8')
@@ -165,6 +174,12 @@ def irregular_hole_synthesize(img,mask):
 
     return hole_img,mask.convert("L")
 
+def fill_holes(img, hole):
+    ## irregular_hole_synthesize for a bool mask: the holes are painted white
+    img_np=np.array(img)
+    img_np[hole]=255
+    return Image.fromarray(img_np)
+
 def zero_mask(size):
     x=np.zeros((size,size,3)).astype('uint8')
     mask=Image.fromarray(x).convert("RGB")
@@ -172,6 +187,17 @@ def zero_mask(size):
 
 
 
+def filter_small_images(loaded_imgs, min_size=256):
+    ## Filter the images by the sizes in the bigfile index; they are only decoded when sampled
+    print("-------------Filter the imgs whose size <%d in VOC-------------" % min_size)
+    sizes = loaded_imgs.sizes()
+    indices = np.flatnonzero((sizes >= min_size).all(axis=1))
+    filtered_imgs = BigFileSubset(loaded_imgs, indices)
+    print("--------Origin image num is [%d], filtered result is [%d]--------" % (
+    len(loaded_imgs), len(filtered_imgs)))
+    return filtered_imgs
+
+
 class UnPairOldPhotos_SR(BaseDataset):  ## Synthetic + Real Old
     def initialize(self, opt):
         self.opt = opt
@@ -184,27 +210,17 @@ class UnPairOldPhotos_SR(BaseDataset):  ## Synthetic + Real Old
             self.load_img_dir_RGB_old=os.path.join(self.dir_AB,"Real_RGB_old.bigfile")
             self.load_img_dir_clean=os.path.join(self.dir_AB,"VOC_RGB_JPEGImages.bigfile")
 
-            self.loaded_imgs_L_old=BigFileMemoryLoader(self.load_img_dir_L_old)
-            self.loaded_imgs_RGB_old=BigFileMemoryLoader(self.load_img_dir_RGB_old)
-            self.loaded_imgs_clean=BigFileMemoryLoader(self.load_img_dir_clean)
+            self.loaded_imgs_L_old=open_bigfile(self.load_img_dir_L_old)
+            self.loaded_imgs_RGB_old=open_bigfile(self.load_img_dir_RGB_old)
+            self.loaded_imgs_clean=open_bigfile(self.load_img_dir_clean)
 
         else:
             # self.load_img_dir_clean=os.path.join(self.dir_AB,self.opt.test_dataset)
             self.load_img_dir_clean=os.path.join(self.dir_AB,"VOC_RGB_JPEGImages.bigfile")
-            self.loaded_imgs_clean=BigFileMemoryLoader(self.load_img_dir_clean)
+            self.loaded_imgs_clean=open_bigfile(self.load_img_dir_clean)
 
         ####
-        print("-------------Filter the imgs whose size <256 in VOC-------------")
-        self.filtered_imgs_clean=[]
-        for i in range(len(self.loaded_imgs_clean)):
-            img_name,img=self.loaded_imgs_clean[i]
-            h,w=img.size
-            if h<256 or w<256:
-                continue
-            self.filtered_imgs_clean.append((img_name,img))
-
-        print("--------Origin image num is [%d], filtered result is [%d]--------" % (
-        len(self.loaded_imgs_clean), len(self.filtered_imgs_clean)))
+        self.filtered_imgs_clean = filter_small_images(self.loaded_imgs_clean)
         ## Filter these images whose size is less than 256
 
         # self.img_list=os.listdir(load_img_dir)
@@ -242,8 +258,8 @@ class UnPairOldPhotos_SR(BaseDataset):  ## Synthetic + Real Old
 
         img_name,img = sampled_dataset[index]
 
-        if degradation is not None:
-            img=online_add_degradation_v2(img)
+        if degradation is not None and not self.opt.gpu_degradation:
+            img=add_degradation(img,self.opt)
 
         path=os.path.join(self.load_img_dir,img_name)
 
@@ -252,7 +268,7 @@ class UnPairOldPhotos_SR(BaseDataset):  ## Synthetic + Real Old
 
         # apply the same transform to both A and B
 
-        if random.uniform(0,1) <0.1:
+        if random.uniform(0,1) <0.1 and not self.opt.gpu_degradation:
             img=img.convert("L")
             img=img.convert("RGB")
             ## Give a probability P, we convert the RGB image into L
@@ -284,6 +300,9 @@ class UnPairOldPhotos_SR(BaseDataset):  ## Synthetic + Real Old
 
         input_dict = {'label': A_tensor, 'inst': is_real_old, 'image': A_tensor,
                         'feat': feat_tensor, 'path': path}
+        if self.opt.gpu_degradation:
+            ## degradation and the grayscale conversion are left to degrade_training_batch
+            input_dict['degrade_on_gpu'] = int(degradation is not None)
         return input_dict
 
     def __len__(self):
@@ -301,23 +320,13 @@ class PairOldPhotos(BaseDataset):
         self.dir_AB = opt.dataroot
         if opt.isTrain:
             self.load_img_dir_clean= os.path.join(self.dir_AB, "VOC_RGB_JPEGImages.bigfile")
-            self.loaded_imgs_clean = BigFileMemoryLoader(self.load_img_dir_clean)
-
-            print("-------------Filter the imgs whose size <256 in VOC-------------")
-            self.filtered_imgs_clean = []
-            for i in range(len(self.loaded_imgs_clean)):
-                img_name, img = self.loaded_imgs_clean[i]
-                h, w = img.size
-                if h < 256 or w < 256:
-                    continue
-                self.filtered_imgs_clean.append((img_name, img))
+            self.loaded_imgs_clean = open_bigfile(self.load_img_dir_clean)
 
-            print("--------Origin image num is [%d], filtered result is [%d]--------" % (
-            len(self.loaded_imgs_clean), len(self.filtered_imgs_clean)))
+            self.filtered_imgs_clean = filter_small_images(self.loaded_imgs_clean)
 
         else:
             self.load_img_dir=os.path.join(self.dir_AB,opt.test_dataset)
-            self.loaded_imgs=BigFileMemoryLoader(self.load_img_dir)
+            self.loaded_imgs=open_bigfile(self.load_img_dir)
 
         self.pid = os.getpid()
 
@@ -328,15 +337,17 @@ class PairOldPhotos(BaseDataset):
         if self.opt.isTrain:
             img_name_clean,B = self.filtered_imgs_clean[index]
             path = os.path.join(self.load_img_dir_clean, img_name_clean)
-            if self.opt.use_v2_degradation:
-                A=online_add_degradation_v2(B)
+            if self.opt.gpu_degradation:
+                A=B
+            elif self.opt.use_v2_degradation:
+                A=add_degradation(B,self.opt)
             ### Remind: A is the input and B is corresponding GT
         else:
 
             if self.opt.test_on_synthetic:
 
                 img_name_B,B=self.loaded_imgs[index]
-                A=online_add_degradation_v2(B)
+                A=add_degradation(B,self.opt)
                 img_name_A=img_name_B
                 path = os.path.join(self.load_img_dir, img_name_A)
             else:
@@ -345,7 +356,7 @@ class PairOldPhotos(BaseDataset):
                 path = os.path.join(self.load_img_dir, img_name_A)
 
 
-        if random.uniform(0,1)<0.1 and self.opt.isTrain:
+        if random.uniform(0,1)<0.1 and self.opt.isTrain and not self.opt.gpu_degradation:
             A=A.convert("L")
             B=B.convert("L")
             A=A.convert("RGB")
@@ -386,6 +397,8 @@ class PairOldPhotos(BaseDataset):
 
         input_dict = {'label': A_tensor, 'inst': inst_tensor, 'image': B_tensor,
                     'feat': feat_tensor, 'path': path}
+        if self.opt.gpu_degradation and self.opt.isTrain:
+            input_dict['degrade_on_gpu'] = int(self.opt.use_v2_degradation)
         return input_dict
 
     def __len__(self):
@@ -407,25 +420,20 @@ class PairOldPhotos_with_hole(BaseDataset):
         self.dir_AB = opt.dataroot
         if opt.isTrain:
             self.load_img_dir_clean= os.path.join(self.dir_AB, "VOC_RGB_JPEGImages.bigfile")
-            self.loaded_imgs_clean = BigFileMemoryLoader(self.load_img_dir_clean)
-
-            print("-------------Filter the imgs whose size <256 in VOC-------------")
-            self.filtered_imgs_clean = []
-            for i in range(len(self.loaded_imgs_clean)):
-                img_name, img = self.loaded_imgs_clean[i]
-                h, w = img.size
-                if h < 256 or w < 256:
-                    continue
-                self.filtered_imgs_clean.append((img_name, img))
+            self.loaded_imgs_clean = open_bigfile(self.load_img_dir_clean)
 
-            print("--------Origin image num is [%d], filtered result is [%d]--------" % (
-            len(self.loaded_imgs_clean), len(self.filtered_imgs_clean)))
+            self.filtered_imgs_clean = filter_small_images(self.loaded_imgs_clean)
 
         else:
             self.load_img_dir=os.path.join(self.dir_AB,opt.test_dataset)
-            self.loaded_imgs=BigFileMemoryLoader(self.load_img_dir)
+            self.loaded_imgs=open_bigfile(self.load_img_dir)
 
-        self.loaded_masks = BigFileMemoryLoader(opt.irregular_mask)
+        if opt.mask_bank:
+            self.mask_bank = load_mask_bank(opt.mask_bank, opt.irregular_mask, opt.mask_bank_size or opt.loadSize)
+        else:
+            self.loaded_masks = open_bigfile(opt.irregular_mask)
+        if opt.gpu_degradation:
+            print("PairOldPhotos_with_hole degrades before adding the holes, on the CPU; --gpu_degradation is ignored")
 
         self.pid = os.getpid()
 
@@ -439,7 +447,7 @@ class PairOldPhotos_with_hole(BaseDataset):
 
 
             B=transforms.RandomCrop(256)(B)
-            A=online_add_degradation_v2(B)
+            A=add_degradation(B,self.opt)
             ### Remind: A is the input and B is corresponding GT
 
         else:
@@ -458,23 +466,26 @@ class PairOldPhotos_with_hole(BaseDataset):
             B=B.convert("RGB")
         ## In P, we convert the RGB into L
 
-        if self.opt.isTrain:
-            mask_name,mask=self.loaded_masks[random.randint(0,len(self.loaded_masks)-1)]
+        if self.opt.mask_bank:
+            A,hole=self.bank_hole(A,index)
         else:
-            mask_name, mask = self.loaded_masks[index%100]
-        mask = mask.resize((self.opt.loadSize, self.opt.loadSize), Image.NEAREST)
+            if self.opt.isTrain:
+                mask_name,mask=self.loaded_masks[random.randint(0,len(self.loaded_masks)-1)]
+            else:
+                mask_name, mask = self.loaded_masks[index%100]
+            mask = mask.resize((self.opt.loadSize, self.opt.loadSize), Image.NEAREST)
 
-        if self.opt.random_hole and random.uniform(0,1)>0.5 and self.opt.isTrain:
-            mask=zero_mask(256)
+            if self.opt.random_hole and random.uniform(0,1)>0.5 and self.opt.isTrain:
+                mask=zero_mask(256)
 
-        if self.opt.no_hole:
-            mask=zero_mask(256)
+            if self.opt.no_hole:
+                mask=zero_mask(256)
 
 
-        A,_=irregular_hole_synthesize(A,mask)
+            A,_=irregular_hole_synthesize(A,mask)
 
-        if not self.opt.isTrain and self.opt.hole_image_no_mask:
-            mask=zero_mask(256)
+            if not self.opt.isTrain and self.opt.hole_image_no_mask:
+                mask=zero_mask(256)
 
         flip = get_random_flip()
         transform = get_transform(
@@ -485,16 +496,21 @@ class PairOldPhotos_with_hole(BaseDataset):
             self.opt.test_random_crop, 
             self.opt.isTrain, 
             self.opt.no_flip, 
-            get_random_flip(), 
+            flip, 
             self.opt.n_downsample_global, 
             self.opt.netG, 
             self.opt.n_local_enhancers, 
         )
 
-        if flip and self.opt.isTrain:
-            mask=mask.transpose(Image.FLIP_LEFT_RIGHT)
+        if self.opt.mask_bank:
+            if flip and self.opt.isTrain and not self.opt.no_flip:
+                hole=hole[:,::-1]
+            mask_tensor = torch.from_numpy(np.ascontiguousarray(hole)).permute(2, 0, 1).float()
+        else:
+            if flip and self.opt.isTrain and not self.opt.no_flip:
+                mask=mask.transpose(Image.FLIP_LEFT_RIGHT)
 
-        mask_tensor = transforms.ToTensor()(mask)
+            mask_tensor = transforms.ToTensor()(mask)
 
 
         B_tensor = inst_tensor = feat_tensor = 0
@@ -505,6 +521,22 @@ class PairOldPhotos_with_hole(BaseDataset):
                     'feat': feat_tensor, 'path': path}
         return input_dict
 
+    def bank_hole(self, A, index):
+        ## A with the holes of a mask from the bank, cropped, rotated and flipped at random while training
+        if self.opt.isTrain:
+            hole=self.mask_bank.random_mask(self.opt.loadSize)
+        else:
+            hole=self.mask_bank.mask(index%100,self.opt.loadSize)
+
+        if (self.opt.random_hole and random.uniform(0,1)>0.5 and self.opt.isTrain) or self.opt.no_hole:
+            hole=np.zeros_like(hole)
+
+        A=fill_holes(A,hole)
+
+        if not self.opt.isTrain and self.opt.hole_image_no_mask:
+            hole=np.zeros_like(hole)
+        return A,hole
+
     def __len__(self):
 
         if self.opt.isTrain:
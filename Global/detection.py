@@ -19,6 +19,13 @@ except ImportError:
     from detection_models import networks
     from detection_util.util import *
 
+try:
+    from ..bopbtl_utils import checkpoint, onnx_util
+    from ..bopbtl_utils.cpu_threads import set_cpu_threads
+except ImportError:
+    from bopbtl_utils import checkpoint, onnx_util
+    from bopbtl_utils.cpu_threads import set_cpu_threads
+
 warnings.filterwarnings("ignore", category=UserWarning)
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -74,10 +81,30 @@ def blend_mask(img, mask):
     return Image.fromarray((np_img * (1 - mask) + mask * 255.0).astype("uint8")).convert("RGB")
 
 
+class OnnxScratchDetector:
+    """The scratch detection UNet written by export_onnx, run with onnxruntime on the CPU."""
+
+    def __init__(self, path: str, num_threads: int = 0, num_interop_threads: int = 0):
+        self.session = onnx_util.create_session(path, num_threads, num_interop_threads)
+
+    def __call__(self, image: torch.Tensor) -> torch.Tensor:
+        return torch.from_numpy(onnx_util.run(self.session, {"image": image}))
+
+
+def export_onnx(model: networks.UNet, path: str, size: int = 256):
+    return onnx_util.export(model, {"image": torch.zeros(1, 1, size, size)}, path)
+
+
 def load_model(
     device_ids, # str | int
     checkpoint_path: str,
+    num_threads: int = 0,
+    num_interop_threads: int = 0,
 ):
+    if checkpoint_path.endswith(onnx_util.ONNX_EXTENSION):
+        if str(device_ids) not in ("-1", "cpu"):
+            raise ValueError("ONNX models only run on CPU; use device -1")
+        return OnnxScratchDetector(checkpoint_path, num_threads, num_interop_threads)
     model = networks.UNet(
         in_channels=1,
         out_channels=1,
@@ -91,33 +118,51 @@ def load_model(
         sync_bn=True,
         antialiasing=True,
     )
-    checkpoint = torch.load(checkpoint_path, map_location="cpu")
-    model.load_state_dict(checkpoint["model_state"])
+    checkpoint.load_network_from_path(model, checkpoint_path, key="model_state", strict=True)
     try:
         device_ids = int(device_ids)
     except:
         pass
     if type(device_ids) is int and device_ids < 0:
-        model.cpu()
-    else:
-        model.to(device_ids)
+        device_ids = "cpu"
+    model.to(device_ids)
+    if torch.device(device_ids).type == "cpu":
+        ## oneDNN convolutions avoid reordering their inputs in the NHWC layout
+        model.to(memory_format=torch.channels_last)
     model.eval()
     return model
 
 
-def detect_scratches(
+def scratch_input(
     image: Image.Image, 
-    model: networks.UNet, 
-    device_ids, # str | int
     input_size: str, 
     resize_method: Image.Resampling=Image.Resampling.BICUBIC, 
-) -> torch.Tensor:
+):
+    ## the 1 x 1 x h x w input of the UNet and the size of the mask to return
     image = data_transforms(image, input_size, resize_method).convert("L")
     image = torchvision.transforms.ToTensor()(image)
     image = torchvision.transforms.Normalize([0.5], [0.5])(image)
     image = torch.unsqueeze(image, 0)
     _, _, ow, oh = image.shape
-    scaled_image = scale_tensor(image)
+    return scale_tensor(image), (ow, oh)
+
+
+def scratch_mask(logits: torch.Tensor, size) -> torch.Tensor:
+    ## the binary 1 x h x w mask of one UNet output
+    mask = torch.sigmoid(logits.unsqueeze(0)).data.cpu()
+    mask = F.interpolate(mask, list(size), mode="nearest")
+    mask: torch.Tensor = (mask >= 0.4).float()
+    return mask[0]
+
+
+def detect_scratches(
+    image: Image.Image, 
+    model: networks.UNet, 
+    device_ids, # str | int
+    input_size: str, 
+    resize_method: Image.Resampling=Image.Resampling.BICUBIC, 
+) -> torch.Tensor:
+    scaled_image, size = scratch_input(image, input_size, resize_method)
     try:
         device_ids = int(device_ids)
     except:
@@ -127,12 +172,9 @@ def detect_scratches(
     else:
         scaled_image = scaled_image.to(device_ids)
 
-    with torch.no_grad():
-        mask = torch.sigmoid(model(scaled_image))
-    mask = mask.data.cpu()
-    mask = F.interpolate(mask, [ow, oh], mode="nearest")
-    mask: torch.Tensor = (mask >= 0.4).float()
-    return mask[0]
+    with torch.inference_mode():
+        logits = model(scaled_image)
+    return scratch_mask(logits[0], size)
 
 
 def main(config):
@@ -141,10 +183,15 @@ def main(config):
     if config.test_path == config.output_dir:
         raise RuntimeError("Input and output directories cannot be the same!")
 
+    if str(config.GPU) == "-1":
+        set_cpu_threads(config.cpu_threads, config.cpu_interop_threads)
+
     # load model
     model = load_model(
         device_ids=config.GPU, 
-        checkpoint_path=config.checkpoint_name
+        checkpoint_path=config.checkpoint_name, 
+        num_threads=config.cpu_threads, 
+        num_interop_threads=config.cpu_interop_threads, 
     )
 
     for file in os.listdir(config.test_path):
@@ -184,10 +231,12 @@ def main(config):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--checkpoint_name', type=str, default="./checkpoints/detection/FT_Epoch_latest.pt", help='Checkpoint Path')
+    parser.add_argument('--checkpoint_name', type=str, default="./checkpoints/detection/FT_Epoch_latest.pt", help='Checkpoint Path; a .onnx file written by export_onnx.py runs with onnxruntime on CPU')
     parser.add_argument("--GPU", type=str, default=0, help='Default gpu_id=0, cpu_id=-1, multiple gpus=\"2,3\"')
     parser.add_argument("--test_path", type=str)
     parser.add_argument("--output_dir", type=str)
     parser.add_argument("--input_size", type=str, default="scale_256", help="resize_256|full_size|scale_256")
+    parser.add_argument("--cpu_threads", type=int, default=0, help="intra-op threads of CPU inference, 0 uses the torch default")
+    parser.add_argument("--cpu_interop_threads", type=int, default=0, help="inter-op threads of CPU inference, 0 uses the torch default")
     config = parser.parse_args()
     main(config)
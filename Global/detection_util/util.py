@@ -19,7 +19,6 @@ except:
     pass
 
 import yaml
-import matplotlib.pyplot as plt
 from easydict import EasyDict as edict
 import torchvision.utils as vutils
 
@@ -200,6 +199,8 @@ def tb_image_logger_test(epoch, iter, images_info, config):
 
 
 def imshow(input_image, title=None, to_numpy=False):
+    import matplotlib.pyplot as plt
+
     inp = input_image
     if to_numpy or type(input_image) is torch.Tensor:
         inp = input_image.numpy()
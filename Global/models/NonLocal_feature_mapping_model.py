@@ -83,6 +83,16 @@ class Mapping_Model_with_mask(nn.Module):
 
         return x3
 
+    def inference_forward(self, input, mask):
+        x1 = self.before_NL(input)
+        del input
+        x2 = self.NL.inference_forward(x1, mask)
+        del x1, mask
+        x3 = self.after_NL(x2)
+        del x2
+
+        return x3
+
 class Mapping_Model_with_mask_2(nn.Module): ## Multi-Scale Patch Attention
     def __init__(self, nc, mc=64, n_blocks=3, norm="instance", padding_type="reflect", opt=None):
         super(Mapping_Model_with_mask_2, self).__init__()
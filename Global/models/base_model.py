@@ -5,6 +5,16 @@ import os
 import torch
 import sys
 
+try:
+    from ..util.background_writer import atomic_save, cpu_snapshot
+except ImportError:
+    from util.background_writer import atomic_save, cpu_snapshot
+
+try:
+    from ...bopbtl_utils import checkpoint
+except ImportError:
+    from bopbtl_utils import checkpoint
+
 
 class BaseModel(torch.nn.Module):
     def name(self):
@@ -16,10 +26,16 @@ class BaseModel(torch.nn.Module):
         self.isTrain = opt.isTrain
         self.Tensor = torch.cuda.FloatTensor if self.gpu_ids else torch.Tensor
         self.save_dir = os.path.join(opt.checkpoints_dir, opt.name)
+        ## a BackgroundWriter set by the training scripts
+        self.checkpoint_writer = None
 
     def set_input(self, input):
         self.input = input
 
+    def to_input_device(self, tensor):
+        ## the current GPU, which is the replica's own under DataParallel; inputs stay put on the CPU
+        return tensor.cuda() if self.gpu_ids else tensor
+
     def forward(self):
         pass
 
@@ -42,18 +58,41 @@ class BaseModel(torch.nn.Module):
     def save(self, label):
         pass
 
+    def write_checkpoint(self, state, save_path):
+        ## a CPU copy, written by the checkpoint writer while training goes on when there is one;
+        ## the network is not moved, DistributedDataParallel holds on to its parameters
+        state = cpu_snapshot(state)
+        if self.checkpoint_writer is None:
+            atomic_save(state, save_path)
+        else:
+            self.checkpoint_writer.submit(atomic_save, state, save_path)
+
     # helper saving function that can be used by subclasses
     def save_network(self, network, network_label, epoch_label, gpu_ids):
         save_filename = "%s_net_%s.pth" % (epoch_label, network_label)
         save_path = os.path.join(self.save_dir, save_filename)
-        torch.save(network.cpu().state_dict(), save_path)
-        if len(gpu_ids) and torch.cuda.is_available():
-            network.cuda()
+        self.write_checkpoint(network.state_dict(), save_path)
 
     def save_optimizer(self, optimizer, optimizer_label, epoch_label):
         save_filename = "%s_optimizer_%s.pth" % (epoch_label, optimizer_label)
         save_path = os.path.join(self.save_dir, save_filename)
-        torch.save(optimizer.state_dict(), save_path)
+        self.write_checkpoint(optimizer.state_dict(), save_path)
+
+    def pool_path(self, epoch_label):
+        ## every rank of a distributed run keeps a pool of its own
+        save_filename = "%s_pool_rank%d.pth" % (epoch_label, getattr(self.opt, "rank", 0))
+        return os.path.join(self.save_dir, save_filename)
+
+    def save_pool(self, epoch_label):
+        if getattr(self, "fake_pool", None) is not None and self.fake_pool.pool_size > 0:
+            self.write_checkpoint(self.fake_pool.state_dict(), self.pool_path(epoch_label))
+
+    def load_pool(self, epoch_label):
+        save_path = self.pool_path(epoch_label)
+        if not os.path.isfile(save_path):
+            print("%s not exists yet!" % save_path)
+        else:
+            self.fake_pool.load_state_dict(torch.load(save_path))
 
     def load_optimizer(self, optimizer, optimizer_label, epoch_label, save_dir="", test_path=""):
         if test_path != "":
@@ -71,18 +110,22 @@ class BaseModel(torch.nn.Module):
             optimizer.load_state_dict(torch.load(save_path))
 
     # helper loading function that can be used by subclasses
-    def load_network(self, network, network_label, epoch_label, save_dir="", test_path=""):
+    def network_path(self, network_label, epoch_label, save_dir="", test_path=""):
         if test_path != "":
-            BaseModel.load_network_from_path(network, test_path)
-            return
-
+            return test_path
         save_filename = "%s_net_%s.pth" % (epoch_label, network_label)
         if not save_dir:
             save_dir = self.save_dir
+        return os.path.join(save_dir, save_filename)
+
+    def load_network(self, network, network_label, epoch_label, save_dir="", test_path=""):
+        if test_path != "":
+            BaseModel.load_network_from_path(network, test_path)
+            return
 
         # print(save_dir)
         # print(self.save_dir)
-        save_path = os.path.join(save_dir, save_filename)
+        save_path = self.network_path(network_label, epoch_label, save_dir)
         if not os.path.isfile(save_path):
             print("%s not exists yet!" % save_path)
             # if network_label == 'G':
@@ -92,44 +135,8 @@ class BaseModel(torch.nn.Module):
 
     @staticmethod
     def load_network_from_path(network, save_path):
-        # network.load_state_dict(torch.load(save_path))
-        try:
-            # print(save_path)
-            network.load_state_dict(torch.load(save_path))
-        except:
-            networkfile = os.path.split(save_path)[1]
-            pretrained_dict = torch.load(save_path)
-            model_dict = network.state_dict()
-            try:
-                pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
-                network.load_state_dict(pretrained_dict)
-                # if self.opt.verbose:
-                print(
-                    "Pretrained network %s has excessive layers; Only loading layers that are used"
-                    % networkfile
-                )
-            except:
-                print(
-                    "Pretrained network %s has fewer layers; The following are not initialized:"
-                    % networkfile
-                )
-                for k, v in pretrained_dict.items():
-                    if v.size() == model_dict[k].size():
-                        model_dict[k] = v
-
-                if sys.version_info >= (3, 0):
-                    not_initialized = set()
-                else:
-                    from sets import Set
-
-                    not_initialized = Set()
-
-                for k, v in model_dict.items():
-                    if k not in pretrained_dict or v.size() != pretrained_dict[k].size():
-                        not_initialized.add(k.split(".")[0])
-
-                print(sorted(not_initialized))
-                network.load_state_dict(model_dict)
+        ## read the checkpoint once and load the layers that match in name and size
+        checkpoint.load_network_from_path(network, save_path)
 
     def update_learning_rate():
         pass
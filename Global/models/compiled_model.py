@@ -0,0 +1,134 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import hashlib
+
+import torch
+import torch.nn as nn
+
+from .mapping_model import stage_device
+from .network_cache import network_hash
+
+COMPILE_MODES = ["none", "trace", "inductor"]
+
+## string options that change what the networks compute; every non-string option is part of the key
+KEY_OPTIONS = ["norm", "non_local", "NL_fusion_method"]
+
+
+class EncoderStage(nn.Module):
+    def __init__(self, network):
+        super(EncoderStage, self).__init__()
+        self.network = network
+
+    def forward(self, x):
+        return self.network(x, flow="enc")
+
+
+class MappingStage(nn.Module):
+    def __init__(self, network):
+        super(MappingStage, self).__init__()
+        self.network = network
+
+    def forward(self, x, mask=None):
+        if mask is None:
+            return self.network(x)
+        return self.network(x, mask)
+
+
+class DecoderStage(nn.Module):
+    def __init__(self, network):
+        super(DecoderStage, self).__init__()
+        self.network = network
+
+    def forward(self, x):
+        return self.network(x, flow="dec")
+
+
+class CompiledInference:
+    """Runs the encoder, mapping and decoder of a Pix2PixHDModel_Mapping as compiled modules.
+
+    trace: every stage is traced to TorchScript and frozen once per input shape. The modules
+    are saved in |cache_dir| under a key of the options, network structure, weights, input shape
+    and torch version, so a restarted process loads them instead of tracing again.
+    inductor: the stages are compiled with torch.compile and the inductor caches are kept in
+    |cache_dir|.
+
+    With --inference_optimize the chunked attention picks its keys from the mask content, so
+    the mapping stage keeps running eagerly."""
+
+    def __init__(self, model, mode, cache_dir):
+        if mode not in COMPILE_MODES[1:]:
+            raise ValueError("Unknown compile mode %s!" % mode)
+        self.opt = model.opt
+        self.model = model
+        self.mode = mode
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.stages = {"encode": EncoderStage(model.netG_A), "decode": DecoderStage(model.netG_B)}
+        if not self.opt.inference_optimize:
+            self.stages["mapping"] = MappingStage(model.mapping_net)
+        for stage in self.stages.values():
+            stage.eval()
+
+        if mode == "inductor":
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+            self.compiled = {name: torch.compile(stage) for name, stage in self.stages.items()}
+        else:
+            options = sorted(
+                (k, v) for k, v in vars(self.opt).items() if not isinstance(v, str) or k in KEY_OPTIONS
+            )
+            self.hashes = {
+                name: hashlib.sha1((repr(options) + network_hash(stage)).encode()).hexdigest()
+                for name, stage in self.stages.items()
+            }
+            self.traced = {}
+
+    def inference(self, label, inst):
+        model = self.model
+        label_feat = self.run("encode", label.to(stage_device(model.netG_A)))
+        if "mapping" in self.stages:
+            device = stage_device(model.mapping_net)
+            if self.opt.NL_use_mask:
+                label_feat_map = self.run("mapping", label_feat.to(device), inst.to(device))
+            else:
+                label_feat_map = self.run("mapping", label_feat.to(device))
+        else:
+            label_feat_map = model.inference_mapping(label_feat, inst)
+        del label_feat
+        return self.run("decode", label_feat_map.to(stage_device(model.netG_B)))
+
+    def inference_batch(self, labels, insts):
+        return [self.inference(label, inst) for label, inst in zip(labels, insts)]
+
+    def run(self, name, *inputs):
+        if self.mode == "inductor":
+            return self.compiled[name](*inputs)
+        key = self.key(name, inputs)
+        module = self.traced.get(key)
+        if module is None:
+            module = self.load_or_trace(name, key, inputs)
+            self.traced[key] = module
+        return module(*inputs)
+
+    def key(self, name, inputs):
+        description = [name, self.hashes[name], torch.__version__]
+        for x in inputs:
+            description.append(
+                (tuple(x.shape), str(x.dtype), str(x.device), x.is_contiguous(memory_format=torch.channels_last))
+            )
+        return hashlib.sha1(repr(description).encode()).hexdigest()
+
+    def load_or_trace(self, name, key, inputs):
+        path = os.path.join(self.cache_dir, "%s_%s.pt" % (name, key))
+        if os.path.isfile(path):
+            return torch.jit.load(path, map_location=inputs[0].device)
+        ## tracing records the graph through autograd, so it cannot run on inference tensors
+        inputs = tuple(x.clone() for x in inputs)
+        with torch.inference_mode(False), torch.no_grad():
+            module = torch.jit.freeze(torch.jit.trace(self.stages[name], inputs, check_trace=False))
+        ## write atomically, other processes may share the cache
+        torch.jit.save(module, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return module
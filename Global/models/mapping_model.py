@@ -7,6 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import os
 import functools
+import itertools
 from torch.autograd import Variable
 
 try:
@@ -14,10 +15,23 @@ try:
 except ImportError:
     from util.image_pool import ImagePool
 
+try:
+    from ...bopbtl_utils.quantization import prepare_int8, convert_int8
+except ImportError:
+    from bopbtl_utils.quantization import prepare_int8, convert_int8
+
 from .base_model import BaseModel
 from . import networks
 import math
 from .NonLocal_feature_mapping_model import *
+from . import network_cache
+
+
+def stage_device(network):
+    ## quantized networks keep their weights in packed buffers instead of parameters
+    for tensor in itertools.chain(network.parameters(), network.buffers()):
+        return tensor.device
+    return torch.device("cpu")
 
 
 class Mapping_Model(nn.Module):
@@ -85,6 +99,7 @@ class Pix2PixHDModel_Mapping(BaseModel):
         if opt.resize_or_crop != "none" or not opt.isTrain:
             torch.backends.cudnn.benchmark = True
         self.isTrain = opt.isTrain
+        self.quantized = False
         input_nc = opt.label_nc if opt.label_nc != 0 else opt.input_nc
 
         ##### define networks
@@ -137,9 +152,13 @@ class Pix2PixHDModel_Mapping(BaseModel):
         if opt.load_pretrain != "":
             self.load_network(self.mapping_net, "mapping_net", opt.which_epoch, opt.load_pretrain, test_path=opt.test_mapping_net)
 
-        if not opt.no_load_VAE:
-            self.load_network(self.netG_A, "G", opt.use_vae_which_epoch, opt.load_pretrainA, test_path=opt.test_vae_a)
-            self.load_network(self.netG_B, "G", opt.use_vae_which_epoch, opt.load_pretrainB, test_path=opt.test_vae_b)
+        if not opt.no_load_VAE and not self.isTrain:
+            self.netG_A = self.load_shared_VAE(self.netG_A, opt.load_pretrainA, opt.test_vae_a)
+            self.netG_B = self.load_shared_VAE(self.netG_B, opt.load_pretrainB, opt.test_vae_b)
+        elif not opt.no_load_VAE:
+            ## --test_vae_a and --test_vae_b are test options
+            self.load_network(self.netG_A, "G", opt.use_vae_which_epoch, opt.load_pretrainA, test_path=getattr(opt, "test_vae_a", ""))
+            self.load_network(self.netG_B, "G", opt.use_vae_which_epoch, opt.load_pretrainB, test_path=getattr(opt, "test_vae_b", ""))
             for param in self.netG_A.parameters():
                 param.requires_grad = False
             for param in self.netG_B.parameters():
@@ -168,8 +187,10 @@ class Pix2PixHDModel_Mapping(BaseModel):
         # set loss functions and optimizers
         if self.isTrain:
             if opt.pool_size > 0 and (len(self.gpu_ids)) > 1:
-                raise NotImplementedError("Fake Pool Not Implemented for MultiGPU")
+                raise NotImplementedError("Fake Pool Not Implemented for DataParallel, start the training with torchrun for a pool on every GPU")
             self.fake_pool = ImagePool(opt.pool_size)
+            if opt.continue_train and opt.pool_size > 0:
+                self.load_pool(opt.which_epoch)
             self.old_lr = opt.lr
 
             # define loss functions
@@ -218,7 +239,7 @@ class Pix2PixHDModel_Mapping(BaseModel):
 
     def encode_input(self, label_map, inst_map=None, real_image=None, feat_map=None, infer=False):             
         if self.opt.label_nc == 0:
-            input_label = label_map.data.cuda()
+            input_label = self.to_input_device(label_map.data)
         else:
             # create one-hot vector for label map 
             size = label_map.size()
@@ -230,14 +251,14 @@ class Pix2PixHDModel_Mapping(BaseModel):
 
         # get edges from instance map
         if not self.opt.no_instance:
-            inst_map = inst_map.data.cuda()
+            inst_map = self.to_input_device(inst_map.data)
             edge_map = self.get_edges(inst_map)
             input_label = torch.cat((input_label, edge_map), dim=1)         
         input_label = Variable(input_label, volatile=infer)
 
         # real images for training
         if real_image is not None:
-            real_image = Variable(real_image.data.cuda())
+            real_image = Variable(self.to_input_device(real_image.data))
 
         return input_label, inst_map, real_image, feat_map
 
@@ -325,28 +346,76 @@ class Pix2PixHDModel_Mapping(BaseModel):
 
         return [ self.loss_filter(loss_feat_l2, loss_G_GAN, loss_G_GAN_Feat, loss_G_VGG, loss_D_real, loss_D_fake,smooth_l1_loss,loss_feat_l2_stage_1), None if not infer else fake_image ]
 
+    def save(self, which_epoch):
+        self.save_network(self.mapping_net, "mapping_net", which_epoch, self.gpu_ids)
+        self.save_network(self.netD, "D", which_epoch, self.gpu_ids)
+
+    def set_stage_devices(self, encoder_device, mapping_device, decoder_device):
+        ## Place the encoder, mapping and decoder stages on separate devices
+        self.netG_A.to(encoder_device)
+        self.mapping_net.to(mapping_device)
+        self.netG_B.to(decoder_device)
+
+    def load_shared_VAE(self, network, save_dir, test_path):
+        ## the frozen VAEs are shared with other inference models loaded from the same checkpoint,
+        ## e.g. the VAE_A_quality encoder of the quality and the scratch restoration
+        opt = self.opt
+        device = torch.device("cuda", opt.gpu_ids[0]) if opt.gpu_ids else torch.device("cpu")
+        channels_last = getattr(opt, "channels_last", False) and not opt.gpu_ids
+        ## the pipeline moves the stages between devices
+        stage_gpu_ids = getattr(opt, "stage_gpu_ids", "")
+
+        def load(network):
+            self.load_network(network, "G", opt.use_vae_which_epoch, save_dir, test_path=test_path)
+            for param in network.parameters():
+                param.requires_grad = False
+            network.eval()
+            network.to(device)
 
-    def inference(self, label, inst):
+        path = self.network_path("G", opt.use_vae_which_epoch, save_dir, test_path)
+        return network_cache.shared_network(network, path, load, str(device), channels_last, stage_gpu_ids)
 
-        use_gpu = len(self.opt.gpu_ids) > 0
-        if use_gpu:
-            input_concat = label.data.cuda()
-            inst_data = inst.cuda()
-        else:
-            input_concat = label.data
-            inst_data = inst
+    def inference_encode(self, label):
+        device = stage_device(self.netG_A)
+        input_concat = label.data.to(device)
+        return self.netG_A.forward(input_concat, flow="enc")
 
-        label_feat = self.netG_A.forward(input_concat, flow="enc")
+    def inference_mapping(self, label_feat, inst):
+        device = stage_device(self.mapping_net)
+        label_feat = label_feat.to(device)
 
         if self.opt.NL_use_mask:
+            inst_data = inst.to(device)
             if self.opt.inference_optimize:
                 label_feat_map=self.mapping_net.inference_forward(label_feat.detach(),inst_data)
             else:   
                 label_feat_map = self.mapping_net(label_feat.detach(), inst_data)
         else:
             label_feat_map = self.mapping_net(label_feat.detach())
+        return label_feat_map
+
+    def inference_decode(self, label_feat_map):
+        device = stage_device(self.netG_B)
+        label_feat_map = label_feat_map.to(device)
+        return self.netG_B.forward(label_feat_map, flow="dec")
+
+    def quantize(self, labels, insts):
+        ## Post-training static int8 quantization of the mapping network, calibrated on the given
+        ## inputs; the attention blocks keep running in float
+        if stage_device(self.mapping_net).type != "cpu":
+            raise ValueError("int8 inference is only supported on CPU!")
+        prepare_int8(self.mapping_net, exclude=(networks.NonLocalBlock2D_with_mask_Res, networks.Patch_Attention_4))
+        with torch.inference_mode():
+            for label, inst in zip(labels, insts):
+                self.inference(label, inst)
+        convert_int8(self.mapping_net)
+        self.quantized = True
 
-        fake_image = self.netG_B.forward(label_feat_map, flow="dec")
+    def inference(self, label, inst):
+        label_feat = self.inference_encode(label)
+        label_feat_map = self.inference_mapping(label_feat, inst)
+        del label_feat
+        fake_image = self.inference_decode(label_feat_map)
         return fake_image
 
 
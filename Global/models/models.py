@@ -3,6 +3,11 @@
 
 import torch
 
+try:
+    from ..util.distributed import parallelize
+except ImportError:
+    from util.distributed import parallelize
+
 
 def create_model(opt):
     if opt.model == "pix2pixHD":
@@ -20,9 +25,8 @@ def create_model(opt):
     if opt.verbose:
         print("model [%s] was created" % (model.name()))
 
-    if opt.isTrain and len(opt.gpu_ids) > 1:
-        # pass
-        model = torch.nn.DataParallel(model, device_ids=opt.gpu_ids)
+    if opt.isTrain:
+        model = parallelize(model, opt)
 
     return model
 
@@ -40,8 +44,7 @@ def create_da_model(opt):
     if opt.verbose:
         print("model [%s] was created" % (model.name()))
 
-    if opt.isTrain and len(opt.gpu_ids) > 1:
-        #pass
-        model = torch.nn.DataParallel(model, device_ids=opt.gpu_ids)
+    if opt.isTrain:
+        model = parallelize(model, opt)
 
     return model
\ No newline at end of file
@@ -0,0 +1,54 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import hashlib
+import threading
+import weakref
+
+import torch
+
+## read-only inference networks by checkpoint and by content; a network is freed with the last model using it
+_networks = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+def network_hash(network):
+    digest = hashlib.sha1(repr(network).encode())
+    for name, value in network.state_dict().items():
+        digest.update(name.encode())
+        if torch.is_tensor(value) and not value.is_quantized:
+            digest.update(value.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy())
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+
+def checkpoint_key(path):
+    if path == "" or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def shared_network(network, path, load, *key):
+    """Returns the network already loaded from |path| for the same structure and |key|, or
+    |network| after calling |load| on it. A newly loaded network is also matched by its weights,
+    so copies of a checkpoint at different paths are shared as well.
+
+    The returned network may be used by several models at once and must not be modified."""
+    path_key = checkpoint_key(path)
+    with _lock:
+        if path_key is not None:
+            shared = _networks.get(("path", path_key, repr(network)) + key)
+            if shared is not None:
+                return shared
+        load(network)
+        content_key = ("content", network_hash(network)) + key
+        shared = _networks.get(content_key)
+        if shared is None:
+            shared = network
+            _networks[content_key] = shared
+        if path_key is not None:
+            _networks[("path", path_key, repr(network)) + key] = shared
+        return shared
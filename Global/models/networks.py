@@ -457,7 +457,40 @@ class NonLocalBlock2D_with_mask_Res(nn.Module):
             ]
         self.res_block = nn.Sequential(*model)
 
+    def valid_mask(self, mask, size):
+        ## Resize the scratch mask to the feature size; 1: valid position 0: hole
+        tmp = 1 - mask
+        mask = F.interpolate(mask, size, mode="bilinear")
+        mask[mask > 0] = 1.0
+        mask = 1 - mask
+
+        tmp = F.interpolate(tmp, size)
+        mask *= tmp
+        return mask
+
     def forward(self, x, mask):  ## The shape of mask is Batch*1*H*W
+        if self.mode != "combine":
+            return self.attention(x, mask)
+
+        ## The combine fusion keeps x wherever the mask is valid, so samples without
+        ## any hole come out unchanged and the HW x HW attention can be skipped for them.
+        ## Within a sample with holes every position stays a query: W and the instance
+        ## normalized res_block mix the attention output of the valid positions into the holes
+        valid = self.valid_mask(mask, (x.size(2), x.size(3)))
+        if torch.jit.is_tracing():
+            ## a trace would bake in the branch taken for the example mask
+            return self.attention(x, mask, valid)
+        has_hole = (valid < 1).flatten(1).any(dim=1)
+        if not has_hole.any():
+            return x
+        if has_hole.all():
+            return self.attention(x, mask, valid)
+
+        hole_index = torch.nonzero(has_hole, as_tuple=True)[0]
+        z = self.attention(x[hole_index], mask[hole_index], valid[hole_index])
+        return x.index_copy(0, hole_index, z)
+
+    def attention(self, x, mask, valid=None):
         batch_size = x.size(0)
 
         g_x = self.g(x).view(batch_size, self.inter_channels, -1)
@@ -474,19 +507,17 @@ class NonLocalBlock2D_with_mask_Res(nn.Module):
             theta_x = F.normalize(theta_x, dim=2)
             phi_x = F.normalize(phi_x, dim=1)
 
-        f = torch.matmul(theta_x, phi_x)
-
-        f /= self.temperature
+        ## the similarities can overflow float16 under autocast, so they and their softmax stay in float
+        with torch.autocast(x.device.type, enabled=False):
+            f = torch.matmul(theta_x.float(), phi_x.float())
 
-        f_div_C = F.softmax(f, dim=2)
+            f /= self.temperature
 
-        tmp = 1 - mask
-        mask = F.interpolate(mask, (x.size(2), x.size(3)), mode="bilinear")
-        mask[mask > 0] = 1.0
-        mask = 1 - mask
+            f_div_C = F.softmax(f, dim=2).to(g_x.dtype)
 
-        tmp = F.interpolate(tmp, (x.size(2), x.size(3)))
-        mask *= tmp
+        if valid is None:
+            valid = self.valid_mask(mask, (x.size(2), x.size(3)))
+        mask = valid
 
         mask_expand = mask.view(batch_size, 1, -1)
         mask_expand = mask_expand.repeat(1, x.size(2) * x.size(3), 1)
@@ -522,6 +553,77 @@ class NonLocalBlock2D_with_mask_Res(nn.Module):
             z = full_mask * x + (1 - full_mask) * W_y
         return z
 
+    def inference_forward(self, x, mask, chunk_size=4096):  ## Reduce the memory of the attention
+        """forward computed in chunks of |chunk_size| queries, so the attention holds chunk_size x HW
+        similarities instead of HW x HW. Every position is still a query and the output matches
+        forward up to float rounding; the compute does not shrink with the scratch area, only the
+        masked-out keys are skipped when they carry no weight."""
+        if self.mode != "combine":
+            return self.attention(x, mask)
+
+        batch_size, _, h, w = x.shape
+
+        valid = self.valid_mask(mask, (h, w))
+        has_hole = (valid < 1).flatten(1).any(dim=1)
+        if not has_hole.any():
+            return x
+
+        g_x = self.g(x).view(batch_size, self.inter_channels, -1)
+        theta_x = self.theta(x).view(batch_size, self.inter_channels, -1)
+        phi_x = self.phi(x).view(batch_size, self.inter_channels, -1)
+
+        if self.cosin:
+            theta_x = F.normalize(theta_x, dim=1)
+            phi_x = F.normalize(phi_x, dim=1)
+
+        ## W and the instance normalized res_block mix the attention output of every position into
+        ## the holes, so every position stays a query, like in forward; the queries run in chunks
+        ## of chunk_size rows instead of materializing the HW x HW similarities
+        y = torch.zeros_like(g_x)
+        positions = torch.arange(h * w, device=x.device)
+        for b in range(batch_size):
+            if not has_hole[b]:
+                continue
+            valid_b = valid[b].view(-1)
+            if self.renorm and not self.use_self:
+                ## After renormalization the masked-out keys carry no weight
+                key_index = torch.nonzero(valid_b > 0, as_tuple=True)[0]
+            else:
+                key_index = positions
+            if len(key_index) == 0:
+                continue
+
+            key = phi_x[b][:, key_index]
+            value = g_x[b][:, key_index].t()
+            key_mask = valid_b[key_index].unsqueeze(0)
+
+            for start in range(0, h * w, chunk_size):
+                chunk_index = positions[start : start + chunk_size]
+                with torch.autocast(x.device.type, enabled=False):
+                    f = torch.matmul(theta_x[b][:, chunk_index].t().float(), key.float())
+                    f /= self.temperature
+                    f_div_C = F.softmax(f, dim=1).to(value.dtype)
+                if self.use_self:
+                    mask_expand = key_mask.repeat(len(chunk_index), 1)
+                    mask_expand[key_index.unsqueeze(0) == chunk_index.unsqueeze(1)] = 1.0
+                    f_div_C = mask_expand * f_div_C
+                else:
+                    f_div_C = key_mask * f_div_C
+                if self.renorm:
+                    f_div_C = F.normalize(f_div_C, p=1, dim=1)
+                y[b, :, chunk_index] = torch.matmul(f_div_C, value).t()
+                del f, f_div_C
+
+        y = y.view(batch_size, self.inter_channels, h, w)
+        W_y = self.W(y)
+        del y
+
+        W_y = self.res_block(W_y)
+
+        full_mask = valid.repeat(1, self.inter_channels, 1, 1)
+        z = full_mask * x + (1 - full_mask) * W_y
+        return x.where(has_hole.view(-1, 1, 1, 1).logical_not(), z)
+
 
 class MultiscaleDiscriminator(nn.Module):
     def __init__(self, input_nc, opt, ndf=64, n_layers=3, norm_layer=nn.BatchNorm2d,
@@ -863,7 +965,7 @@ class VGG19_torch(torch.nn.Module):
 class VGGLoss_torch(nn.Module):
     def __init__(self, gpu_ids):
         super(VGGLoss_torch, self).__init__()
-        self.vgg = VGG19_torch().cuda()
+        self.vgg = VGG19_torch().cuda() if gpu_ids else VGG19_torch()
         self.criterion = nn.L1Loss()
         self.weights = [1.0/32, 1.0/16, 1.0/8, 1.0/4, 1.0]
 
@@ -0,0 +1,52 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+
+import torch
+
+try:
+    from ...bopbtl_utils import onnx_util
+except ImportError:
+    from bopbtl_utils import onnx_util
+
+from .compiled_model import EncoderStage, MappingStage, DecoderStage
+from .NonLocal_feature_mapping_model import Mapping_Model_with_mask_2
+
+STAGE_FILES = {"encode": "encoder.onnx", "mapping": "mapping.onnx", "decode": "decoder.onnx"}
+
+
+def export_onnx(model, directory, label, inst):
+    """Exports the encoder, mapping and decoder of a Pix2PixHDModel_Mapping to |directory|,
+    traced on an example |label| and |inst| on the CPU."""
+    if isinstance(model.mapping_net, Mapping_Model_with_mask_2):
+        ## the patch attention picks its patches from the mask content, a trace would freeze them
+        raise ValueError("The patch attention mapping network cannot be exported to ONNX!")
+    with torch.no_grad():
+        label_feat = model.netG_A(label, flow="enc")
+    onnx_util.export(EncoderStage(model.netG_A).eval(), {"image": label}, os.path.join(directory, STAGE_FILES["encode"]))
+    inputs = {"feature": label_feat}
+    if model.opt.NL_use_mask:
+        inputs["mask"] = inst
+    onnx_util.export(MappingStage(model.mapping_net).eval(), inputs, os.path.join(directory, STAGE_FILES["mapping"]))
+    onnx_util.export(DecoderStage(model.netG_B).eval(), {"feature": label_feat}, os.path.join(directory, STAGE_FILES["decode"]))
+    return directory
+
+
+class OnnxInference:
+    """Runs the networks written by export_onnx with onnxruntime on the CPU, in place of a
+    Pix2PixHDModel_Mapping; takes and returns CPU tensors like its inference."""
+
+    def __init__(self, directory, num_threads=0, num_interop_threads=0):
+        self.sessions = {
+            name: onnx_util.create_session(os.path.join(directory, filename), num_threads, num_interop_threads)
+            for name, filename in STAGE_FILES.items()
+        }
+
+    def inference(self, label, inst):
+        label_feat = onnx_util.run(self.sessions["encode"], {"image": label})
+        label_feat_map = onnx_util.run(self.sessions["mapping"], {"feature": label_feat, "mask": inst})
+        return torch.from_numpy(onnx_util.run(self.sessions["decode"], {"feature": label_feat_map}))
+
+    def inference_batch(self, labels, insts):
+        return [self.inference(label, inst) for label, inst in zip(labels, insts)]
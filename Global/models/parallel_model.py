@@ -0,0 +1,153 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import contextlib
+import copy
+import queue
+import threading
+
+import torch
+
+
+def get_device(device_id):
+    if isinstance(device_id, torch.device):
+        return device_id
+    if isinstance(device_id, int):
+        return torch.device("cpu") if device_id < 0 else torch.device("cuda", device_id)
+    return torch.device(device_id)
+
+
+class DataParallelInference:
+    """Replicates netG_A, mapping_net and netG_B of a Pix2PixHDModel_Mapping on several
+    devices and shards frames among the replicas through a shared work queue.
+    Outputs are returned in the order of the inputs."""
+
+    def __init__(self, model, devices):
+        if len(devices) == 0:
+            raise ValueError("At least one device is required!")
+        self.opt = model.opt
+        self.devices = [get_device(device) for device in devices]
+        self.replicas = []
+        for device in self.devices:
+            replica = copy.deepcopy(model)
+            replica.to(device)
+            replica.eval()
+            self.replicas.append(replica)
+
+    def inference(self, label, inst):
+        return self.inference_batch([label], [inst])[0]
+
+    def inference_batch(self, labels, insts):
+        jobs = queue.Queue()
+        for i, (label, inst) in enumerate(zip(labels, insts)):
+            jobs.put((i, label, inst))
+        results = [None] * jobs.qsize()
+        errors = []
+
+        def work(replica, device):
+            ## grad mode is thread local
+            with torch.inference_mode(), device_context(device):
+                while not errors:
+                    try:
+                        i, label, inst = jobs.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        results[i] = replica.inference(label, inst).cpu()
+                    except Exception as e:
+                        errors.append(e)
+
+        workers = [
+            threading.Thread(target=work, args=(replica, device), daemon=True)
+            for replica, device in zip(self.replicas, self.devices)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+def device_context(device):
+    if device.type == "cuda":
+        return torch.cuda.device(device)
+    return contextlib.nullcontext()
+
+
+class PipelineParallelInference:
+    """Places the encoder, mapping and decoder stages of a Pix2PixHDModel_Mapping on
+    three devices and streams frames through them, so that a stage works on frame k
+    while the next stage works on frame k-1. Each device only holds the weights and
+    activations of its own stage."""
+
+    def __init__(self, model, devices, queue_size=2):
+        if len(devices) != 3:
+            raise ValueError("Pipeline parallel inference needs exactly three devices!")
+        self.opt = model.opt
+        self.devices = [get_device(device) for device in devices]
+        self.queue_size = queue_size
+        self.model = model
+        self.model.set_stage_devices(*self.devices)
+        self.model.eval()
+
+    def inference(self, label, inst):
+        return self.inference_batch([label], [inst])[0]
+
+    def inference_batch(self, labels, insts):
+        model = self.model
+        stages = [
+            lambda label, inst: model.inference_encode(label),
+            lambda label_feat, inst: model.inference_mapping(label_feat, inst),
+            lambda label_feat_map, inst: model.inference_decode(label_feat_map).cpu(),
+        ]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+        results = [None] * len(labels)
+        errors = []
+
+        def work(stage, device, inputs, outputs):
+            ## grad mode is thread local
+            with torch.inference_mode(), device_context(device):
+                while True:
+                    job = inputs.get()
+                    if job is None:
+                        outputs.put(None)
+                        return
+                    i, x, inst = job
+                    if not errors:
+                        try:
+                            x = stage(x, inst)
+                        except Exception as e:
+                            errors.append(e)
+                    if not errors:
+                        outputs.put((i, x, inst))
+
+        workers = [
+            threading.Thread(target=work, args=(stage, device, queues[k], queues[k + 1]), daemon=True)
+            for k, (stage, device) in enumerate(zip(stages, self.devices))
+        ]
+        for worker in workers:
+            worker.start()
+
+        def feed():
+            for i, (label, inst) in enumerate(zip(labels, insts)):
+                if errors:
+                    break
+                queues[0].put((i, label, inst))
+            queues[0].put(None)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        while True:
+            job = queues[-1].get()
+            if job is None:
+                break
+            i, fake_image, _ = job
+            results[i] = fake_image
+        feeder.join()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        return results
@@ -68,8 +68,10 @@ class Pix2PixHDModel(BaseModel):
         # set loss functions and optimizers
         if self.isTrain:
             if opt.pool_size > 0 and (len(self.gpu_ids)) > 1:   ## The pool_size is 0!
-                raise NotImplementedError("Fake Pool Not Implemented for MultiGPU")
+                raise NotImplementedError("Fake Pool Not Implemented for DataParallel, start the training with torchrun for a pool on every GPU")
             self.fake_pool = ImagePool(opt.pool_size)
+            if opt.continue_train and opt.pool_size > 0:
+                self.load_pool(opt.which_epoch)
             self.old_lr = opt.lr
 
             # define loss functions
@@ -111,7 +113,7 @@ class Pix2PixHDModel(BaseModel):
 
     def encode_input(self, label_map, inst_map=None, real_image=None, feat_map=None, infer=False):             
         if self.opt.label_nc == 0:
-            input_label = label_map.data.cuda()
+            input_label = self.to_input_device(label_map.data)
         else:
             # create one-hot vector for label map 
             size = label_map.size()
@@ -123,14 +125,14 @@ class Pix2PixHDModel(BaseModel):
 
         # get edges from instance map
         if not self.opt.no_instance:
-            inst_map = inst_map.data.cuda()
+            inst_map = self.to_input_device(inst_map.data)
             edge_map = self.get_edges(inst_map)
             input_label = torch.cat((input_label, edge_map), dim=1)         
         input_label = Variable(input_label, volatile=infer)
 
         # real images for training
         if real_image is not None:
-            real_image = Variable(real_image.data.cuda())
+            real_image = Variable(self.to_input_device(real_image.data))
 
         # instance map for feature encoding
         if self.use_features:
@@ -165,7 +167,7 @@ class Pix2PixHDModel(BaseModel):
         else:
             input_concat = input_label
         hiddens = self.netG.forward(input_concat, 'enc')
-        noise = Variable(torch.randn(hiddens.size()).cuda(hiddens.data.get_device()))
+        noise = Variable(torch.randn(hiddens.size()).to(hiddens.device))
         # This is a reduced VAE implementation where we assume the outputs are multivariate Gaussian distribution with mean = hiddens and std_dev = all ones.
         # We follow the the VAE of MUNIT (https://github.com/NVlabs/MUNIT/blob/master/networks.py)
         fake_image = self.netG.forward(hiddens + noise, 'dec')
@@ -7,8 +7,10 @@ import torch
 
 try:
     from ..util import util
+    from ..util.distributed import init_distributed, is_main
 except ImportError:
     import util.util as util
+    from util.distributed import init_distributed, is_main
 
 
 class BaseOptions:
@@ -113,6 +115,8 @@ class BaseOptions:
         self.parser.add_argument("--mask_dilation", type=int, default=0)  ## Don't change the input, only dilation the mask
 
         self.parser.add_argument("--irregular_mask", type=str, default="", help="This is the root of the mask")
+        self.parser.add_argument("--mask_bank", type=str, default="", help="bit-packed bank of the irregular masks, rasterized from --irregular_mask if it does not exist")
+        self.parser.add_argument("--mask_bank_size", type=int, default=0, help="mask size in the bank, loadSize without it; larger banks are randomly cropped while training")
         self.parser.add_argument("--mapping_net_dilation", type=int, default=1, help="This parameter is the dilation size of the translation net")
 
         self.parser.add_argument("--VOC", type=str, default="VOC_RGB_JPEGImages.bigfile", help="The root of VOC dataset")
@@ -153,6 +157,8 @@ class BaseOptions:
         self.parser.add_argument("--hole_image_no_mask", action="store_true", help="while testing, give hole image but not give the mask")
 
         self.parser.add_argument("--down_sample_degradation", action="store_true", help="down_sample the image only, corresponds to [down_sample_face]")
+        self.parser.add_argument("--degradation_engine", type=str, default="legacy", help="legacy|torch, the torch engine draws every image's degradation from its own seed")
+        self.parser.add_argument("--gpu_degradation", action="store_true", help="data workers only decode and crop, the training loop degrades the batches with the torch engine on the GPU")
 
         self.parser.add_argument("--norm_G", type=str, default="spectralinstance", help="The norm type of Generator")
         self.parser.add_argument("--init_G", type=str, default="xavier", help="normal|xavier|xavier_uniform|kaiming|orthogonal|none")
@@ -167,7 +173,7 @@ class BaseOptions:
         self.parser.add_argument("--downsample_mode", type=str, default="nearest", help="For partial non-local, choose how to downsample the mask")
 
         self.parser.add_argument("--mapping_exp",type=int,default=0,help='Default 0: original PNL|1: Multi-Scale Patch Attention')
-        self.parser.add_argument("--inference_optimize",action='store_true',help='optimize the memory cost')
+        self.parser.add_argument("--inference_optimize",action='store_true',help='optimize the memory cost: the NonLocal attention of the mapping runs in chunks of queries, matching the full attention; the patch attention of --HR only attends from the masked patches')
 
 
         self.initialized = True
@@ -190,6 +196,10 @@ class BaseOptions:
             # pass
             torch.cuda.set_device(self.opt.gpu_ids[0])
 
+        ## a training process started by torchrun joins its process group and takes one of the GPUs
+        if self.isTrain:
+            init_distributed(self.opt)
+
         args = vars(self.opt)
 
         # print('------------ Options -------------')
@@ -200,7 +210,7 @@ class BaseOptions:
         # save to the disk
         expr_dir = os.path.join(self.opt.checkpoints_dir, self.opt.name)
         util.mkdirs(expr_dir)
-        if save and not self.opt.continue_train:
+        if save and not self.opt.continue_train and is_main(self.opt):
             file_name = os.path.join(expr_dir, "opt.txt")
             with open(file_name, "wt") as opt_file:
                 opt_file.write("------------ Options -------------\n")
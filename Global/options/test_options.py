@@ -53,3 +53,19 @@ class TestOptions(BaseOptions):
         self.parser.add_argument("--Quality_restore", action="store_true", help="For RGB images")
         self.parser.add_argument("--Scratch_and_Quality_restore", action="store_true", help="For scratched images")
         self.parser.add_argument("--HR", action='store_true',help='Large input size with scratches')
+        self.parser.add_argument("--stage_gpu_ids", type=str, default="", help="Devices of the encoder, mapping and decoder stages, e.g. 0,1,2; streams the images through the stages in a pipeline")
+        self.parser.add_argument("--cpu_threads", type=int, default=0, help="intra-op threads of CPU inference, 0 uses the torch default")
+        self.parser.add_argument("--cpu_interop_threads", type=int, default=0, help="inter-op threads of CPU inference, 0 uses the torch default")
+        self.parser.add_argument("--channels_last", action="store_true", help="use the channels_last memory format on CPU; slower than NCHW for the instance normalized restoration networks on most CPUs")
+        self.parser.add_argument("--quantize", type=str, default="none", choices=["none", "int8"], help="int8: post-training static quantization of the mapping network, CPU only")
+        self.parser.add_argument("--quantize_calibration", type=str, default="", help="directory of old photos to calibrate the int8 mapping network on; defaults to the test inputs")
+        self.parser.add_argument("--quantize_samples", type=int, default=8, help="number of photos the int8 mapping network is calibrated on")
+        self.parser.add_argument("--compile", type=str, default="none", choices=["none", "trace", "inductor"], help="trace: TorchScript modules traced once per input size, inductor: torch.compile")
+        self.parser.add_argument("--compile_cache", type=str, default="", help="directory the compiled networks are cached in; defaults to <checkpoints_dir>/compiled")
+        self.parser.add_argument("--onnx_dir", type=str, default="", help="directory with the encoder.onnx, mapping.onnx and decoder.onnx written by export_onnx.py; runs them with onnxruntime on CPU instead of the checkpoints")
+        self.parser.add_argument("--prefetch_threads", type=int, default=2, help="threads decoding and transforming the next images while the current one is restored")
+        self.parser.add_argument("--write_threads", type=int, default=2, help="threads encoding and writing the outputs in the background")
+        self.parser.add_argument("--max_inflight", type=int, default=4, help="most images decoded ahead, and most outputs waiting to be written")
+        self.parser.add_argument("--output_format", type=str, default="png", choices=["png", "jpg"], help="file format of the outputs")
+        self.parser.add_argument("--jpeg_quality", type=int, default=95, help="quality of jpg outputs")
+        self.parser.add_argument("--no_debug_outputs", action="store_true", help="only write restored_image, without the input_image and origin directories")
@@ -55,6 +55,11 @@ class TrainOptions(BaseOptions):
         self.parser.add_argument('--positive_weight',type=float,default=1.0,help='(For scratch detection) Since the scratch number is less, and we use a weight strategy. This parameter means that we want to decrease the weight.')
 
         self.parser.add_argument('--no_update_lr',action='store_true',help='use this means we do not update the LR while training')
+        self.parser.add_argument('--amp',action='store_true',help='train the mapping with automatic mixed precision and a gradient scaler')
+        self.parser.add_argument('--accumulation_steps',type=int,default=1,help='batches whose gradients are accumulated before every optimizer step')
+        self.parser.add_argument('--max_pending_writes',type=int,default=4,help='checkpoints, images and logs waiting for the background writer before training blocks; 0 writes them in the training loop')
+        self.parser.add_argument('--dist_backend',type=str,default='',help='process group backend of a run started by torchrun, nccl with GPUs and gloo without by default')
+        self.parser.add_argument('--find_unused_parameters',action='store_true',help='let DistributedDataParallel skip parameters that get no gradient in an iteration')
 
 
         self.isTrain = True
@@ -2,20 +2,35 @@
 # Licensed under the MIT License.
 
 import os
-import gc
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from torch.autograd import Variable
 
 try:
     from .options.test_options import TestOptions
     from .models.models import create_model
     from .models.mapping_model import Pix2PixHDModel_Mapping
+    from .models.parallel_model import DataParallelInference, PipelineParallelInference
+    from .models.compiled_model import CompiledInference
+    from .models.onnx_model import OnnxInference
     from . import util
+    from .util.background_writer import BackgroundWriter
 except ImportError:
     from options.test_options import TestOptions
     from models.models import create_model
     from models.mapping_model import Pix2PixHDModel_Mapping
+    from models.parallel_model import DataParallelInference, PipelineParallelInference
+    from models.compiled_model import CompiledInference
+    from models.onnx_model import OnnxInference
     from util import util
+    from util.background_writer import BackgroundWriter
+
+try:
+    from ..bopbtl_utils.cpu_threads import set_cpu_threads
+    from ..bopbtl_utils.prefetch import map_ordered
+except ImportError:
+    from bopbtl_utils.cpu_threads import set_cpu_threads
+    from bopbtl_utils.prefetch import map_ordered
 
 from PIL import Image
 import torch
@@ -106,12 +121,36 @@ def parameter_set(opt):
 
 
 def load_model(opt):
+    if opt.onnx_dir != "":
+        if opt.gpu_ids or opt.stage_gpu_ids or opt.quantize != "none" or opt.compile != "none":
+            raise ValueError("--onnx_dir only runs on CPU, without --quantize or --compile; use --gpu_ids -1")
+        return OnnxInference(opt.onnx_dir, opt.cpu_threads, opt.cpu_interop_threads)
+    if opt.quantize == "int8" and (opt.gpu_ids or opt.stage_gpu_ids):
+        raise ValueError("int8 inference is only supported on CPU; use --gpu_ids -1")
+    if opt.compile != "none" and (opt.quantize != "none" or opt.stage_gpu_ids or len(opt.gpu_ids) > 1):
+        raise ValueError("--compile only supports a single device without --quantize")
+    if not opt.gpu_ids:
+        set_cpu_threads(opt.cpu_threads, opt.cpu_interop_threads)
     model = Pix2PixHDModel_Mapping()
     model.initialize(opt)
     model.eval()
+    if not opt.gpu_ids and opt.channels_last:
+        model.to(memory_format=torch.channels_last)
+    if getattr(opt, "stage_gpu_ids", ""):
+        model = PipelineParallelInference(model, [int(n) for n in opt.stage_gpu_ids.split(",")])
+    elif len(opt.gpu_ids) > 1:
+        model = DataParallelInference(model, opt.gpu_ids)
+    elif opt.compile != "none":
+        model = CompiledInference(model, opt.compile, opt.compile_cache or os.path.join(opt.checkpoints_dir, "compiled"))
     return model
 
 
+def inference_batch(model, inputs, masks):
+    if isinstance(model, (DataParallelInference, PipelineParallelInference, CompiledInference, OnnxInference)):
+        return model.inference_batch(inputs, masks)
+    return [model.inference(input, mask) for input, mask in zip(inputs, masks)]
+
+
 def get_transforms():
     img_transform = transforms.Compose([
         transforms.ToTensor(), 
@@ -150,6 +189,58 @@ def transform_image_and_mask(input, img_transform, mask, mask_transform, mask_di
     return (input, mask, origin)
 
 
+def load_calibration_samples(opt, img_transform, mask_transform):
+    ## A few photos of --quantize_calibration, or else the first test inputs, to calibrate the int8 model on
+    image_dir = opt.quantize_calibration or opt.test_input
+    mask_dir = opt.test_mask if opt.quantize_calibration == "" and opt.NL_use_mask else ""
+    image_names = sorted(os.listdir(image_dir))
+    mask_names = sorted(os.listdir(mask_dir)) if mask_dir != "" else []
+
+    inputs = []
+    masks = []
+    for i, image_name in enumerate(image_names):
+        if len(inputs) >= opt.quantize_samples:
+            break
+        image_file = os.path.join(image_dir, image_name)
+        if not os.path.isfile(image_file):
+            continue
+        image = Image.open(image_file).convert("RGB")
+        if not opt.NL_use_mask:
+            input, mask, _ = transform_image(image, img_transform, opt.test_mode)
+        else:
+            if mask_dir != "":
+                mask = Image.open(os.path.join(mask_dir, mask_names[i])).convert("RGB")
+            else:
+                mask = Image.new("RGB", image.size)
+            input, mask, _ = transform_image_and_mask(image, img_transform, mask, mask_transform, opt.mask_dilation)
+        inputs.append(input)
+        masks.append(mask)
+    return inputs, masks
+
+
+def load_input(opt, input_name, mask_name, img_transform, mask_transform):
+    input_file = os.path.join(opt.test_input, input_name)
+    if not os.path.isfile(input_file):
+        return None
+    input = Image.open(input_file).convert("RGB")
+    if not opt.NL_use_mask:
+        return transform_image(input, img_transform, opt.test_mode)
+    mask = Image.open(os.path.join(opt.test_mask, mask_name)).convert("RGB")
+    return transform_image_and_mask(input, img_transform, mask, mask_transform, opt.mask_dilation)
+
+
+def tensor_image(image):
+    ## the PIL image vutils.save_image(normalize=True, padding=0) writes for a single image
+    grid = vutils.make_grid(image, nrow=1, padding=0, normalize=True)
+    array = grid.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to("cpu", torch.uint8).numpy()
+    return Image.fromarray(array)
+
+
+def save_tensor_image(image, path, quality=95):
+    ## with the jpeg quality
+    tensor_image(image).save(path, quality=quality)
+
+
 def main(opt):
     parameter_set(opt)
 
@@ -158,24 +249,19 @@ def main(opt):
     output_restored_dir = opt.outputs_dir + os.path.sep + "restored_image"
     output_origin_dir = opt.outputs_dir + os.path.sep + "origin"
 
-    if not os.path.exists(output_input_dir):
-        os.makedirs(output_input_dir)
-    if not os.path.exists(output_restored_dir):
-        os.makedirs(output_restored_dir)
-    if not os.path.exists(output_origin_dir):
-        os.makedirs(output_origin_dir)
+    output_dirs = [output_restored_dir]
+    if not opt.no_debug_outputs:
+        output_dirs += [output_input_dir, output_origin_dir]
+    for output_dir in output_dirs:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
 
     # images
-    dataset_size = 0
-
-    input_loader = os.listdir(opt.test_input)
-    dataset_size = len(input_loader)
-    input_loader.sort()
-
+    input_loader = sorted(os.listdir(opt.test_input))
+    mask_loader = [None] * len(input_loader)
     if opt.test_mask != "":
-        mask_loader = os.listdir(opt.test_mask)
-        dataset_size = len(os.listdir(opt.test_mask))
-        mask_loader.sort()
+        mask_loader = sorted(os.listdir(opt.test_mask))
+        input_loader = input_loader[: len(mask_loader)]
 
     # load model
     model = load_model(opt)
@@ -183,57 +269,47 @@ def main(opt):
     # image transforms
     img_transform, mask_transform = get_transforms()
 
-    for i in range(dataset_size):
-        # load image
-        input_name = input_loader[i]
-        input_file = os.path.join(opt.test_input, input_name)
-        if not os.path.isfile(input_file):
-            print("Skipping non-file %s" % input_name)
-            continue
-        input = Image.open(input_file).convert("RGB")
-
-        # load mask
-        mask = None
-        if opt.NL_use_mask:
-            mask_name = mask_loader[i]
-            mask = Image.open(os.path.join(opt.test_mask, mask_name)).convert("RGB")
-
-        print("Now you are processing %s" % (input_name))
-
-        # transform image
-        if mask is None:
-            input, mask, origin = transform_image(input, img_transform, opt.test_mode)
-        else:
-            input, mask, origin = transform_image_and_mask(input, img_transform, mask, mask_transform, opt.mask_dilation)
-
-        # restore image
-        with torch.no_grad():
-            generated = model.inference(input, mask)
-
-        # save image
-        if input_name.endswith(".jpg"):
-            input_name = input_name[:-4] + ".png"
-
-        image_grid = vutils.save_image(
-            (input + 1.0) / 2.0,
-            output_input_dir + os.path.sep + input_name,
-            nrow=1,
-            padding=0,
-            normalize=True,
-        )
-        image_grid = vutils.save_image(
-            (generated.data.cpu() + 1.0) / 2.0,
-            output_restored_dir + os.path.sep + input_name,
-            nrow=1,
-            padding=0,
-            normalize=True,
-        )
-        origin.save(output_origin_dir + os.path.sep + input_name)
-
-        # clean up
-        gc.collect()
-        torch.cuda.empty_cache()
-
+    if opt.quantize == "int8":
+        model.quantize(*load_calibration_samples(opt, img_transform, mask_transform))
+
+    ## decoding the next images, restoring the current one and writing the previous ones overlap
+    def load(names):
+        input_name, mask_name = names
+        return input_name, load_input(opt, input_name, mask_name, img_transform, mask_transform)
+
+    writer = BackgroundWriter(opt.write_threads, opt.max_inflight)
+    try:
+        with ThreadPoolExecutor(max(opt.prefetch_threads, 1)) as executor:
+            for input_name, loaded in map_ordered(executor, load, zip(input_loader, mask_loader), opt.max_inflight):
+                if loaded is None:
+                    print("Skipping non-file %s" % input_name)
+                    continue
+                input, mask, origin = loaded
+
+                print("Now you are processing %s" % (input_name))
+
+                # restore image
+                with torch.inference_mode():
+                    generated = model.inference(input, mask).cpu()
+
+                # save image
+                output_name = os.path.splitext(input_name)[0] + "." + opt.output_format
+                writer.submit(
+                    save_tensor_image,
+                    (generated + 1.0) / 2.0,
+                    output_restored_dir + os.path.sep + output_name,
+                    opt.jpeg_quality,
+                )
+                if not opt.no_debug_outputs:
+                    writer.submit(
+                        save_tensor_image,
+                        (input + 1.0) / 2.0,
+                        output_input_dir + os.path.sep + output_name,
+                        opt.jpeg_quality,
+                    )
+                    writer.submit(origin.save, output_origin_dir + os.path.sep + output_name, quality=opt.jpeg_quality)
+    finally:
+        writer.close()
 
 
 if __name__ == "__main__":
@@ -6,9 +6,12 @@ from collections import OrderedDict
 from options.train_options import TrainOptions
 from data.data_loader import CreateDataLoader
 from models.models import create_model
+from data.degradation import degrade_training_batch
 import util.util as util
 from util.visualizer import Visualizer
 import os
+from util.background_writer import create_training_writer, submit_write, atomic_savetxt
+from util.distributed import is_main, optimized_parameters, cleanup_distributed
 import numpy as np
 import torch
 import torchvision.utils as vutils
@@ -17,6 +20,8 @@ import random
 
 
 opt = TrainOptions().parse()
+## only rank 0 of a distributed run logs, displays and saves
+main_process = is_main(opt)
 
 if opt.debug:
     opt.display_freq = 1
@@ -31,7 +36,9 @@ dataset_size = len(dataset) * opt.batchSize
 print('#training images = %d' % dataset_size)
 
 path = os.path.join(opt.checkpoints_dir, opt.name, 'model.txt')
-visualizer = Visualizer(opt)
+## checkpoints, images and logs are written on a background thread
+writer = create_training_writer(opt)
+visualizer = Visualizer(opt, writer) if main_process else None
 
 
 iter_path = os.path.join(opt.checkpoints_dir, opt.name, 'iter.txt')
@@ -40,16 +47,21 @@ if opt.continue_train:
         start_epoch, epoch_iter = np.loadtxt(iter_path , delimiter=',', dtype=int)
     except:
         start_epoch, epoch_iter = 1, 0
-    visualizer.print_save('Resuming from epoch %d at iteration %d' % (start_epoch-1, epoch_iter))
+    if main_process:
+        visualizer.print_save('Resuming from epoch %d at iteration %d' % (start_epoch-1, epoch_iter))
 else:
     start_epoch, epoch_iter = 1, 0
 
 # opt.which_epoch=start_epoch-1
 model = create_model(opt)
-fd = open(path, 'w')
-fd.write(str(model.module.netG))
-fd.write(str(model.module.netD))
-fd.close()
+model.module.checkpoint_writer = writer
+if main_process:
+    fd = open(path, 'w')
+    fd.write(str(model.module.netG))
+    fd.write(str(model.module.netD))
+    fd.close()
+
+degradation_device = torch.device("cuda", opt.gpu_ids[0]) if opt.gpu_ids else torch.device("cpu")
 
 total_steps = (start_epoch-1) * dataset_size + epoch_iter
 
@@ -59,6 +71,7 @@ save_delta = total_steps % opt.save_latest_freq
 
 for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
     epoch_start_time = time.time()
+    data_loader.set_epoch(epoch)
     if epoch != start_epoch:
         epoch_iter = epoch_iter % dataset_size
     for i, data in enumerate(dataset, start=epoch_iter):
@@ -66,6 +79,9 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
         total_steps += opt.batchSize
         epoch_iter += opt.batchSize
 
+        if opt.gpu_degradation:
+            data = degrade_training_batch(data, degradation_device, paired=False)
+
         # whether to collect output images
         save_fake = total_steps % opt.display_freq == display_delta
 
@@ -85,40 +101,36 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
 
         ############### Backward Pass ####################
         # update generator weights
+        ## every loss only reaches the network it trains, which DistributedDataParallel needs to
+        ## average each gradient once
         model.module.optimizer_G.zero_grad()
-        loss_G.backward()
+        loss_G.backward(inputs=optimized_parameters(model.module.optimizer_G))
         model.module.optimizer_G.step()
 
         # update discriminator weights
         model.module.optimizer_D.zero_grad()
-        loss_D.backward()
+        loss_D.backward(inputs=optimized_parameters(model.module.optimizer_D))
         model.module.optimizer_D.step()
 
         #call(["nvidia-smi", "--format=csv", "--query-gpu=memory.used,memory.free"]) 
 
         ############## Display results and errors ##########
         ### print out errors
-        if total_steps % opt.print_freq == print_delta:
+        if main_process and total_steps % opt.print_freq == print_delta:
             errors = {k: v.data if not isinstance(v, int) else v for k, v in loss_dict.items()}
             t = (time.time() - iter_start_time) / opt.batchSize
             visualizer.print_current_errors(epoch, epoch_iter, errors, t, model.module.old_lr)
             visualizer.plot_current_errors(errors, total_steps)
 
         ### display output images
-        if save_fake:
+        if save_fake and main_process:
 
             if not os.path.exists(opt.outputs_dir + opt.name):
                 os.makedirs(opt.outputs_dir + opt.name)
             imgs_num = 5
-            imgs = torch.cat((data['label'][:imgs_num], generated.data.cpu()[:imgs_num], data['image'][:imgs_num]), 0)
-
-            imgs = (imgs + 1.) / 2.0
+            imgs = [data['label'][:imgs_num], generated.data[:imgs_num], data['image'][:imgs_num]]
 
-            try:
-                image_grid = vutils.save_image(imgs, opt.outputs_dir + opt.name + '/' + str(epoch) + '_' + str(total_steps) + '.png',
-                        nrow=imgs_num, padding=0, normalize=True)
-            except OSError as err:
-                print(err)
+            visualizer.save_image_grid(imgs, opt.outputs_dir + opt.name + '/' + str(epoch) + '_' + str(total_steps) + '.png', imgs_num)
 
         if epoch_iter >= dataset_size:
             break
@@ -130,10 +142,14 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
 
     ### save model for this epoch
     if epoch % opt.save_epoch_freq == 0:
-        print('saving the model at the end of epoch %d, iters %d' % (epoch, total_steps))        
-        model.module.save('latest')
-        model.module.save(epoch)
-        np.savetxt(iter_path, (epoch+1, 0), delimiter=',', fmt='%d')
+        if main_process:
+            print('saving the model at the end of epoch %d, iters %d' % (epoch, total_steps))        
+            model.module.save('latest')
+            model.module.save(epoch)
+            submit_write(writer, atomic_savetxt, iter_path, (epoch+1, 0), delimiter=',', fmt='%d')
+        ## every rank saves its own pool of generated images
+        model.module.save_pool('latest')
+        model.module.save_pool(epoch)
 
     ### instead of only training the local enhancer, train the entire network after certain iterations
     if (opt.niter_fix_global != 0) and (epoch == opt.niter_fix_global):
@@ -143,3 +159,6 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
     if epoch > opt.niter:
         model.module.update_learning_rate()
 
+if writer is not None:
+    writer.close()
+cleanup_distributed(opt)
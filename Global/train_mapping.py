@@ -2,37 +2,46 @@
 # Licensed under the MIT License.
 
 import time
+import contextlib
 from collections import OrderedDict
 from options.train_options import TrainOptions
 from data.data_loader import CreateDataLoader
 from models.mapping_model import Pix2PixHDModel_Mapping
+from data.degradation import degrade_training_batch
 import util.util as util
 from util.visualizer import Visualizer
 import os
+from util.background_writer import create_training_writer, submit_write, atomic_savetxt
+from util.distributed import parallelize, is_main, optimized_parameters, cleanup_distributed
 import numpy as np
 import torch
 import torchvision.utils as vutils
-from torch.autograd import Variable
 import datetime
 import random
 
 
 
 opt = TrainOptions().parse()
-visualizer = Visualizer(opt)
+## only rank 0 of a distributed run logs, displays and saves
+main_process = is_main(opt)
+## checkpoints, images and logs are written on a background thread
+writer = create_training_writer(opt)
+visualizer = Visualizer(opt, writer) if main_process else None
 iter_path = os.path.join(opt.checkpoints_dir, opt.name, 'iter.txt')
 if opt.continue_train:
     try:
         start_epoch, epoch_iter = np.loadtxt(iter_path , delimiter=',', dtype=int)
     except:
         start_epoch, epoch_iter = 1, 0
-    visualizer.print_save('Resuming from epoch %d at iteration %d' % (start_epoch-1, epoch_iter))
+    if main_process:
+        visualizer.print_save('Resuming from epoch %d at iteration %d' % (start_epoch-1, epoch_iter))
 else:
     start_epoch, epoch_iter = 1, 0
 
 if opt.which_epoch != "latest":
     start_epoch=int(opt.which_epoch)
-    visualizer.print_save('Notice : Resuming from epoch %d at iteration %d' % (start_epoch - 1, epoch_iter))
+    if main_process:
+        visualizer.print_save('Notice : Resuming from epoch %d at iteration %d' % (start_epoch - 1, epoch_iter))
 
 opt.start_epoch=start_epoch
 ### temp for continue train unfixed decoder
@@ -46,24 +55,36 @@ print('#training images = %d' % dataset_size)
 model = Pix2PixHDModel_Mapping()
 model.initialize(opt)
 
-path = os.path.join(opt.checkpoints_dir, opt.name, 'model.txt')
-fd = open(path, 'w')
+if main_process:
+    path = os.path.join(opt.checkpoints_dir, opt.name, 'model.txt')
+    fd = open(path, 'w')
 
-if opt.use_skip_model:
-    fd.write(str(model.mapping_net))
-    fd.close()
-else:
-    fd.write(str(model.netG_A))
-    fd.write(str(model.mapping_net))
-    fd.close()
+    if opt.use_skip_model:
+        fd.write(str(model.mapping_net))
+        fd.close()
+    else:
+        fd.write(str(model.netG_A))
+        fd.write(str(model.mapping_net))
+        fd.close()
+
+if opt.isTrain:
+    model = parallelize(model, opt)
+model.module.checkpoint_writer = writer
 
-if opt.isTrain and len(opt.gpu_ids) > 1:
-    model = torch.nn.DataParallel(model, device_ids=opt.gpu_ids)
 
 
+degradation_device = torch.device("cuda", opt.gpu_ids[0]) if opt.gpu_ids else torch.device("cpu")
 
 total_steps = (start_epoch-1) * dataset_size + epoch_iter
 
+## one scaler for both optimizers; without --amp it leaves the losses and the steps unchanged
+scaler = torch.amp.GradScaler("cuda", enabled=opt.amp)
+mapping_params = optimized_parameters(model.module.optimizer_mapping)
+D_params = optimized_parameters(model.module.optimizer_D)
+model.module.optimizer_mapping.zero_grad()
+model.module.optimizer_D.zero_grad()
+accumulated = 0
+
 display_delta = total_steps % opt.display_freq
 print_delta = total_steps % opt.print_freq
 save_delta = total_steps % opt.save_latest_freq
@@ -72,6 +93,8 @@ save_delta = total_steps % opt.save_latest_freq
 for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
     epoch_s_t=datetime.datetime.now()
     epoch_start_time = time.time()
+    print_start_time, print_samples = time.time(), 0
+    data_loader.set_epoch(epoch)
     if epoch != start_epoch:
         epoch_iter = epoch_iter % dataset_size
     for i, data in enumerate(dataset, start=epoch_iter):
@@ -79,13 +102,19 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
         total_steps += opt.batchSize
         epoch_iter += opt.batchSize
 
+        if opt.gpu_degradation:
+            data = degrade_training_batch(data, degradation_device, paired=True)
+
         # whether to collect output images
         save_fake = total_steps % opt.display_freq == display_delta
 
         ############## Forward Pass ######################
         #print(pair)
-        losses, generated = model(Variable(data['label']), Variable(data['inst']), 
-            Variable(data['image']), Variable(data['feat']), infer=save_fake)
+        ## DistributedDataParallel averages the gradients only in the backward of the last accumulated batch
+        sync = accumulated + 1 == opt.accumulation_steps
+        with model.no_sync() if opt.distributed and not sync else contextlib.nullcontext():
+            with torch.autocast("cuda", enabled=opt.amp):
+                losses, generated = model(data['label'], data['inst'], data['image'], data['feat'], infer=save_fake)
         
         # sum per device losses
         losses = [ torch.mean(x) if not isinstance(x, int) else x for x in losses ]
@@ -97,26 +126,39 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
         #loss_G = loss_dict['G_Feat_L2'] 
 
         ############### Backward Pass ####################
-        # update generator weights
-        model.module.optimizer_mapping.zero_grad()
-        loss_G.backward()
-        model.module.optimizer_mapping.step()
-
-        # update discriminator weights
-        model.module.optimizer_D.zero_grad()
-        loss_D.backward()
-        model.module.optimizer_D.step()
+        ## loss_G only accumulates into the mapping and loss_D only into the discriminator, so the
+        ## gradients of --accumulation_steps batches add up before both optimizers step
+        scaler.scale(loss_G / opt.accumulation_steps).backward(inputs=mapping_params)
+        scaler.scale(loss_D / opt.accumulation_steps).backward(inputs=D_params)
+        accumulated += 1
+        print_samples += opt.batchSize
+
+        if accumulated == opt.accumulation_steps:
+            scaler.step(model.module.optimizer_mapping)
+            scaler.step(model.module.optimizer_D)
+            scaler.update()
+            model.module.optimizer_mapping.zero_grad()
+            model.module.optimizer_D.zero_grad()
+            accumulated = 0
 
         ############## Display results and errors ##########
         ### print out errors
-        if i == 0 or total_steps % opt.print_freq == print_delta:
+        if main_process and (i == 0 or total_steps % opt.print_freq == print_delta):
             errors = {k: v.data if not isinstance(v, int) else v for k, v in loss_dict.items()}
             t = (time.time() - iter_start_time) / opt.batchSize
             visualizer.print_current_errors(epoch, epoch_iter, errors, t,model.module.old_lr)
             visualizer.plot_current_errors(errors, total_steps)
 
+            samples_per_second = print_samples * opt.world_size / (time.time() - print_start_time)
+            max_memory = max([torch.cuda.max_memory_allocated(gpu) for gpu in opt.gpu_ids], default=0) / 1024 ** 2
+            visualizer.print_save('(samples/s: %.1f, max memory: %.0f MB, loss scale: %.0f)' % (
+                samples_per_second, max_memory, scaler.get_scale() if opt.amp else 1))
+            for gpu in opt.gpu_ids:
+                torch.cuda.reset_peak_memory_stats(gpu)
+            print_start_time, print_samples = time.time(), 0
+
         ### display output images
-        if save_fake:
+        if save_fake and main_process:
 
             if not os.path.exists(opt.outputs_dir + opt.name):
                 os.makedirs(opt.outputs_dir + opt.name)
@@ -125,17 +167,11 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
             if opt.NL_use_mask:
                 mask=data['inst'][:imgs_num]
                 mask=mask.repeat(1,3,1,1)
-                imgs = torch.cat((data['label'][:imgs_num], mask,generated.data.cpu()[:imgs_num], data['image'][:imgs_num]), 0)
+                imgs = [data['label'][:imgs_num], mask, generated.data[:imgs_num], data['image'][:imgs_num]]
             else:
-                imgs = torch.cat((data['label'][:imgs_num], generated.data.cpu()[:imgs_num], data['image'][:imgs_num]), 0)
+                imgs = [data['label'][:imgs_num], generated.data[:imgs_num], data['image'][:imgs_num]]
 
-            imgs=(imgs+1.)/2.0   ## de-normalize
-
-            try:
-                image_grid = vutils.save_image(imgs, opt.outputs_dir + opt.name + '/' + str(epoch) + '_' + str(total_steps) + '.png',
-                        nrow=imgs_num, padding=0, normalize=True)
-            except OSError as err:
-                print(err)
+            visualizer.save_image_grid(imgs, opt.outputs_dir + opt.name + '/' + str(epoch) + '_' + str(total_steps) + '.png', imgs_num)
 
         if epoch_iter >= dataset_size:
             break
@@ -148,10 +184,14 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
 
     ### save model for this epoch
     if epoch % opt.save_epoch_freq == 0:
-        print('saving the model at the end of epoch %d, iters %d' % (epoch, total_steps))        
-        model.module.save('latest')
-        model.module.save(epoch)
-        np.savetxt(iter_path, (epoch+1, 0), delimiter=',', fmt='%d')
+        if main_process:
+            print('saving the model at the end of epoch %d, iters %d' % (epoch, total_steps))        
+            model.module.save('latest')
+            model.module.save(epoch)
+            submit_write(writer, atomic_savetxt, iter_path, (epoch+1, 0), delimiter=',', fmt='%d')
+        ## every rank saves its own pool of generated images
+        model.module.save_pool('latest')
+        model.module.save_pool(epoch)
 
     ### instead of only training the local enhancer, train the entire network after certain iterations
     if (opt.niter_fix_global != 0) and (epoch == opt.niter_fix_global):
@@ -159,4 +199,8 @@ for epoch in range(start_epoch, opt.niter + opt.niter_decay + 1):
 
     ### linearly decay learning rate after certain iterations
     if epoch > opt.niter:
-        model.module.update_learning_rate()
\ No newline at end of file
+        model.module.update_learning_rate()
+
+if writer is not None:
+    writer.close()
+cleanup_distributed(opt)
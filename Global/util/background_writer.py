@@ -0,0 +1,97 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torchvision.utils as vutils
+
+
+class BackgroundWriter:
+    """Runs the writes on |num_threads| threads, blocking new writes while |max_pending| are
+    waiting. Errors of a write are raised by a later submit or by close. With one thread the
+    writes run in the order they are submitted."""
+
+    def __init__(self, num_threads, max_pending):
+        self.executor = ThreadPoolExecutor(max(num_threads, 1))
+        self.max_pending = max(max_pending, 1)
+        self.pending = deque()
+
+    def submit(self, fn, *args, **kwargs):
+        while len(self.pending) >= self.max_pending or (self.pending and self.pending[0].done()):
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(fn, *args, **kwargs))
+
+    def close(self):
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown()
+
+
+def create_training_writer(opt):
+    """The single thread that writes the checkpoints, images and logs of a training script, so
+    they keep their order; None with --max_pending_writes 0, which writes them in the loop."""
+    if opt.max_pending_writes <= 0:
+        return None
+    return BackgroundWriter(1, opt.max_pending_writes)
+
+
+def submit_write(writer, fn, *args, **kwargs):
+    """fn(*args, **kwargs) on |writer|, or right away when there is none."""
+    if writer is None:
+        fn(*args, **kwargs)
+    else:
+        writer.submit(fn, *args, **kwargs)
+
+
+def cpu_snapshot(state):
+    """|state| with every tensor copied to the CPU, which is all the training loop waits for
+    before the copy is written in the background while the tensors keep training."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        snapshot = type(state)((k, cpu_snapshot(v)) for k, v in state.items())
+        ## the versions of the layers in a state_dict
+        if hasattr(state, "_metadata"):
+            snapshot._metadata = state._metadata
+        return snapshot
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_snapshot(v) for v in state)
+    return state
+
+
+def atomic_path(path):
+    ## the temporary file keeps the extension, which picks the image format
+    root, ext = os.path.splitext(path)
+    return "%s.tmp%s" % (root, ext)
+
+
+def atomic_save(state, path):
+    ## written next to the target and renamed, so a crash never leaves a truncated checkpoint
+    tmp_path = atomic_path(path)
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_savetxt(path, values, **kwargs):
+    tmp_path = atomic_path(path)
+    np.savetxt(tmp_path, values, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def save_image_grid(images, path, nrow):
+    """The [-1, 1] |images|, a list of batches, as one grid like the training scripts saved it."""
+    grid = (torch.cat(images, 0) + 1.0) / 2.0
+    tmp_path = atomic_path(path)
+    vutils.save_image(grid, tmp_path, nrow=nrow, padding=0, normalize=True)
+    os.replace(tmp_path, path)
+
+
+def append_line(path, message):
+    with open(path, "a") as log_file:
+        log_file.write("%s\n" % message)
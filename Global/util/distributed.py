@@ -0,0 +1,59 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+## A training script started by torchrun trains one process per GPU, or per CPU process with gloo:
+##   torchrun --nproc_per_node=4 train_mapping.py --gpu_ids 0,1,2,3 ...
+## Every rank loads its own share of the batches and keeps its own ImagePool; only rank 0 writes
+## checkpoints, logs and images.
+
+
+def init_distributed(opt):
+    """Joins the process group described by the torchrun environment and sets opt.rank,
+    opt.world_size and opt.distributed. Every rank trains on one GPU: the |local_rank|-th of
+    --gpu_ids, or the GPU of that index when fewer are listed; without GPUs it trains on the CPU."""
+    opt.world_size = int(os.environ.get("WORLD_SIZE", 1))
+    opt.rank = int(os.environ.get("RANK", 0))
+    opt.distributed = opt.world_size > 1
+    if not opt.distributed:
+        return opt
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if opt.gpu_ids:
+        opt.gpu_ids = [opt.gpu_ids[local_rank] if local_rank < len(opt.gpu_ids) else local_rank]
+        torch.cuda.set_device(opt.gpu_ids[0])
+    backend = opt.dist_backend or ("nccl" if opt.gpu_ids else "gloo")
+    dist.init_process_group(backend)
+    return opt
+
+
+def is_main(opt):
+    return getattr(opt, "rank", 0) == 0
+
+
+def parallelize(model, opt):
+    """|model| wrapped for training: DistributedDataParallel in a distributed run, DataParallel over
+    several --gpu_ids otherwise. Batch norms are synchronized across the GPUs of a distributed run."""
+    if getattr(opt, "distributed", False):
+        if opt.gpu_ids:
+            model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        return DistributedDataParallel(model, device_ids=opt.gpu_ids or None,
+                                       find_unused_parameters=opt.find_unused_parameters)
+    if len(opt.gpu_ids) > 1:
+        return torch.nn.DataParallel(model, device_ids=opt.gpu_ids)
+    return model
+
+
+def optimized_parameters(optimizer):
+    """The parameters |optimizer| steps. A loss backpropagated with inputs=optimized_parameters(...)
+    only reaches the network it trains, so every gradient is averaged once per iteration even when
+    the generator and discriminator losses are backpropagated separately."""
+    return [p for group in optimizer.param_groups for p in group["params"] if p.requires_grad]
+
+
+def cleanup_distributed(opt):
+    if getattr(opt, "distributed", False):
+        dist.destroy_process_group()
@@ -1,36 +1,78 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import random
 import torch
-from torch.autograd import Variable
 
 
 class ImagePool:
+    """A history of generated images for the discriminator, kept in one preallocated tensor on the
+    device of the images.
+
+    Until the pool is full every queried image is stored and returned; after that every image is
+    swapped with probability 0.5 for a random stored image, which is returned in its place. The pool
+    draws from its own generator, so state_dict() also restores its random choices. Every process
+    of a distributed run has a pool of its own."""
+
     def __init__(self, pool_size):
         self.pool_size = pool_size
         if self.pool_size > 0:
             self.num_imgs = 0
-            self.images = []
+            self.images = None
+            self.generator = torch.Generator()
+            self.generator.seed()
 
     def query(self, images):
         if self.pool_size == 0:
             return images
-        return_images = []
-        for image in images.data:
-            image = torch.unsqueeze(image, 0)
-            if self.num_imgs < self.pool_size:
-                self.num_imgs = self.num_imgs + 1
-                self.images.append(image)
-                return_images.append(image)
-            else:
-                p = random.uniform(0, 1)
-                if p > 0.5:
-                    random_id = random.randint(0, self.pool_size - 1)
-                    tmp = self.images[random_id].clone()
-                    self.images[random_id] = image
-                    return_images.append(tmp)
-                else:
-                    return_images.append(image)
-        return_images = Variable(torch.cat(return_images, 0))
+        images = images.detach()
+        if self.images is None:
+            self.images = images.new_empty((self.pool_size,) + images.shape[1:])
+        elif self.images.shape[1:] != images.shape[1:]:
+            raise ValueError("The pool keeps images of %s, got %s" % (tuple(self.images.shape[1:]), tuple(images.shape[1:])))
+        if self.images.device != images.device:
+            self.images = self.images.to(images.device)
+        stored = images.to(self.images.dtype)
+
+        ## the first images fill the pool and are returned as they are
+        filled = min(len(images), self.pool_size - self.num_imgs)
+        self.images[self.num_imgs:self.num_imgs + filled] = stored[:filled]
+        self.num_imgs += filled
+        if filled == len(images):
+            return images
+
+        ## the others are swapped into distinct random slots, at most one image per slot and batch
+        swap = torch.rand(len(images) - filled, generator=self.generator) > 0.5
+        swap &= swap.cumsum(0) <= self.pool_size
+        index = torch.nonzero(swap).view(-1) + filled
+        if len(index) == 0:
+            return images
+        slots = torch.randperm(self.pool_size, generator=self.generator)[:len(index)]
+        index, slots = index.to(images.device), slots.to(images.device)
+
+        return_images = images.index_copy(0, index, self.images.index_select(0, slots).to(images.dtype))
+        self.images.index_copy_(0, slots, stored.index_select(0, index))
         return return_images
+
+    def state_dict(self):
+        if self.pool_size == 0:
+            return {"pool_size": 0}
+        return {
+            "pool_size": self.pool_size,
+            "images": None if self.images is None else self.images[:self.num_imgs].cpu(),
+            "generator": self.generator.get_state(),
+        }
+
+    def load_state_dict(self, state):
+        if state["pool_size"] != self.pool_size:
+            print("The saved pool keeps %d images instead of %d, starting with an empty pool" % (state["pool_size"], self.pool_size))
+            return
+        if self.pool_size == 0:
+            return
+        self.generator.set_state(state["generator"])
+        self.num_imgs = 0
+        self.images = None
+        if state["images"] is not None:
+            saved = state["images"]
+            self.images = saved.new_empty((self.pool_size,) + saved.shape[1:])
+            self.images[:len(saved)] = saved
+            self.num_imgs = len(saved)
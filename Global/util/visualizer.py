@@ -6,6 +6,7 @@ import os
 import ntpath
 import time
 from . import util
+from .background_writer import append_line, cpu_snapshot, save_image_grid, submit_write
 #from . import html
 import scipy.misc
 try:
@@ -14,8 +15,10 @@ except ImportError:
     from io import BytesIO         # Python 3.x
 
 class Visualizer():
-    def __init__(self, opt):
+    def __init__(self, opt, writer=None):
         # self.opt = opt
+        ## a BackgroundWriter for the logs, which are written in the caller's thread without it
+        self.writer = writer
         self.tf_log = opt.tf_log
         self.use_html = opt.isTrain and not opt.no_html
         self.win_size = opt.display_winsize
@@ -24,7 +27,7 @@ class Visualizer():
             import tensorflow as tf
             self.tf = tf
             self.log_dir = os.path.join(opt.checkpoints_dir, opt.name, 'logs')
-            self.writer = tf.summary.FileWriter(self.log_dir)
+            self.summary_writer = tf.summary.FileWriter(self.log_dir)
 
         if self.use_html:
             self.web_dir = os.path.join(opt.checkpoints_dir, opt.name, 'web')
@@ -54,7 +57,7 @@ class Visualizer():
 
             # Create and write Summary
             summary = self.tf.Summary(value=img_summaries)
-            self.writer.add_summary(summary, step)
+            self.summary_writer.add_summary(summary, step)
 
         if self.use_html: # save images to a html file
             for label, image_numpy in visuals.items():
@@ -97,9 +100,23 @@ class Visualizer():
     # errors: dictionary of error labels and values
     def plot_current_errors(self, errors, step):
         if self.tf_log:
-            for tag, value in errors.items():
-                summary = self.tf.Summary(value=[self.tf.Summary.Value(tag=tag, simple_value=value)])
-                self.writer.add_summary(summary, step)
+            errors = {tag: float(value) for tag, value in errors.items()}
+            submit_write(self.writer, self.add_summaries, errors, step)
+
+    def add_summaries(self, errors, step):
+        for tag, value in errors.items():
+            summary = self.tf.Summary(value=[self.tf.Summary.Value(tag=tag, simple_value=value)])
+            self.summary_writer.add_summary(summary, step)
+
+    def save_image_grid(self, images, image_path, nrow):
+        ## the writer composes and saves the grid, the caller only waits for the copy to the CPU
+        submit_write(self.writer, self.write_image_grid, cpu_snapshot(images), image_path, nrow)
+
+    def write_image_grid(self, images, image_path, nrow):
+        try:
+            save_image_grid(images, image_path, nrow)
+        except OSError as err:
+            print(err)
 
     # errors: same format as |errors| of plotCurrentErrors
     def print_current_errors(self, epoch, i, errors, t, lr):
@@ -109,16 +126,13 @@ class Visualizer():
                 message += '%s: %.3f ' % (k, v)
 
         print(message)
-        with open(self.log_name, "a") as log_file:
-            log_file.write('%s\n' % message)
+        submit_write(self.writer, append_line, self.log_name, message)
 
 
     def print_save(self,message):
 
         print(message)
-
-        with open(self.log_name,"a") as log_file:
-            log_file.write('%s\n'%message)
+        submit_write(self.writer, append_line, self.log_name, message)
 
 
     # save image to the disk
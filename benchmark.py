@@ -0,0 +1,293 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import platform
+import subprocess
+
+import numpy as np
+import torch
+from PIL import Image
+import cv2
+from torch.utils.data import DataLoader
+
+# the online dataset uses the same absolute imports as the training scripts in Global
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Global"))
+
+from bopbtl_utils.cpu_threads import set_cpu_threads
+from Global.data.online_dataset_for_old_photos import online_add_degradation_v2
+from model_loaders import ScratchDetector, Restorer, FaceDetector, FaceBlender, FaceTensorDataset
+from model_loaders import load_scratch_detector, load_restore_model, load_face_enhancer
+
+STAGES = ["scratch_detect", "restore_quality", "restore_scratch", "face_detect", "align", "enhance", "blend"]
+
+
+def synthesize_clean_image(size: int) -> Image.Image:
+    # smooth colour gradients with a few shapes, so the degradations have structure to destroy
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    image = np.stack([x, y, 1.0 - (x + y) / 2.0], axis=2) * 255.0
+    for _ in range(8):
+        center = (random.randint(0, size - 1), random.randint(0, size - 1))
+        radius = random.randint(size // 16, size // 4)
+        color = [random.randint(0, 255) for _ in range(3)]
+        cv2.circle(image, center, radius, color, -1)
+    return Image.fromarray(image.astype(np.uint8))
+
+
+def synthesize_scratch_mask(size: int) -> Image.Image:
+    mask = np.zeros((size, size), np.uint8)
+    for _ in range(random.randint(3, 10)):
+        start = (random.randint(0, size - 1), random.randint(0, size - 1))
+        end = (random.randint(0, size - 1), random.randint(0, size - 1))
+        cv2.line(mask, start, end, 255, random.randint(1, 3))
+    return Image.fromarray(mask).convert("RGB")
+
+
+def synthesize_old_photo(size: int):
+    clean = synthesize_clean_image(size)
+    mask = synthesize_scratch_mask(size)
+    degraded = online_add_degradation_v2(clean)
+    degraded = Restorer.irregular_hole_synthesize(degraded, mask)
+    return degraded, mask
+
+
+def synthesize_landmarks(size: int):
+    # a single frontal face in the middle of the image, in the order returned by FaceDetector.search
+    points = FaceDetector._origin_face_pts() / 512.0 * size
+    return points.astype(np.int64)
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.gpu_ids = [int(n) for n in args.device_ids.split(",") if int(n) >= 0]
+        self.device = torch.device("cuda", self.gpu_ids[0]) if self.gpu_ids else torch.device("cpu")
+        self.scratch_device = self.gpu_ids[0] if self.gpu_ids else -1
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.models = {}
+
+    def model(self, name):
+        if name not in self.models:
+            self.models[name] = self.load_model(name)
+        return self.models[name]
+
+    def load_model(self, name):
+        tmp_dir = self.tmp_dir.name
+        if name == "scratch":
+            return load_scratch_detector(self.scratch_device, "", tmp_dir)
+        if name == "restore_quality":
+            return load_restore_model(self.gpu_ids, False, tmp_dir, compile=self.args.compile, compile_cache=self.args.compile_cache)
+        if name == "restore_scratch":
+            return load_restore_model(self.gpu_ids, True, tmp_dir, compile=self.args.compile, compile_cache=self.args.compile_cache)
+        if name == "face_detector":
+            face_detector = FaceDetector.dlib.get_frontal_face_detector()
+            landmark_locator = None
+            if self.args.shape_predictor != "":
+                landmark_locator = FaceDetector.dlib.shape_predictor(self.args.shape_predictor)
+            return face_detector, landmark_locator
+        if name == "face_enhancer":
+            return load_face_enhancer(self.gpu_ids, self.args.face_size, "", tmp_dir)
+        raise ValueError("Unknown model %s" % name)
+
+    def synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def prepare(self, stage, resolution, batch_size):
+        photos = [synthesize_old_photo(resolution) for _ in range(batch_size)]
+        images = [image for image, _ in photos]
+        masks = [mask for _, mask in photos]
+        face_size = self.args.face_size
+        landmarks = [synthesize_landmarks(resolution) for _ in range(batch_size)]
+
+        if stage == "scratch_detect":
+            model = self.model("scratch")
+            return lambda: [
+                ScratchDetector.detect_scratches(image, model, self.scratch_device, "full_size")
+                for image in images
+            ]
+
+        if stage in ("restore_quality", "restore_scratch"):
+            opt, model, image_transform, mask_transform = self.model(stage)
+
+            def restore():
+                inputs = []
+                input_masks = []
+                for image, mask in zip(images, masks):
+                    if opt.Scratch_and_Quality_restore:
+                        input, input_mask, _ = Restorer.transform_image_and_mask(
+                            image, image_transform, mask, mask_transform, opt.mask_dilation
+                        )
+                    else:
+                        input, input_mask, _ = Restorer.transform_image(image, image_transform, opt.test_mode)
+                    inputs.append(input)
+                    input_masks.append(input_mask)
+                with torch.no_grad():
+                    return Restorer.inference_batch(model, inputs, input_masks)
+
+            return restore
+
+        np_images = [np.array(image) for image in images]
+
+        if stage == "face_detect":
+            face_detector, landmark_locator = self.model("face_detector")
+
+            def detect():
+                for np_image in np_images:
+                    if landmark_locator is None:
+                        face_detector(np_image)
+                    else:
+                        FaceDetector.get_face_landmarks(face_detector, landmark_locator, np_image)
+
+            return detect
+
+        if stage == "align":
+            return lambda: [
+                FaceDetector.get_aligned_faces([landmark], np_image, face_size)
+                for landmark, np_image in zip(landmarks, np_images)
+            ]
+
+        faces = []
+        for landmark, np_image in zip(landmarks, np_images):
+            faces += FaceDetector.get_aligned_faces([landmark], np_image, face_size)
+
+        if stage == "enhance":
+            model = self.model("face_enhancer")
+            pil_faces = [Image.fromarray((face * 255.0).astype(np.uint8)) for face in faces]
+
+            def enhance():
+                dataset = FaceTensorDataset()
+                dataset.initialize(
+                    preprocess_mode="scale_width_and_crop",
+                    load_size=face_size,
+                    crop_size=face_size,
+                    aspect_ratio=1.0,
+                    is_train=False,
+                    no_flip=True,
+                    image_list=pil_faces,
+                    parts_list=[None for _ in range(len(FaceTensorDataset.get_parts()))],
+                )
+                dataloader = DataLoader(dataset, batch_size=1 if face_size == 512 else 4, shuffle=False)
+                return [model(batch, mode="inference") for batch in dataloader]
+
+            return enhance
+
+        if stage == "blend":
+            enhanced_faces = [(face * 255.0).astype(np.uint8) for face in faces]
+            return lambda: FaceBlender.blend_faces(
+                np_images, [1] * batch_size, enhanced_faces, landmarks, face_size
+            )
+
+        raise ValueError("Unknown stage %s" % stage)
+
+    def run_stage(self, stage, resolution, batch_size):
+        random.seed(self.args.seed)
+        np.random.seed(self.args.seed)
+        torch.manual_seed(self.args.seed)
+        fn = self.prepare(stage, resolution, batch_size)
+        for _ in range(self.args.warmup):
+            fn()
+        self.synchronize()
+        timings = []
+        for _ in range(self.args.repeats):
+            start = time.perf_counter()
+            fn()
+            self.synchronize()
+            timings.append((time.perf_counter() - start) * 1000.0)
+        timings = np.array(timings)
+        return {
+            "stage": stage,
+            "resolution": resolution,
+            "batch_size": batch_size,
+            "repeats": self.args.repeats,
+            "mean_ms": float(timings.mean()),
+            "median_ms": float(np.median(timings)),
+            "min_ms": float(timings.min()),
+            "max_ms": float(timings.max()),
+            "std_ms": float(timings.std()),
+            "images_per_s": float(batch_size * 1000.0 / timings.mean()),
+        }
+
+    def run(self):
+        results = []
+        for stage in self.args.stages.split(","):
+            for resolution in [int(n) for n in self.args.resolutions.split(",")]:
+                for batch_size in [int(n) for n in self.args.batch_sizes.split(",")]:
+                    result = self.run_stage(stage, resolution, batch_size)
+                    print(
+                        "%-16s %5dpx x %-3d %10.2f ms  (%.2f img/s)"
+                        % (stage, resolution, batch_size, result["mean_ms"], result["images_per_s"])
+                    )
+                    results.append(result)
+        return {"meta": self.meta(), "results": results}
+
+    def meta(self):
+        try:
+            commit = subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+            ).decode().strip()
+        except Exception:
+            commit = ""
+        return {
+            "commit": commit,
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "device": str(self.device),
+            "num_threads": torch.get_num_threads(),
+            "num_interop_threads": torch.get_num_interop_threads(),
+            "seed": self.args.seed,
+            "warmup": self.args.warmup,
+            "compile": self.args.compile,
+        }
+
+
+def compare(baseline, results):
+    key = lambda result: (result["stage"], result["resolution"], result["batch_size"])
+    print("compared with commit %s" % baseline["meta"]["commit"])
+    baseline = {key(result): result for result in baseline["results"]}
+    for result in results["results"]:
+        if key(result) not in baseline:
+            continue
+        before = baseline[key(result)]["mean_ms"]
+        after = result["mean_ms"]
+        print(
+            "%-16s %5dpx x %-3d %10.2f ms -> %10.2f ms  (%.2fx)"
+            % (result["stage"], result["resolution"], result["batch_size"], before, after, before / after)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", type=str, default=",".join(STAGES), help=",".join(STAGES))
+    parser.add_argument("--resolutions", type=str, default="256,512", help="comma separated square input sizes")
+    parser.add_argument("--batch_sizes", type=str, default="1,4", help="comma separated batch sizes")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--device_ids", type=str, default="-1", help="-1 for CPU, 0 for the first gpu")
+    parser.add_argument("--face_size", type=int, default=256, help="256|512")
+    parser.add_argument("--cpu_threads", type=int, default=0, help="intra-op threads on CPU, 0 uses the torch default")
+    parser.add_argument("--cpu_interop_threads", type=int, default=0, help="inter-op threads on CPU, 0 uses the torch default")
+    parser.add_argument("--compile", type=str, default="none", help="none|trace|inductor, how the restoration networks run; the warmup runs compile them")
+    parser.add_argument("--compile_cache", type=str, default="", help="cache of the compiled restoration networks; a temporary directory without it")
+    parser.add_argument("--shape_predictor", type=str, default="", help="dlib 68 landmarks model; without it only the face detector is timed")
+    parser.add_argument("--output", type=str, default="", help="write the results as JSON to this file")
+    parser.add_argument("--compare", type=str, default="", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    set_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+    results = Benchmark(args).run()
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare != "":
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,139 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+import os
+import sys
+import time
+import random
+import struct
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Global"))
+
+from data.Load_Bigfile import BigFileMemoryLoader, BigFileWriter
+
+
+class LegacyBigFileLoader(object):
+    """The loader before the v2 format: every image is read into its own bytes object."""
+
+    def __init__(self, file_path):
+        with open(file_path, "rb") as fid:
+            self.img_num = struct.unpack("i", fid.read(4))[0]
+            self.img_names = []
+            self.img_bytes = []
+            for i in range(self.img_num):
+                img_name_len = struct.unpack("i", fid.read(4))[0]
+                self.img_names.append(fid.read(img_name_len).decode("utf-8"))
+                img_bytes_len = struct.unpack("i", fid.read(4))[0]
+                self.img_bytes.append(fid.read(img_bytes_len))
+
+    def __getitem__(self, index):
+        return self.img_names[index], Image.open(io.BytesIO(self.img_bytes[index])).convert("RGB")
+
+    def __len__(self):
+        return self.img_num
+
+
+def write_v1(path: str, images):
+    with open(path, "wb") as fid:
+        fid.write(struct.pack("i", len(images)))
+        for name, data in images:
+            name = name.encode("utf-8")
+            fid.write(struct.pack("i", len(name)))
+            fid.write(name)
+            fid.write(struct.pack("i", len(data)))
+            fid.write(data)
+
+
+def synthesize_images(count: int, size: int):
+    images = []
+    for i in range(count):
+        ## noise does not compress, so the file is about count * size * size * 3 bytes
+        array = np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(array).save(buffer, format="PNG", compress_level=0)
+        images.append(("%06d.png" % i, buffer.getvalue()))
+    return images
+
+
+def memory_kb():
+    memory = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("RssAnon:", "RssFile:")):
+                key, value = line.split(":")
+                memory[key] = int(value.split()[0])
+    return memory
+
+
+def measure(loader_name: str, path: str, reads: int, results):
+    loader_class = LegacyBigFileLoader if loader_name == "legacy" else BigFileMemoryLoader
+    base = memory_kb()
+    start = time.perf_counter()
+    loader = loader_class(path)
+    open_s = time.perf_counter() - start
+    opened = memory_kb()
+    indices = random.Random(0).choices(range(len(loader)), k=reads)
+    start = time.perf_counter()
+    for index in indices:
+        loader[index]
+    read_ms = (time.perf_counter() - start) * 1000.0 / max(reads, 1)
+    read = memory_kb()
+    results.put({
+        "open_s": open_s,
+        "read_ms": read_ms,
+        "anon_open_mb": (opened["RssAnon"] - base["RssAnon"]) / 1024.0,
+        "anon_read_mb": (read["RssAnon"] - base["RssAnon"]) / 1024.0,
+        "file_read_mb": (read["RssFile"] - base["RssFile"]) / 1024.0,
+    })
+
+
+def run(loader_name: str, path: str, reads: int):
+    ## a fresh process for every measurement, so the memory of one loader does not hide another
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=measure, args=(loader_name, path, reads, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and memory of the mmap bigfile loader compared with the legacy in-memory loader")
+    parser.add_argument("--bigfile", type=str, default="", help="v1 bigfile to measure; a synthesized one without it")
+    parser.add_argument("--images", type=int, default=2000, help="images of the synthesized bigfile")
+    parser.add_argument("--size", type=int, default=128, help="square size of the synthesized images")
+    parser.add_argument("--reads", type=int, default=200, help="random images decoded after opening")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    v1_path = args.bigfile
+    if v1_path == "":
+        v1_path = os.path.join(tmp_dir.name, "v1.bigfile")
+        write_v1(v1_path, synthesize_images(args.images, args.size))
+    v2_path = os.path.join(tmp_dir.name, "v2.bigfile")
+    v1 = BigFileMemoryLoader(v1_path)
+    with BigFileWriter(v2_path) as writer:
+        for i in range(len(v1)):
+            writer.add(v1.name(i), v1.img_bytes(i))
+    del v1
+
+    print("%.2f GB, %d reads" % (os.path.getsize(v1_path) / 1024.0 ** 3, args.reads))
+    print("%-12s %10s %12s %16s %16s %16s" % ("loader", "open s", "read ms/img", "anon open MB", "anon read MB", "file read MB"))
+    for loader_name, path in (("legacy", v1_path), ("mmap v1", v1_path), ("mmap v2", v2_path)):
+        result = run(loader_name, path, args.reads)
+        print(
+            "%-12s %10.3f %12.2f %16.1f %16.1f %16.1f"
+            % (loader_name, result["open_s"], result["read_ms"], result["anon_open_mb"], result["anon_read_mb"], result["file_read_mb"])
+        )
+
+
+if __name__ == "__main__":
+    main()
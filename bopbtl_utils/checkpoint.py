@@ -0,0 +1,106 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import torch
+
+try:
+    import safetensors.torch
+except ImportError:
+    safetensors = None
+
+SAFETENSORS_EXTENSION = ".safetensors"
+
+
+def safetensors_path(path):
+    return os.path.splitext(path)[0] + SAFETENSORS_EXTENSION
+
+
+def resolve_checkpoint_path(path):
+    ## Prefer an up to date .safetensors copy next to a .pth/.pt checkpoint
+    if path.endswith(SAFETENSORS_EXTENSION) or safetensors is None:
+        return path
+    converted = safetensors_path(path)
+    if os.path.isfile(converted) and os.path.getmtime(converted) >= os.path.getmtime(path):
+        return converted
+    return path
+
+
+def load_checkpoint(path, device="cpu"):
+    """Reads a checkpoint exactly once. safetensors files are loaded straight to |device|;
+    pickled checkpoints are memory-mapped where the file format allows it, so tensors are
+    only paged in when they are copied into the network."""
+    path = resolve_checkpoint_path(path)
+    if path.endswith(SAFETENSORS_EXTENSION):
+        if safetensors is None:
+            raise RuntimeError("Loading %s requires the safetensors package!" % path)
+        return safetensors.torch.load_file(path, device=str(device))
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (RuntimeError, TypeError):
+        ## legacy (non zip) checkpoints and old torch versions cannot be memory-mapped
+        return torch.load(path, map_location="cpu")
+
+
+def network_device(network):
+    for param in network.parameters():
+        return param.device
+    return torch.device("cpu")
+
+
+def load_state_dict(network, state_dict, name="", strict=False):
+    """Copies the matching tensors of |state_dict| into |network|.
+
+    Returns the missing, unexpected and shape mismatched keys. With |strict| any of
+    them raises instead, like torch.nn.Module.load_state_dict."""
+    model_dict = network.state_dict()
+    missing = [k for k in model_dict if k not in state_dict]
+    unexpected = [k for k in state_dict if k not in model_dict]
+    mismatched = [
+        k for k, v in state_dict.items() if k in model_dict and v.size() != model_dict[k].size()
+    ]
+    if strict and (missing or unexpected or mismatched):
+        raise RuntimeError(
+            "Error(s) in loading state_dict for %s: missing %s, unexpected %s, size mismatch %s"
+            % (name or network.__class__.__name__, missing, unexpected, mismatched)
+        )
+
+    if unexpected:
+        print("Pretrained network %s has excessive layers; Only loading layers that are used" % name)
+    if missing or mismatched:
+        print("Pretrained network %s has fewer layers; The following are not initialized:" % name)
+        print(sorted(set(k.split(".")[0] for k in missing + mismatched)))
+
+    matched = {k: v for k, v in state_dict.items() if k in model_dict and k not in mismatched}
+    network.load_state_dict(matched, strict=False)
+    return missing, unexpected, mismatched
+
+
+def load_network_from_path(network, path, key=None, strict=False):
+    checkpoint = load_checkpoint(path, network_device(network))
+    if key is not None and key in checkpoint:
+        checkpoint = checkpoint[key]
+    return load_state_dict(network, checkpoint, os.path.split(path)[1], strict=strict)
+
+
+def convert_to_safetensors(path, output_path=None):
+    """Writes the tensors of a .pth/.pt checkpoint to a .safetensors file next to it.
+    A nested {"model_state": ...} checkpoint is flattened to its state dict."""
+    if safetensors is None:
+        raise RuntimeError("Converting checkpoints requires the safetensors package!")
+    checkpoint = torch.load(path, map_location="cpu")
+    if isinstance(checkpoint, dict) and isinstance(checkpoint.get("model_state"), dict):
+        checkpoint = checkpoint["model_state"]
+    tensors = {}
+    skipped = []
+    for k, v in checkpoint.items():
+        if torch.is_tensor(v):
+            ## safetensors does not store shared or strided storage
+            tensors[k] = v.detach().contiguous().clone()
+        else:
+            skipped.append(k)
+    if skipped:
+        print("Skipping non tensor entries of %s: %s" % (path, skipped))
+    output_path = output_path or safetensors_path(path)
+    safetensors.torch.save_file(tensors, output_path, metadata={"source": os.path.basename(path)})
+    return output_path
@@ -0,0 +1,16 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import torch
+
+
+def set_cpu_threads(num_threads=0, num_interop_threads=0):
+    ## Size the intra-op and inter-op thread pools of CPU inference; 0 keeps the torch default
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0 and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            ## the inter-op pool can only be sized before its first use
+            print("Unable to use %d inter-op threads; keeping %d" % (num_interop_threads, torch.get_num_interop_threads()))
@@ -0,0 +1,266 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+
+import torch
+
+# Set BOPBTL_PROFILE=1 to record every node call and inner stage, and
+# BOPBTL_PROFILE_TRACE=<path> to also write a Chrome trace when the process exits.
+ENV_PROFILE = "BOPBTL_PROFILE"
+ENV_TRACE = "BOPBTL_PROFILE_TRACE"
+
+_enabled = False
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+_active = set() # stages running on any thread
+_peaks_lock = threading.Lock()
+_patches = [] # (module, attribute, original, wrapped)
+_origin = time.perf_counter()
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+    for module, attribute, original, wrapped in _patches:
+        setattr(module, attribute, wrapped)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    for module, attribute, original, wrapped in _patches:
+        setattr(module, attribute, original)
+
+
+def clear():
+    with _records_lock:
+        _records.clear()
+
+
+def get_records():
+    with _records_lock:
+        return list(_records)
+
+
+def _host_peak_mb():
+    # the peak resident set size since the last _reset_host_peak; only Linux can reset it, and the
+    # lifetime peak of the process (ru_maxrss) says nothing about the stage, so elsewhere it is None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def _reset_host_peak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _devices():
+    if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return []
+    return range(torch.cuda.device_count())
+
+
+def _device_peak_mb():
+    # the largest peak of any device, the pipeline and data parallel stages run on several
+    peaks = [torch.cuda.max_memory_allocated(device) / 1024.0 / 1024.0 for device in _devices()]
+    return max(peaks) if peaks else None
+
+
+def _fold_peaks():
+    # callers hold _peaks_lock
+    host, device = _host_peak_mb(), _device_peak_mb()
+    for stage in _active:
+        stage.host_peak = _max(stage.host_peak, host)
+        stage.device_peak = _max(stage.device_peak, device)
+
+
+class _Stage:
+    """The peaks are process wide: a stage starting resets them, after folding them into every
+    stage still running, on this thread (the enclosing stages) or on others. So no stage loses
+    its peak, but stages running concurrently are not isolated and each one reports the peak of
+    everything that ran alongside it."""
+
+    __slots__ = ("name", "parent", "start", "cpu_start", "host_peak", "device_peak")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        self.host_peak = None
+        self.device_peak = None
+        with _peaks_lock:
+            _fold_peaks()
+            _reset_host_peak()
+            for device in _devices():
+                torch.cuda.reset_peak_memory_stats(device)
+            _active.add(self)
+        stack.append(self)
+        self.cpu_start = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        cpu_end = time.thread_time()
+        _local.stack.pop()
+        with _peaks_lock:
+            _fold_peaks()
+            _active.discard(self)
+        record = {
+            "name": self.name,
+            "parent": self.parent.name if self.parent is not None else None,
+            "depth": len(_local.stack),
+            "thread": threading.get_ident(),
+            "start_ms": (self.start - _origin) * 1000.0,
+            "wall_ms": (end - self.start) * 1000.0,
+            "cpu_ms": (cpu_end - self.cpu_start) * 1000.0,
+            "peak_host_mb": self.host_peak,
+            "peak_device_mb": self.device_peak,
+        }
+        with _records_lock:
+            _records.append(record)
+        return False
+
+
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def stage(name: str):
+    """Context manager recording one stage; a shared no-op when instrumentation is disabled."""
+    if not _enabled:
+        return _null_stage
+    return _Stage(name)
+
+
+def instrument(name: str):
+    """Decorator recording every call of the decorated function as a stage."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register(module, attribute: str, name: str = None):
+    """Records calls of a module level function, including calls made from inside that module.
+    The wrapper is only installed while instrumentation is enabled."""
+    original = getattr(module, attribute)
+    name = name or module.__name__.split(".")[-1] + "." + attribute
+
+    @functools.wraps(original)
+    def wrapped(*args, **kwargs):
+        with _Stage(name):
+            return original(*args, **kwargs)
+
+    _patches.append((module, attribute, original, wrapped))
+    if _enabled:
+        setattr(module, attribute, wrapped)
+
+
+def summary(records=None):
+    """Totals per stage name, sorted by wall time."""
+    totals = {}
+    for record in records if records is not None else get_records():
+        total = totals.setdefault(record["name"], {
+            "name": record["name"],
+            "calls": 0,
+            "wall_ms": 0.0,
+            "cpu_ms": 0.0,
+            "peak_host_mb": None,
+            "peak_device_mb": None,
+        })
+        total["calls"] += 1
+        total["wall_ms"] += record["wall_ms"]
+        total["cpu_ms"] += record["cpu_ms"]
+        total["peak_host_mb"] = _max(total["peak_host_mb"], record["peak_host_mb"])
+        total["peak_device_mb"] = _max(total["peak_device_mb"], record["peak_device_mb"])
+    return sorted(totals.values(), key=lambda total: total["wall_ms"], reverse=True)
+
+
+def print_summary(records=None):
+    print("%-40s %6s %12s %12s %12s %12s" % ("stage", "calls", "wall ms", "cpu ms", "host MB", "device MB"))
+    for total in summary(records):
+        print("%-40s %6d %12.2f %12.2f %12s %12s" % (
+            total["name"],
+            total["calls"],
+            total["wall_ms"],
+            total["cpu_ms"],
+            "-" if total["peak_host_mb"] is None else "%.1f" % total["peak_host_mb"],
+            "-" if total["peak_device_mb"] is None else "%.1f" % total["peak_device_mb"],
+        ))
+
+
+def export_chrome_trace(path: str, records=None):
+    """Writes the records in the Chrome trace event format (chrome://tracing, Perfetto)."""
+    pid = os.getpid()
+    events = []
+    for record in records if records is not None else get_records():
+        events.append({
+            "name": record["name"],
+            "cat": "bopbtl",
+            "ph": "X",
+            "ts": record["start_ms"] * 1000.0,
+            "dur": record["wall_ms"] * 1000.0,
+            "pid": pid,
+            "tid": record["thread"],
+            "args": {
+                "cpu_ms": record["cpu_ms"],
+                "peak_host_mb": record["peak_host_mb"],
+                "peak_device_mb": record["peak_device_mb"],
+            },
+        })
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+if os.environ.get(ENV_PROFILE, "") not in ("", "0"):
+    enable()
+if os.environ.get(ENV_TRACE, "") != "":
+    enable()
+    atexit.register(lambda: export_chrome_trace(os.environ[ENV_TRACE]))
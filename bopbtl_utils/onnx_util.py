@@ -0,0 +1,65 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+
+import numpy as np
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+ONNX_EXTENSION = ".onnx"
+OPSET_VERSION = 17
+
+
+def dynamic_axes(names):
+    ## every tensor gets its own spatial axis names, the outputs are not always the size of the inputs
+    return {name: {0: "batch", 2: name + "_height", 3: name + "_width"} for name in names}
+
+
+def export(network, inputs, path, opset_version=OPSET_VERSION):
+    """Exports |network| to ONNX by tracing it on |inputs|, a dict of input names and example
+    tensors in the order of the arguments of its forward. The batch and spatial axes of the
+    inputs and of the output stay dynamic."""
+    import torch
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    names = list(inputs)
+    with torch.no_grad():
+        torch.onnx.export(
+            network,
+            tuple(inputs.values()),
+            path,
+            input_names=names,
+            output_names=["output"],
+            dynamic_axes=dynamic_axes(names + ["output"]),
+            opset_version=opset_version,
+            dynamo=False,
+        )
+    return path
+
+
+def create_session(path, num_threads=0, num_interop_threads=0):
+    if onnxruntime is None:
+        raise RuntimeError("Running %s requires the onnxruntime package!" % path)
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+    if num_interop_threads > 0:
+        options.inter_op_num_threads = num_interop_threads
+    return onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def run(session, inputs):
+    """Runs |session| on a dict of named numpy arrays or tensors and returns the output as a
+    numpy array. Inputs that the exported graph does not use are dropped."""
+    feed = {}
+    for arg in session.get_inputs():
+        x = inputs[arg.name]
+        if hasattr(x, "detach"):
+            x = x.detach().cpu().numpy()
+        feed[arg.name] = np.ascontiguousarray(x, dtype=np.float32)
+    return session.run(None, feed)[0]
@@ -0,0 +1,19 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from collections import deque
+
+
+def map_ordered(executor, fn, items, depth):
+    ## yields fn(item) in order, keeping up to |depth| calls running ahead on |executor|
+    items = iter(items)
+    pending = deque()
+    while True:
+        while len(pending) < max(depth, 1):
+            item = next(items, None)
+            if item is None:
+                break
+            pending.append(executor.submit(fn, item))
+        if not pending:
+            return
+        yield pending.popleft().result()
@@ -0,0 +1,51 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+QUANTIZE_MODES = ["none", "int8"]
+
+
+def quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError("This build of torch does not support quantized inference!")
+
+
+def prepare_int8(network, exclude=()):
+    """Inserts observers for post-training static int8 quantization into every Conv2d of |network|
+    that is not part of a module of a type in |exclude|. Each convolution gets its own quantize /
+    dequantize stubs, so normalization layers, activations and attention stay in float.
+    Run a few calibration batches through |network| and then call convert_int8."""
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    qconfig = quantization.get_default_qconfig(engine)
+
+    def wrap(module):
+        for name, child in module.named_children():
+            if isinstance(child, exclude):
+                continue
+            if isinstance(child, nn.Conv2d):
+                try:
+                    ## fold the spectral normalization into the weight before it is quantized
+                    nn.utils.remove_spectral_norm(child)
+                except ValueError:
+                    pass
+                child = quantization.QuantWrapper(child)
+                child.qconfig = qconfig
+                setattr(module, name, child)
+            else:
+                wrap(child)
+
+    wrap(network)
+    quantization.prepare(network, inplace=True)
+    return network
+
+
+def convert_int8(network):
+    quantization.convert(network, inplace=True)
+    return network
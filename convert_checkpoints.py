@@ -0,0 +1,74 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import time
+import argparse
+
+import torch
+
+from bopbtl_utils import checkpoint
+
+CHECKPOINT_EXTENSIONS = (".pth", ".pt")
+
+
+def find_checkpoints(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if name.endswith(CHECKPOINT_EXTENSIONS) and "optimizer" not in name:
+                    yield os.path.join(root, name)
+
+
+def time_load(load, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        state_dict = load()
+        ## touch every tensor so lazily mapped checkpoints are actually read
+        for v in state_dict.values():
+            if torch.is_tensor(v):
+                v.sum()
+        times.append((time.perf_counter() - start) * 1000.0)
+    return min(times)
+
+
+def benchmark(path, converted, repeats):
+    def flat(state_dict):
+        return state_dict.get("model_state", state_dict)
+
+    results = {
+        "torch.load": time_load(lambda: flat(torch.load(path, map_location="cpu")), repeats),
+        "torch.load(mmap)": time_load(lambda: flat(checkpoint.load_checkpoint(path)), repeats),
+    }
+    if converted is not None:
+        results["safetensors"] = time_load(lambda: checkpoint.load_checkpoint(converted), repeats)
+    print(os.path.basename(path) + ": " + ", ".join("%s %.1f ms" % item for item in results.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert .pth/.pt checkpoints to .safetensors")
+    parser.add_argument("paths", nargs="+", help="checkpoint files or directories to search for checkpoints")
+    parser.add_argument("--overwrite", action="store_true", help="convert even if an up to date .safetensors file exists")
+    parser.add_argument("--benchmark", action="store_true", help="compare the load time of the formats")
+    parser.add_argument("--repeats", type=int, default=3, help="loads per format when benchmarking")
+    args = parser.parse_args()
+
+    for path in find_checkpoints(args.paths):
+        converted = checkpoint.safetensors_path(path)
+        if args.overwrite or checkpoint.resolve_checkpoint_path(path) != converted:
+            try:
+                checkpoint.convert_to_safetensors(path, converted)
+                print("Converted %s" % path)
+            except Exception as e:
+                print("Skipping %s: %s" % (path, e))
+                converted = None
+        if args.benchmark:
+            benchmark(path, converted, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
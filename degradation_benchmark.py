@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import sys
+import time
+import random
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Global"))
+
+from data.degradation import degrade
+from data.image_folder import make_dataset
+from data.online_dataset_for_old_photos import online_add_degradation_v2
+
+
+def load_images(folder: str, count: int, size: int):
+    if folder == "":
+        ## smooth noise, so blur, resampling and jpeg change it about as much as a photo
+        images = []
+        for _ in range(count):
+            low = np.random.randint(0, 256, (size // 8, size // 8, 3), dtype=np.uint8)
+            images.append(np.array(Image.fromarray(low).resize((size, size), Image.BICUBIC)))
+        return np.stack(images)
+    paths = sorted(make_dataset(folder))[:count]
+    return np.stack([np.array(Image.open(path).convert("RGB").resize((size, size), Image.BICUBIC)) for path in paths])
+
+
+def degrade_legacy(images):
+    return np.stack([np.array(online_add_degradation_v2(Image.fromarray(image))) for image in images])
+
+
+def degrade_torch(images, batch_size: int, device: str):
+    x = torch.from_numpy(images).permute(0, 3, 1, 2).contiguous().to(device)
+    seeds = list(range(len(images)))
+    out = torch.cat([degrade(x[i:i + batch_size], seeds[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return out.permute(0, 2, 3, 1).cpu().numpy()
+
+
+def statistics(clean, degraded):
+    ## per image change, its distribution is what the two engines should share
+    diff = np.abs(degraded.astype(np.float32) - clean.astype(np.float32)).reshape(len(clean), -1)
+    mse = (diff ** 2).mean(1)
+    psnr = 10 * np.log10(255.0 ** 2 / np.maximum(mse, 1e-10))
+    return {
+        "mean abs diff": diff.mean(1),
+        "psnr": np.minimum(psnr, 100),
+        "unchanged": (diff.max(1) == 0).astype(np.float32),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and output statistics of the torch degradation engine compared with online_add_degradation_v2")
+    parser.add_argument("--images", type=str, default="", help="folder of images; synthesized images without it")
+    parser.add_argument("--count", type=int, default=256, help="images to degrade")
+    parser.add_argument("--size", type=int, default=256, help="images are resized to this square size")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    images = load_images(args.images, args.count, args.size)
+    engines = [("legacy", lambda: degrade_legacy(images)), ("torch cpu", lambda: degrade_torch(images, args.batch_size, "cpu"))]
+    if torch.cuda.is_available():
+        degrade_torch(images[: args.batch_size], args.batch_size, "cuda")
+        engines.append(("torch cuda", lambda: degrade_torch(images, args.batch_size, "cuda")))
+
+    print("%d images of %dx%d, batch size %d" % (len(images), args.size, args.size, args.batch_size))
+    print("%-12s %10s %16s %16s %12s" % ("engine", "images/s", "mean abs diff", "psnr", "unchanged"))
+    for name, run in engines:
+        start = time.perf_counter()
+        degraded = run()
+        seconds = time.perf_counter() - start
+        stats = statistics(images, degraded)
+        print(
+            "%-12s %10.1f %8.2f +- %5.2f %8.2f +- %5.2f %12.3f"
+            % (
+                name,
+                len(images) / seconds,
+                stats["mean abs diff"].mean(),
+                stats["mean abs diff"].std(),
+                stats["psnr"].mean(),
+                stats["psnr"].std(),
+                stats["unchanged"].mean(),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+from model_loaders import ScratchDetector, load_scratch_detector, load_restore_model, load_face_enhancer
+from Global.models.onnx_model import OnnxInference, export_onnx as export_restoration
+from Face_Enhancement.models.onnx_model import OnnxPix2PixModel, export_onnx as export_face_enhancer
+
+MODELS = ["scratch", "restore_quality", "restore_scratch", "face"]
+
+
+def sizes(resolution: int):
+    ## a square and a non square size, both multiples of 16, to check the dynamic spatial axes
+    return [(resolution, resolution), (resolution * 3 // 4 // 16 * 16, resolution)]
+
+
+def difference(reference, output):
+    reference = reference.float().cpu().numpy()
+    output = np.asarray(output, dtype=np.float32)
+    if reference.shape != output.shape:
+        raise RuntimeError("ONNX output shape %s does not match %s" % (output.shape, reference.shape))
+    error = np.abs(reference - output)
+    return float(error.max()), float(error.mean())
+
+
+def export_scratch(args, tmp_dir: str):
+    model = load_scratch_detector(-1, args.scratch_checkpoint, tmp_dir)
+    path = ScratchDetector.export_onnx(model, args.output, args.resolution)
+    onnx_model = ScratchDetector.OnnxScratchDetector(path)
+    checks = []
+    for h, w in sizes(args.resolution):
+        image = torch.randn(1, 1, h, w)
+        checks.append(("%dx%d" % (h, w), model(image), onnx_model(image)))
+    return checks
+
+
+def export_restore(scratch: bool, args, tmp_dir: str):
+    opt, model, _, _ = load_restore_model([], scratch, tmp_dir, args.vae_a, args.vae_b, args.mapping_net)
+    label = torch.zeros(1, 3, args.resolution, args.resolution)
+    inst = torch.zeros(1, 1, args.resolution, args.resolution)
+    export_restoration(model, args.output, label, inst)
+    onnx_model = OnnxInference(args.output)
+    checks = []
+    for h, w in sizes(args.resolution):
+        label = torch.rand(1, 3, h, w) * 2 - 1
+        inst = (torch.rand(1, 1, h, w) > 0.95).float()
+        checks.append(("%dx%d" % (h, w), model.inference(label, inst), onnx_model.inference(label, inst)))
+    return checks
+
+
+def export_face(args, tmp_dir: str):
+    model = load_face_enhancer([], args.face_size, args.face_checkpoint, tmp_dir)
+    size = args.face_size
+    path = export_face_enhancer(model, args.output, torch.zeros(1, 18, size, size), torch.zeros(1, 3, size, size))
+    model.opt.test_path_G = path
+    onnx_model = OnnxPix2PixModel(model.opt)
+    checks = []
+    ## the generator always upsamples to the face size, so only the batch size varies
+    for batch_size in (1, 2):
+        data = {"label": torch.randn(batch_size, 18, size, size), "image": torch.rand(batch_size, 3, size, size) * 2 - 1}
+        checks.append(("batch %d" % batch_size, model(dict(data), mode="inference"), onnx_model(dict(data), mode="inference")))
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the networks to ONNX and check them against PyTorch with onnxruntime")
+    parser.add_argument("--model", type=str, required=True, choices=MODELS)
+    parser.add_argument("--output", type=str, required=True, help=".onnx file, or the directory of the encoder, mapping and decoder for restore_*")
+    parser.add_argument("--resolution", type=int, default=256, help="size of the example inputs")
+    parser.add_argument("--face_size", type=int, default=512, help="256|512")
+    parser.add_argument("--scratch_checkpoint", type=str, default="", help="scratch detection checkpoint; random weights without it")
+    parser.add_argument("--vae_a", type=str, default="", help="VAE A checkpoint")
+    parser.add_argument("--vae_b", type=str, default="", help="VAE B checkpoint matching the model")
+    parser.add_argument("--mapping_net", type=str, default="", help="mapping checkpoint matching the model; random weights without it")
+    parser.add_argument("--face_checkpoint", type=str, default="", help="face enhancer generator; random weights without it")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="largest mean absolute difference to PyTorch that passes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    tmp_dir = tempfile.TemporaryDirectory()
+    with torch.no_grad():
+        if args.model == "scratch":
+            checks = export_scratch(args, tmp_dir.name)
+        elif args.model == "face":
+            checks = export_face(args, tmp_dir.name)
+        else:
+            checks = export_restore(args.model == "restore_scratch", args, tmp_dir.name)
+
+    passed = True
+    for name, reference, output in checks:
+        max_error, mean_error = difference(reference, output)
+        passed = passed and mean_error <= args.tolerance
+        print("%s %-12s max abs diff %.3g, mean abs diff %.3g" % (args.model, name, max_error, mean_error))
+    print("Exported %s to %s" % (args.model, args.output))
+    if not passed:
+        print("onnxruntime does not match PyTorch within %g!" % args.tolerance)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import sys
+
+import torch
+
+from Global import detection as ScratchDetector
+from Global.detection_models import networks as ScratchNetworks
+from Global import test as Restorer
+from Global.options.test_options import TestOptions as RestoreOptions
+
+from Face_Detection import detect_all_dlib as FaceDetector
+from Face_Detection import align_warp_back_multiple_dlib as FaceBlender
+
+from Face_Enhancement import test_face as FaceEnhancer
+from Face_Enhancement.options.test_options import TestOptions as FaceEnhancerOptions
+from Face_Enhancement.models import networks as FaceNetworks
+from Face_Enhancement.data.face_dataset import FaceTensorDataset
+
+## The models of the command line tools (benchmark.py, server.py, quantization_report.py, export_onnx.py)
+## loaded from their checkpoints, or with random weights when a checkpoint is not given; random weights
+## only show the speed and memory, the restored photos need the real checkpoints.
+
+
+def save_random_scratch_model(path: str):
+    model = ScratchNetworks.UNet(
+        in_channels=1,
+        out_channels=1,
+        depth=4,
+        conv_num=2,
+        wf=6,
+        padding=True,
+        batch_norm=True,
+        up_mode="upsample",
+        with_tanh=False,
+        sync_bn=True,
+        antialiasing=True,
+    )
+    torch.save({"model_state": model.state_dict()}, path)
+
+
+def load_scratch_detector(device, checkpoint_path: str, tmp_dir: str):
+    if checkpoint_path == "":
+        checkpoint_path = os.path.join(tmp_dir, "scratch.pt")
+        save_random_scratch_model(checkpoint_path)
+    return ScratchDetector.load_model(device, checkpoint_path)
+
+
+def load_restore_model(
+    gpu_ids,
+    scratch: bool,
+    tmp_dir: str,
+    vae_a: str = "",
+    vae_b: str = "",
+    mapping_net: str = "",
+    HR: bool = False,
+    compile: str = "none",
+    compile_cache: str = "",
+    cpu_threads: int = 0,
+    cpu_interop_threads: int = 0,
+):
+    """(opt, model, image_transform, mask_transform) of Global/test.py; random weights without |mapping_net|."""
+    opt = RestoreOptions()
+    opt.initialize()
+    opt = opt.parser.parse_args("")
+    opt.isTrain = False
+    opt.test_mode = "Full"
+    opt.Quality_restore = not scratch
+    opt.Scratch_and_Quality_restore = scratch
+    opt.HR = scratch and HR
+    opt.gpu_ids = gpu_ids
+    opt.cpu_threads = cpu_threads
+    opt.cpu_interop_threads = cpu_interop_threads
+    Restorer.parameter_set(opt)
+    if mapping_net == "":
+        # no checkpoints exist here, so every network keeps its random initialization
+        opt.checkpoints_dir = tmp_dir
+        opt.load_pretrainA = tmp_dir
+        opt.load_pretrainB = tmp_dir
+    else:
+        opt.test_vae_a = vae_a
+        opt.test_vae_b = vae_b
+        opt.test_mapping_net = mapping_net
+    opt.compile = compile
+    opt.compile_cache = compile_cache
+    model = Restorer.load_model(opt)
+    image_transform, mask_transform = Restorer.get_transforms()
+    return opt, model, image_transform, mask_transform
+
+
+def load_face_enhancer(gpu_ids, face_size: int, checkpoint_path: str, tmp_dir: str):
+    # the face options read sys.argv while gathering the model specific options
+    argv = sys.argv
+    sys.argv = argv[:1]
+    try:
+        opt = FaceEnhancerOptions().parse(args=["--gpu_ids", ",".join(str(n) for n in gpu_ids) or "-1"])
+    finally:
+        sys.argv = argv
+    opt.isTrain = False
+    opt.label_nc = 18
+    opt.no_instance = True
+    opt.no_parsing_map = True
+    opt.load_size = face_size
+    if checkpoint_path == "":
+        checkpoint_path = os.path.join(tmp_dir, "face_G.pth")
+        torch.save(FaceNetworks.define_G(opt).state_dict(), checkpoint_path)
+    opt.test_path_G = checkpoint_path
+    return FaceEnhancer.load_model(opt)
@@ -2,6 +2,9 @@ import os
 import gc
 import glob
 import warnings
+import importlib
+import itertools
+import threading
 
 import torch
 from torch.utils.data import DataLoader
@@ -9,17 +12,60 @@ import torchvision
 from PIL import Image
 import numpy as np
 
-from .Global import detection as ScratchDetector
-
-from .Global import test as Restorer
-from .Global.options.test_options import TestOptions as RestoreOptions
-
-from .Face_Detection import detect_all_dlib as FaceDetector
-from .Face_Detection import align_warp_back_multiple_dlib as FaceBlender
-
-from .Face_Enhancement import test_face as FaceEnhancer
-from .Face_Enhancement.options.test_options import TestOptions as FaceEnhancerOptions
-from .Face_Enhancement.data.face_dataset import FaceTensorDataset
+from .bopbtl_utils import instrumentation
+
+class LazyModule:
+    """Imports a module of this package on first attribute access, so that ComfyUI can register
+    the nodes without loading dlib, skimage, cv2 and the networks until a node actually runs.
+    |on_load| is called once with the imported module."""
+    def __init__(self, name: str, on_load=None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name, __package__)
+                    if self._on_load is not None:
+                        self._on_load(module)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+def register_restorer(module):
+    instrumentation.register(module, "transform_image")
+    instrumentation.register(module, "transform_image_and_mask")
+    instrumentation.register(module, "inference_batch")
+    instrumentation.register(module.Pix2PixHDModel_Mapping, "inference_encode", "Pix2PixHDModel_Mapping.inference_encode")
+    instrumentation.register(module.Pix2PixHDModel_Mapping, "inference_mapping", "Pix2PixHDModel_Mapping.inference_mapping")
+    instrumentation.register(module.Pix2PixHDModel_Mapping, "inference_decode", "Pix2PixHDModel_Mapping.inference_decode")
+
+def register_face_detector(module):
+    instrumentation.register(module, "get_face_landmarks")
+    instrumentation.register(module, "get_aligned_faces")
+
+def register_face_blender(module):
+    instrumentation.register(module, "blend_faces")
+    instrumentation.register(module, "match_histograms")
+    instrumentation.register(module, "blur_blending_cv2")
+    instrumentation.register(module, "warp", "align_warp_back_multiple_dlib.warp")
+
+ScratchDetector = LazyModule(".Global.detection", lambda module: instrumentation.register(module, "detect_scratches"))
+
+Restorer = LazyModule(".Global.test", register_restorer)
+RestoreOptions = LazyModule(".Global.options.test_options")
+
+FaceDetector = LazyModule(".Face_Detection.detect_all_dlib", register_face_detector)
+FaceBlender = LazyModule(".Face_Detection.align_warp_back_multiple_dlib", register_face_blender)
+
+FaceEnhancer = LazyModule(".Face_Enhancement.test_face")
+FaceEnhancerOptions = LazyModule(".Face_Enhancement.options.test_options")
+FaceDataset = LazyModule(".Face_Enhancement.data.face_dataset")
 
 import comfy.model_management
 import folder_paths
@@ -31,11 +77,16 @@ def search_custom_model_dir(dir:str , ext: str): # The issue with this is that i
         models = [path[len(dir) + 1:] for path in models]
     return models
 
+@instrumentation.instrument("ToPILImage")
+def tensor_to_pil(image: torch.Tensor):
+    return torchvision.transforms.ToPILImage()(image)
+
+@instrumentation.instrument("tensor_images_to_numpy")
 def tensor_images_to_numpy(images: torch.Tensor):
     images = images.permute(0, 3, 1, 2)
     np_images = []
     for image in images:
-        pil_image = torchvision.transforms.ToPILImage()(image)
+        pil_image = tensor_to_pil(image)
         np_image = np.array(pil_image)
         np_images.append(np_image)
     return np_images
@@ -63,21 +114,27 @@ class LoadScratchMaskModel:
             "required": {
                 "scratch_model": (folder_paths.get_filename_list("checkpoints"),),
             },
+            "optional": {
+                "onnx_path": ("STRING", {"default": ""}), # replaces scratch_model, runs on CPU
+            },
         }
 
     @staticmethod
-    def load_model(model_path: str):
+    def load_model(model_path: str, onnx_path: str = ""):
+        if onnx_path != "":
+            return (ScratchDetector.load_model(device_ids=-1, checkpoint_path=onnx_path),)
         model = ScratchDetector.load_model(
             device_ids=comfy.model_management.get_torch_device(), 
             checkpoint_path=model_path, 
         )
         return (model,)
 
-    def run(self, scratch_model: str):
+    @instrumentation.instrument("BOPBTL_LoadScratchMaskModel")
+    def run(self, scratch_model: str, onnx_path: str = ""):
         model_path = folder_paths.get_full_path("checkpoints", scratch_model)
         if isinstance(model_path, tuple):
             model_path = model_path[0]
-        return LoadScratchMaskModel.load_model(model_path)
+        return LoadScratchMaskModel.load_model(model_path, onnx_path)
 
 class ScratchMask:
     RETURN_TYPES = ("MASK",)
@@ -121,7 +178,7 @@ class ScratchMask:
         masks = []
         for i in range(image.size()[0]):
             masks.append(ScratchDetector.detect_scratches(
-                image=torchvision.transforms.ToPILImage()(image[i]), 
+                image=tensor_to_pil(image[i]), 
                 model=scratch_model,
                 device_ids=comfy.model_management.get_torch_device(), 
                 input_size=input_size, 
@@ -133,6 +190,7 @@ class ScratchMask:
         masks = masks.to(input_device, dtype=input_dtype)
         return (masks,)
 
+    @instrumentation.instrument("BOPBTL_ScratchMask")
     def run(self, scratch_model, image, input_size, resize_method):
         return ScratchMask.detect_scratches(
             scratch_model, 
@@ -146,6 +204,7 @@ class LoadRestoreOldPhotosModel:
     RETURN_NAMES = ("bopbtl_models",)
     FUNCTION = "run"
     OUTPUT_NODE = True
+    COMPILE_CACHE_PATH = os.path.normpath(folder_paths.models_dir + os.sep + "bopbtl_compiled" + os.sep)
 
     def __init__(self):
         pass
@@ -167,6 +226,11 @@ class LoadRestoreOldPhotosModel:
                 "vae_b": (folder_paths.get_filename_list("vae"),),
                 "vae_a": (folder_paths.get_filename_list("vae"),),
             },
+            "optional": {
+                "quantize": (["none", "int8"], {"default": "none"}), # int8 runs on CPU only
+                "compile": (["none", "trace", "inductor"], {"default": "none"}), # single device, not with int8
+                "onnx_dir": ("STRING", {"default": ""}), # exported networks replacing the checkpoints, runs on CPU
+            },
         }
 
     @staticmethod
@@ -177,8 +241,11 @@ class LoadRestoreOldPhotosModel:
         mapping_net_path: str, 
         vae_b_path: str, 
         vae_a_path: str, 
+        quantize: str = "none", 
+        compile: str = "none", 
+        onnx_dir: str = "", 
     ):
-        opt = RestoreOptions()
+        opt = RestoreOptions.TestOptions()
         opt.initialize()
         opt = opt.parser.parse_args("")
         opt.isTrain = False
@@ -191,7 +258,11 @@ class LoadRestoreOldPhotosModel:
         opt.test_vae_b = vae_b_path
         opt.test_mapping_net = mapping_net_path
         opt.HR = mapping_patch_attention
-        opt.gpu_ids = device_id_list
+        opt.gpu_ids = device_id_list if onnx_dir == "" else [] # onnxruntime runs on CPU, like the scratch model
+        opt.quantize = quantize
+        opt.compile = compile
+        opt.compile_cache = LoadRestoreOldPhotosModel.COMPILE_CACHE_PATH
+        opt.onnx_dir = onnx_dir
 
         #opt.test_vae_a = "./checkpoints/restoration/VAE_A_quality/latest_net_G.pth"
         #if opt.Quality_restore:
@@ -208,6 +279,7 @@ class LoadRestoreOldPhotosModel:
         image_transform, mask_transform = Restorer.get_transforms()
         return((opt, model, image_transform, mask_transform),)
 
+    @instrumentation.instrument("BOPBTL_LoadRestoreOldPhotosModel")
     def run(
         self, 
         device_ids: str, 
@@ -215,15 +287,21 @@ class LoadRestoreOldPhotosModel:
         mapping_patch_attention: str, 
         mapping_net, 
         vae_b, 
-        vae_a
+        vae_a, 
+        quantize = "none", 
+        compile = "none", 
+        onnx_dir = "", 
     ):
         return LoadRestoreOldPhotosModel.load_models(
-            [int(n) for n in device_ids.split(",")], 
+            [int(n) for n in device_ids.split(",") if int(n) >= 0], # -1 runs on CPU
             True if scratch_detection == "True" else False, 
             True if mapping_patch_attention == "True" else False, 
             folder_paths.get_full_path("checkpoints", mapping_net), 
             folder_paths.get_full_path("vae", vae_b), 
             folder_paths.get_full_path("vae", vae_a), 
+            quantize, 
+            compile, 
+            onnx_dir, 
         )
 
 class RestoreOldPhotos:
@@ -255,9 +333,10 @@ class RestoreOldPhotos:
         input_dtype = image.dtype
         input_device = image.device
         image = image.permute(0, 3, 1, 2)
-        restored_images = []
+        transformed_images = []
+        transformed_masks = []
         for i in range(image.size()[0]):
-            pil_image = torchvision.transforms.ToPILImage()(image[i]).convert("RGB")
+            pil_image = tensor_to_pil(image[i]).convert("RGB")
             if not opt.Scratch_and_Quality_restore:
                 transformed_image, transformed_mask, _ = Restorer.transform_image(
                     pil_image, 
@@ -275,7 +354,7 @@ class RestoreOldPhotos:
                         layout=image.layout, 
                         device=image.device, 
                     )
-                pil_mask = torchvision.transforms.ToPILImage()(mask).convert("RGB")
+                pil_mask = tensor_to_pil(mask).convert("RGB")
                 transformed_image, transformed_mask, _ = Restorer.transform_image_and_mask(
                     pil_image, 
                     image_transform, 
@@ -283,15 +362,20 @@ class RestoreOldPhotos:
                     mask_transform, 
                     opt.mask_dilation, 
                 )
-            with torch.no_grad():
-                restored_image = model.inference(transformed_image, transformed_mask)[0]
-                restored_image = (restored_image + 1.0) / 2.0
-                restored_images.append(restored_image)
+            transformed_images.append(transformed_image)
+            transformed_masks.append(transformed_mask)
+        if opt.quantize == "int8" and not model.quantized:
+            ## calibrate on the first photos that are restored
+            model.quantize(transformed_images, transformed_masks)
+        with torch.inference_mode():
+            restored_images = Restorer.inference_batch(model, transformed_images, transformed_masks)
+            restored_images = [(restored_image[0].to(input_device) + 1.0) / 2.0 for restored_image in restored_images]
         restored_images = torch.stack(restored_images)
         restored_images = restored_images.permute(0, 2, 3, 1)
         restored_images = restored_images.to(input_device, dtype=input_dtype)
         return (restored_images,)
 
+    @instrumentation.instrument("BOPBTL_RestoreOldPhotos")
     def run(self, image, bopbtl_models, scratch_mask = None):
         return RestoreOldPhotos.restore(image, bopbtl_models, scratch_mask)
 
@@ -320,6 +404,7 @@ class LoadFaceDetectorModel:
         landmark_locator = FaceDetector.dlib.shape_predictor(model_path)
         return ((face_detector, landmark_locator),)
 
+    @instrumentation.instrument("BOPBTL_LoadFaceDetectorModel")
     def run(self, shape_predictor_68_face_landmarks: str):
         model_path = os.path.normpath(self.FACE_MODEL_PATH + os.sep + shape_predictor_68_face_landmarks)
         return LoadFaceDetectorModel.load_model(model_path)
@@ -366,7 +451,7 @@ class DetectFaces:
         aligned_faces = []
         faces_landmarks = []
         for torch_image in image:
-            pil_image = torchvision.transforms.ToPILImage()(torch_image).convert("RGB")
+            pil_image = tensor_to_pil(torch_image).convert("RGB")
             np_image = np.array(pil_image)
 
             landmarks = FaceDetector.get_face_landmarks(face_detector, landmark_locator, np_image)
@@ -387,6 +472,7 @@ class DetectFaces:
 
         return ((face_counts, no_faces_detected), aligned_faces, faces_landmarks)
 
+    @instrumentation.instrument("BOPBTL_DetectFaces")
     def run(self, dlib_model, image, face_size):
         return DetectFaces.detect_faces(dlib_model, image, face_size)
 
@@ -407,21 +493,31 @@ class LoadFaceEnhancerModel:
                 "face_enhance_model": (folder_paths.get_filename_list("checkpoints"),),
                 "model_face_size": (["256", "512"], {"default": "512"}),
             },
+            "optional": {
+                "quantize": (["none", "int8"], {"default": "none"}), # int8 runs on CPU only
+                "onnx_path": ("STRING", {"default": ""}), # replaces face_enhance_model, runs on CPU
+            },
         }
 
     @staticmethod
-    def load_model(device_ids: str, face_enhance_model: str, model_face_size: str):
+    def load_model(device_ids: str, face_enhance_model: str, model_face_size: str, quantize: str = "none", onnx_path: str = ""):
         load_size = int(model_face_size)
 
-        opt = FaceEnhancerOptions().parse(args="")
+        ## parsed on CPU: the options assert batchSize is a multiple of the GPU count, which the node does not use
+        opt = FaceEnhancerOptions.TestOptions().parse(args=["--gpu_ids", "-1"])
         opt.isTrain = False
+        opt.gpu_ids = [int(n) for n in device_ids.split(",") if int(n) >= 0] # -1 runs on CPU
+        if onnx_path != "":
+            opt.gpu_ids = [] # onnxruntime runs on CPU, like the scratch model
+        if len(opt.gpu_ids) > 0:
+            torch.cuda.set_device(opt.gpu_ids[0])
 
-        opt.gpu_ids = [int(n) for n in device_ids.split(",")]
         opt.label_nc = 18
         opt.no_instance = True
         opt.preprocess_model = "resize"
-        opt.test_path_G = folder_paths.get_full_path("checkpoints", face_enhance_model)
+        opt.test_path_G = onnx_path or folder_paths.get_full_path("checkpoints", face_enhance_model)
         opt.no_parsing_map = True
+        opt.quantize = quantize
 
         opt.load_size = load_size # this is required to create the model correctly
         #opt.batchSize = batch_size
@@ -430,8 +526,9 @@ class LoadFaceEnhancerModel:
 
         return ((model, load_size),)
 
-    def run(self, device_ids, face_enhance_model, model_face_size):
-        return LoadFaceEnhancerModel.load_model(device_ids, face_enhance_model, model_face_size)
+    @instrumentation.instrument("BOPBTL_LoadFaceEnhancerModel")
+    def run(self, device_ids, face_enhance_model, model_face_size, quantize = "none", onnx_path = ""):
+        return LoadFaceEnhancerModel.load_model(device_ids, face_enhance_model, model_face_size, quantize, onnx_path)
 
 class EnhanceFaces:
     RETURN_TYPES = ("FACE_COUNT", "IMAGE")
@@ -479,20 +576,20 @@ class EnhanceFaces:
         cropped_faces = cropped_faces.permute(0, 3, 1, 2)
         image_list = []
         for image in cropped_faces:
-            pil_image = torchvision.transforms.ToPILImage()(image)
+            pil_image = tensor_to_pil(image)
             image_list.append(pil_image)
 
         parts_list = face_parts
         if len(parts_list) == 0:
-            parts_list = [None for _ in range(len(FaceTensorDataset.get_parts()))]
+            parts_list = [None for _ in range(len(FaceDataset.FaceTensorDataset.get_parts()))]
         else:
             for i in range(len(parts_list)):
                 part = parts_list[i]
                 if part is None:
                     continue
-                parts_list[i] = torchvision.transforms.ToPILImage()(part)
+                parts_list[i] = tensor_to_pil(part)
 
-        dataset = FaceTensorDataset()
+        dataset = FaceDataset.FaceTensorDataset()
         dataset.initialize(
             preprocess_mode="scale_width_and_crop", 
             load_size=load_size, 
@@ -509,9 +606,14 @@ class EnhanceFaces:
             shuffle=False, 
         )
 
+        if model.opt.quantize == "int8" and not model.quantized:
+            ## calibrate on the first faces that are enhanced
+            model.quantize(itertools.islice(dataloader, model.opt.quantize_samples))
+
         enhanced_faces = []
         for batch in dataloader:
-            enhanced_face_batch = model(batch, mode="inference")
+            with instrumentation.stage("Pix2PixModel.inference"):
+                enhanced_face_batch = model(batch, mode="inference")
             enhanced_faces += enhanced_face_batch
         enhanced_faces = torch.stack(enhanced_faces)
         enhanced_faces = enhanced_faces.permute(0, 2, 3, 1)
@@ -521,6 +623,7 @@ class EnhanceFaces:
 
         return (face_count, enhanced_faces)
 
+    @instrumentation.instrument("BOPBTL_EnhanceFaces")
     def run(
         self, 
         face_enhance_model, 
@@ -585,7 +688,7 @@ class EnhanceFacesAdvanced(EnhanceFaces):
     def INPUT_TYPES(self):
         input_types = super().INPUT_TYPES()
         optional = input_types["optional"]
-        parts = FaceTensorDataset.get_parts()
+        parts = FaceDataset.FaceTensorDataset.get_parts()
         for part in parts:
             optional["part_" + part] = ("IMAGE,")
         return input_types
@@ -640,6 +743,7 @@ class BlendFaces:
         blended_images = blended_images.to(input_device, dtype=input_dtype)
         return (blended_images,)
 
+    @instrumentation.instrument("BOPBTL_BlendFaces")
     def run(self, original_image, face_count, enhanced_cropped_faces, face_landmarks):
         return BlendFaces.blend_faces(
             original_image, 
@@ -680,6 +784,7 @@ class DetectEnhanceBlendFaces:
             print("BOPBTL: " + e.message)
             return (image,)
 
+    @instrumentation.instrument("BOPBTL_DetectEnhanceBlendFaces")
     def run(self, dlib_model, face_enhance_model, image):
         return DetectEnhanceBlendFaces.enhance_faces(dlib_model, face_enhance_model, image)
 
@@ -0,0 +1,180 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import copy
+import json
+import time
+import random
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+import benchmark
+from model_loaders import Restorer, FaceTensorDataset, load_restore_model, load_face_enhancer
+
+STAGES = ["restore_quality", "restore_scratch", "enhance"]
+
+
+def load_images(image_dir: str, count: int, size: int, offset: int = 0):
+    """|count| photos of |image_dir| resized to |size|, or synthesized old photos without a directory."""
+    if image_dir == "":
+        return [benchmark.synthesize_old_photo(size) for _ in range(count)]
+    names = sorted(name for name in os.listdir(image_dir) if os.path.isfile(os.path.join(image_dir, name)))
+    names = names[offset:offset + count]
+    if len(names) < count:
+        raise ValueError("%s needs at least %d images!" % (image_dir, offset + count))
+    photos = []
+    for name in names:
+        image = Image.open(os.path.join(image_dir, name)).convert("RGB").resize((size, size), Image.BICUBIC)
+        photos.append((image, benchmark.synthesize_scratch_mask(size)))
+    return photos
+
+
+def to_numpy(image: torch.Tensor):
+    image = ((image.float().clamp(-1, 1) + 1) / 2 * 255).round().byte()
+    return image.permute(1, 2, 0).cpu().numpy()
+
+
+def timed(fn):
+    start = time.perf_counter()
+    outputs = fn()
+    return outputs, (time.perf_counter() - start) * 1000.0
+
+
+def restore_stage(stage: str, args, tmp_dir: str):
+    scratch = stage == "restore_scratch"
+    if scratch:
+        vae_b, mapping_net = args.vae_b_scratch, args.mapping_scratch
+    else:
+        vae_b, mapping_net = args.vae_b_quality, args.mapping_quality
+    opt, model, image_transform, mask_transform = load_restore_model([], scratch, tmp_dir, args.vae_a, vae_b, mapping_net)
+
+    def transform(photos):
+        inputs = []
+        masks = []
+        for image, mask in photos:
+            if scratch:
+                input, mask, _ = Restorer.transform_image_and_mask(image, image_transform, mask, mask_transform, opt.mask_dilation)
+            else:
+                input, mask, _ = Restorer.transform_image(image, image_transform, opt.test_mode)
+            inputs.append(input)
+            masks.append(mask)
+        return inputs, masks
+
+    calibration = transform(load_images(args.images, args.calibration_samples, args.resolution))
+    inputs, masks = transform(load_images(args.images, args.test_samples, args.resolution, args.calibration_samples))
+    quantized = copy.deepcopy(model)
+    quantized.quantize(*calibration)
+
+    def run(model):
+        with torch.inference_mode():
+            return [model.inference(input, mask)[0] for input, mask in zip(inputs, masks)]
+
+    run(model)
+    run(quantized)
+    return run, model, quantized, len(inputs)
+
+
+def enhance_stage(args, tmp_dir: str):
+    model = load_face_enhancer([], args.face_size, args.face_checkpoint, tmp_dir)
+    batch_size = 1 if args.face_size == 512 else 4
+
+    def dataloader(faces):
+        dataset = FaceTensorDataset()
+        dataset.initialize(
+            preprocess_mode="scale_width_and_crop",
+            load_size=args.face_size,
+            crop_size=args.face_size,
+            aspect_ratio=1.0,
+            is_train=False,
+            no_flip=True,
+            image_list=[image for image, _ in faces],
+            parts_list=[None for _ in range(len(FaceTensorDataset.get_parts()))],
+        )
+        return DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+    calibration = dataloader(load_images(args.faces, args.calibration_samples, args.face_size))
+    batches = list(dataloader(load_images(args.faces, args.test_samples, args.face_size, args.calibration_samples)))
+    quantized = copy.deepcopy(model)
+    quantized.quantize(calibration)
+
+    def run(model):
+        outputs = []
+        for batch in batches:
+            outputs += model(dict(batch), mode="inference")
+        return outputs
+
+    run(model)
+    run(quantized)
+    return run, model, quantized, args.test_samples
+
+
+def report(stage: str, args, tmp_dir: str):
+    if stage == "enhance":
+        run, model, quantized, count = enhance_stage(args, tmp_dir)
+    else:
+        run, model, quantized, count = restore_stage(stage, args, tmp_dir)
+
+    reference, fp32_ms = timed(lambda: run(model))
+    outputs, int8_ms = timed(lambda: run(quantized))
+    psnr = []
+    ssim = []
+    for a, b in zip(reference, outputs):
+        a = to_numpy(a)
+        b = to_numpy(b)
+        psnr.append(peak_signal_noise_ratio(a, b, data_range=255))
+        ssim.append(structural_similarity(a, b, channel_axis=2, data_range=255))
+    return {
+        "stage": stage,
+        "images": count,
+        "fp32_ms_per_image": fp32_ms / count,
+        "int8_ms_per_image": int8_ms / count,
+        "speedup": fp32_ms / int8_ms,
+        "psnr_db": float(np.mean(psnr)),
+        "psnr_min_db": float(np.min(psnr)),
+        "ssim": float(np.mean(ssim)),
+        "ssim_min": float(np.min(ssim)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Speed and quality of the int8 CPU models compared with fp32")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES), help=",".join(STAGES))
+    parser.add_argument("--images", type=str, default="", help="directory of old photos; synthesized photos are used without it")
+    parser.add_argument("--faces", type=str, default="", help="directory of aligned old faces; synthesized photos are used without it")
+    parser.add_argument("--resolution", type=int, default=256, help="square size the photos are resized to")
+    parser.add_argument("--face_size", type=int, default=256, help="256|512")
+    parser.add_argument("--calibration_samples", type=int, default=8, help="images to calibrate on")
+    parser.add_argument("--test_samples", type=int, default=8, help="images to compare on, taken after the calibration images")
+    parser.add_argument("--vae_a", type=str, default="", help="VAE A checkpoint")
+    parser.add_argument("--vae_b_quality", type=str, default="", help="VAE B checkpoint of restore_quality")
+    parser.add_argument("--mapping_quality", type=str, default="", help="mapping checkpoint of restore_quality; random weights without it")
+    parser.add_argument("--vae_b_scratch", type=str, default="", help="VAE B checkpoint of restore_scratch")
+    parser.add_argument("--mapping_scratch", type=str, default="", help="mapping checkpoint of restore_scratch; random weights without it")
+    parser.add_argument("--face_checkpoint", type=str, default="", help="face enhancer generator; random weights without it")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    tmp_dir = tempfile.TemporaryDirectory()
+    results = []
+    print("%-16s %6s %14s %14s %8s %10s %8s" % ("stage", "images", "fp32 ms/img", "int8 ms/img", "speedup", "PSNR dB", "SSIM"))
+    for stage in args.stages.split(","):
+        result = report(stage, args, tmp_dir.name)
+        results.append(result)
+        print(
+            "%-16s %6d %14.1f %14.1f %7.2fx %10.2f %8.4f"
+            % (stage, result["images"], result["fp32_ms_per_image"], result["int8_ms_per_image"], result["speedup"], result["psnr_db"], result["ssim"])
+        )
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"torch": torch.__version__, "engine": torch.backends.quantized.engine, "num_threads": torch.get_num_threads()}, "results": results}, f, indent=2)
@@ -7,9 +7,14 @@ import shutil
 import sys
 from subprocess import call
 
+## the scripts in Global and Face_Enhancement import the shared helpers from bopbtl_utils at the repo root
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
 def run_cmd(command):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
     try:
-        call(command, shell=True)
+        call(command, shell=True, env=env)
     except KeyboardInterrupt:
         print("Process interrupted")
         sys.exit(1)
@@ -0,0 +1,689 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+import json
+import time
+import weakref
+import argparse
+import tempfile
+import threading
+import concurrent.futures
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from PIL import Image
+
+from bopbtl_utils import instrumentation
+from bopbtl_utils.cpu_threads import set_cpu_threads
+from model_loaders import ScratchDetector, Restorer, FaceDetector, FaceBlender, FaceTensorDataset
+from model_loaders import load_scratch_detector, load_restore_model, load_face_enhancer
+
+## A local HTTP service restoring photos with the models loaded once in this process:
+##   python server.py --vae_a ... --vae_b_quality ... --mapping_quality ... --port 8765
+##   curl --data-binary @old.png -o restored.png "http://127.0.0.1:8765/restore?scratch=1&faces=1"
+##   curl http://127.0.0.1:8765/metrics
+## Every network runs as a stage with its own queue and worker thread. A stage batches the queued
+## inputs of the same size, until the batch is full or its oldest input waited --max_batch_delay_ms.
+## Inputs are never padded to batch with other sizes: the instance normalization and the convolutions
+## at the borders would change every output pixel, so a batch restores each photo exactly like
+## Global/test.py does on its own. A request is only admitted while the memory estimates of the
+## admitted requests fit in --memory_budget_mb.
+
+## rough host memory of a request per pixel of its photo: the decoded photo, its input, mask and
+## output tensors, and the float64 warps of the face blending
+HOST_BYTES_PER_PIXEL = 64
+BLEND_BYTES_PER_PIXEL = 160
+
+
+class ServiceError(Exception):
+    def __init__(self, status: int, message: str, retry_after: int = 0):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class PeakMemory(TorchDispatchMode):
+    """Counts the bytes of the storages that the operators run inside it allocate, until the last
+    tensor viewing a storage is freed, and keeps the live bytes after every operator. Unlike the
+    allocator statistics this works on the CPU too."""
+
+    def __init__(self):
+        super().__init__()
+        self.live = 0
+        self.timeline = []
+        ## data_ptr: [bytes, tensors viewing the storage]
+        self.storages = {}
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        outputs = func(*args, **(kwargs or {}))
+        for output in tree_flatten(outputs)[0]:
+            if not isinstance(output, torch.Tensor):
+                continue
+            storage = output.untyped_storage()
+            if storage.data_ptr() == 0:
+                continue
+            ## views and in-place results share a storage that is already counted
+            if storage.data_ptr() not in self.storages:
+                self.storages[storage.data_ptr()] = [storage.nbytes(), 0]
+                self.live += storage.nbytes()
+            self.storages[storage.data_ptr()][1] += 1
+            weakref.finalize(output, self.free, storage.data_ptr())
+        self.timeline.append(self.live)
+        return outputs
+
+    def free(self, data_ptr):
+        entry = self.storages[data_ptr]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.storages[data_ptr]
+            self.live -= entry[0]
+
+
+class MemoryModel:
+    """Peak bytes of a network for an input of |pixels|. The live bytes after every operator are a
+    polynomial of the pixels, quadratic for the full attention of the scratch restoration, fitted to
+    the memory measured at a few small sizes; the peak is their maximum, which moves from the
+    convolutions to the attention as the photos grow. Negative coefficients are dropped, so that
+    the estimate only errs upwards."""
+
+    def __init__(self, run, sizes):
+        pixels = []
+        timelines = []
+        for height, width in sizes:
+            memory = PeakMemory()
+            with torch.inference_mode(), memory:
+                run(height, width)
+            pixels.append(height * width)
+            timelines.append(memory.timeline)
+        if len(set(len(timeline) for timeline in timelines)) != 1:
+            ## the operators depend on the size, fall back to the peaks
+            timelines = [[max(timeline)] for timeline in timelines]
+        if len(sizes) == 1:
+            self.coefficients = np.array(timelines, dtype=np.float64)
+        else:
+            self.coefficients = np.maximum(np.polyfit(pixels, np.array(timelines, dtype=np.float64), min(len(sizes) - 1, 2)), 0.0)
+
+    def __call__(self, pixels: int, batch_size: int = 1) -> float:
+        powers = float(pixels) ** np.arange(len(self.coefficients) - 1, -1, -1)
+        return float((powers @ self.coefficients).max()) * batch_size
+
+
+def percentiles(samples):
+    if len(samples) == 0:
+        return None
+    samples = np.asarray(samples)
+    return {
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "max": float(samples.max()),
+    }
+
+
+class StageMetrics:
+    def __init__(self, window: int):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.max_queued = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.batches = 0
+        self.batched_items = 0
+        self.queue_ms = deque(maxlen=window)
+        self.run_ms = deque(maxlen=window)
+
+    def submit(self):
+        with self.lock:
+            self.submitted += 1
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def dequeue(self, queue_ms):
+        with self.lock:
+            self.queued -= len(queue_ms)
+            self.queue_ms.extend(queue_ms)
+
+    def expire(self):
+        with self.lock:
+            self.expired += 1
+
+    def batch(self, batch_size: int, run_ms: float, failed: bool):
+        with self.lock:
+            self.batches += 1
+            self.batched_items += batch_size
+            self.run_ms.append(run_ms)
+            if failed:
+                self.failed += batch_size
+            else:
+                self.completed += batch_size
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "expired": self.expired,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_items / self.batches if self.batches else None,
+                "queue_ms": percentiles(self.queue_ms),
+                "run_ms": percentiles(self.run_ms),
+            }
+
+
+class QueuedItem:
+    __slots__ = ("payload", "future", "queued", "deadline")
+
+    def __init__(self, payload, deadline: float):
+        self.payload = payload
+        self.future = Future()
+        self.queued = time.monotonic()
+        self.deadline = deadline
+
+
+class BatchingStage:
+    """Queues the items of one network in a bucket per key, the input size for the networks, and runs
+    them in batches on its own thread. A bucket runs once it holds |max_batch_size| items or its oldest item waited |max_delay| seconds, the
+    bucket with the oldest item first; items whose request deadline passed in the queue fail with
+    DeadlineExceeded. run(key, payloads) returns one result per payload."""
+
+    def __init__(self, name: str, run, max_batch_size: int, max_delay: float, window: int):
+        self.name = name
+        self.run = run
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_delay = max_delay
+        self.metrics = StageMetrics(window)
+        self.buckets = OrderedDict()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.work, name="stage_" + name, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, payload, deadline: float) -> Future:
+        item = QueuedItem(payload, deadline)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The %s stage is closed" % self.name)
+            self.buckets.setdefault(key, []).append(item)
+            self.metrics.submit()
+            self.condition.notify()
+        return item.future
+
+    def next_batch(self):
+        with self.condition:
+            while True:
+                if not self.buckets:
+                    if self.closed:
+                        return None
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                ready = []
+                wake = None
+                for key, items in self.buckets.items():
+                    due = items[0].queued + self.max_delay
+                    if len(items) >= self.max_batch_size or due <= now or self.closed:
+                        ready.append(key)
+                    elif wake is None or due < wake:
+                        wake = due
+                if not ready:
+                    self.condition.wait(wake - now)
+                    continue
+                key = min(ready, key=lambda key: self.buckets[key][0].queued)
+                items = self.buckets.pop(key)
+                if len(items) > self.max_batch_size:
+                    self.buckets[key] = items[self.max_batch_size:]
+                    items = items[:self.max_batch_size]
+                return key, items
+
+    def work(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            key, items = batch
+            now = time.monotonic()
+            self.metrics.dequeue([(now - item.queued) * 1000.0 for item in items])
+            live = []
+            for item in items:
+                if item.deadline < now:
+                    item.future.set_exception(DeadlineExceeded("Timed out in the %s queue" % self.name))
+                    self.metrics.expire()
+                elif item.future.set_running_or_notify_cancel():
+                    live.append(item)
+            if not live:
+                continue
+            start = time.perf_counter()
+            try:
+                with instrumentation.stage("server." + self.name):
+                    results = self.run(key, [item.payload for item in live])
+            except Exception as e:
+                self.metrics.batch(len(live), (time.perf_counter() - start) * 1000.0, True)
+                for item in live:
+                    item.future.set_exception(e)
+                continue
+            self.metrics.batch(len(live), (time.perf_counter() - start) * 1000.0, False)
+            for item, result in zip(live, results):
+                item.future.set_result(result)
+
+    def close(self):
+        ## runs what is queued, then stops the thread
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+class MemoryBudget:
+    """Admits requests while the sum of their memory estimates fits in |budget| bytes."""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.reserved = 0.0
+        self.peak_reserved = 0.0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def acquire(self, estimate: float) -> bool:
+        with self.lock:
+            if self.reserved + estimate > self.budget:
+                self.rejected += 1
+                return False
+            self.reserved += estimate
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, estimate: float):
+        with self.lock:
+            self.reserved -= estimate
+            self.in_flight -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "budget_mb": self.budget / 2**20,
+                "reserved_mb": self.reserved / 2**20,
+                "peak_reserved_mb": self.peak_reserved / 2**20,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+def to_numpy(image: torch.Tensor):
+    ## a C x H x W image in [-1, 1] as H x W x C uint8
+    image = ((image.float().clamp(-1, 1) + 1) / 2 * 255).round().byte()
+    return image.permute(1, 2, 0).cpu().numpy()
+
+
+class RestorationService:
+    def __init__(self, args):
+        self.args = args
+        self.gpu_ids = [int(n) for n in args.device_ids.split(",") if int(n) >= 0][:1]
+        self.device = torch.device("cuda", self.gpu_ids[0]) if self.gpu_ids else torch.device("cpu")
+        self.scratch_device = self.gpu_ids[0] if self.gpu_ids else -1
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.image_transform, self.mask_transform = Restorer.get_transforms()
+        self.budget = MemoryBudget(args.memory_budget_mb * 2**20)
+        self.memory = OrderedDict()
+        self.started = time.monotonic()
+        self.requests_lock = threading.Lock()
+        self.requests = {}
+        self.latency_ms = deque(maxlen=args.metrics_window)
+        self.load_models()
+        self.fit_memory()
+
+        max_delay = args.max_batch_delay_ms / 1000.0
+        stages = [
+            ("scratch_detect", self.detect_scratches, args.max_batch_size, max_delay),
+            ("restore", self.restore_batch, args.max_batch_size, max_delay),
+            ## dlib and the blending handle one photo at a time, waiting would only add latency
+            ("face_detect", self.detect_faces, 1, 0.0),
+            ("face_enhance", self.enhance_faces, args.max_batch_size, max_delay),
+            ("blend", self.blend_faces, 1, 0.0),
+        ]
+        self.stages = OrderedDict(
+            (name, BatchingStage(name, run, max_batch_size, delay, args.metrics_window))
+            for name, run, max_batch_size, delay in stages
+        )
+
+    def load_models(self):
+        args = self.args
+        tmp_dir = self.tmp_dir.name
+        self.restore_models = OrderedDict()
+        self.restore_opts = OrderedDict()
+        kinds = ["quality"] if args.no_scratch else ["quality", "scratch"]
+        for kind in kinds:
+            vae_b = args.vae_b_scratch if kind == "scratch" else args.vae_b_quality
+            mapping_net = args.mapping_scratch if kind == "scratch" else args.mapping_quality
+            opt, model, _, _ = load_restore_model(
+                self.gpu_ids, kind == "scratch", tmp_dir, args.vae_a, vae_b, mapping_net, HR=args.HR,
+                cpu_threads=args.cpu_threads, cpu_interop_threads=args.cpu_interop_threads,
+            )
+            self.restore_opts[kind] = opt
+            self.restore_models[kind] = model
+
+        self.scratch_model = None
+        if not args.no_scratch:
+            self.scratch_model = load_scratch_detector(self.scratch_device, args.scratch_checkpoint, tmp_dir)
+
+        ## the landmarks need the dlib model, there are no random weights for it
+        self.face_models = None
+        self.face_enhancer = None
+        if args.shape_predictor != "":
+            face_detector = FaceDetector.dlib.get_frontal_face_detector()
+            landmark_locator = FaceDetector.dlib.shape_predictor(args.shape_predictor)
+            self.face_models = (face_detector, landmark_locator)
+            self.face_enhancer = load_face_enhancer(self.gpu_ids, args.face_size, args.face_checkpoint, tmp_dir)
+
+    def fit_memory(self):
+        ## peaks measured at small sizes; the scratch restoration runs with a full mask, the worst case of its attention
+        for kind, model in self.restore_models.items():
+            scratch = kind == "scratch"
+            run = lambda h, w, model=model, scratch=scratch: model.inference(
+                torch.zeros(1, 3, h, w), torch.full((1, 1, h, w), 1.0 if scratch else 0.0)
+            )
+            self.memory["restore_" + kind] = MemoryModel(run, [(64, 64), (96, 96), (128, 128)])
+        if self.scratch_model is not None:
+            run = lambda h, w: self.scratch_model(torch.zeros(1, 1, h, w, device=self.device))
+            self.memory["scratch_detect"] = MemoryModel(run, [(64, 64), (128, 128), (192, 192)])
+        if self.face_enhancer is not None:
+            size = self.args.face_size
+            run = lambda h, w: self.face_enhancer({"label": torch.zeros(1, 18, h, w), "image": torch.zeros(1, 3, h, w)}, mode="inference")
+            self.memory["face_enhance"] = MemoryModel(run, [(size, size)])
+
+    ## stages, each runs one batch on its worker thread
+
+    def detect_scratches(self, key, images):
+        with torch.inference_mode():
+            logits = self.scratch_model(torch.cat(images).to(self.device))
+        return list(logits.cpu())
+
+    def restore_batch(self, key, inputs):
+        kind = key[0]
+        labels = torch.cat([label for label, _ in inputs])
+        insts = torch.cat([inst for _, inst in inputs])
+        with torch.inference_mode():
+            restored = self.restore_models[kind].inference(labels, insts)
+        return restored.cpu().split(1)
+
+    def detect_faces(self, key, images):
+        face_detector, landmark_locator = self.face_models
+        outputs = []
+        for image in images:
+            landmarks = FaceDetector.get_face_landmarks(face_detector, landmark_locator, image)[:self.args.max_faces]
+            outputs.append((landmarks, FaceDetector.get_aligned_faces(landmarks, image, self.args.face_size)))
+        return outputs
+
+    def enhance_faces(self, key, faces):
+        with torch.inference_mode():
+            enhanced = self.face_enhancer(default_collate(faces), mode="inference")
+        return list(enhanced.cpu())
+
+    def blend_faces(self, key, photos):
+        size = self.args.face_size
+        return [
+            FaceBlender.blend_faces([image], [len(faces)], faces, landmarks, size)[0]
+            for image, faces, landmarks in photos
+        ]
+
+    ## requests, each runs on its HTTP thread and waits for the stages
+
+    def wait(self, future: Future, deadline: float):
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0.0))
+        ## concurrent.futures.TimeoutError is only the builtin TimeoutError from Python 3.11
+        except (concurrent.futures.TimeoutError, DeadlineExceeded):
+            future.cancel()
+            raise ServiceError(504, "The request timed out after %.1f s" % self.args.request_timeout)
+
+    def face_input(self, face: np.ndarray):
+        dataset = FaceTensorDataset()
+        dataset.initialize(
+            preprocess_mode="scale_width_and_crop",
+            load_size=self.args.face_size,
+            crop_size=self.args.face_size,
+            aspect_ratio=1.0,
+            is_train=False,
+            no_flip=True,
+            image_list=[Image.fromarray((face * 255.0).astype(np.uint8))],
+            parts_list=[None for _ in range(len(FaceTensorDataset.get_parts()))],
+        )
+        return dataset[0]
+
+    def prepare(self, image: Image.Image, scratch: bool):
+        """The network inputs of a photo, the sizes they batch by and the memory estimate of the request."""
+        plan = {}
+        if scratch:
+            image = ScratchDetector.data_transforms(image, "full_size")
+            scaled, mask_size = ScratchDetector.scratch_input(image, "full_size")
+            plan["scratch"] = (scaled, mask_size)
+            peak = self.memory["scratch_detect"](scaled.shape[2] * scaled.shape[3])
+            restore_size = (image.size[1], image.size[0])
+        else:
+            input, mask, image = Restorer.transform_image(image, self.image_transform, "Full")
+            plan["input"] = (input, mask)
+            peak = 0.0
+            restore_size = tuple(input.shape[2:])
+        plan["restore"] = restore_size
+        peak = max(peak, self.memory["restore_scratch" if scratch else "restore_quality"](restore_size[0] * restore_size[1]))
+        return image, plan, peak
+
+    def restore(self, data: bytes, scratch: bool, faces: bool) -> Image.Image:
+        args = self.args
+        if scratch and self.scratch_model is None:
+            raise ServiceError(400, "Scratch removal is not loaded, restart without --no_scratch")
+        if faces and self.face_models is None:
+            raise ServiceError(400, "Face enhancement is not loaded, restart with --shape_predictor")
+        try:
+            image = Image.open(io.BytesIO(data))
+            if image.size[0] * image.size[1] > args.max_pixels:
+                raise ServiceError(413, "%dx%d is larger than --max_pixels %d" % (image.size + (args.max_pixels,)))
+            image = image.convert("RGB")
+        except ServiceError:
+            raise
+        except Exception as e:
+            raise ServiceError(400, "Cannot decode the image: %s" % e)
+
+        image, plan, peak = self.prepare(image, scratch)
+        pixels = image.size[0] * image.size[1]
+        if faces:
+            peak = max(peak, self.memory["face_enhance"](args.face_size ** 2, min(args.max_faces, args.max_batch_size)))
+        estimate = peak + pixels * (HOST_BYTES_PER_PIXEL + (BLEND_BYTES_PER_PIXEL if faces else 0))
+        if estimate > self.budget.budget:
+            raise ServiceError(413, "The request needs about %.0f MB, more than --memory_budget_mb" % (estimate / 2**20))
+        if not self.budget.acquire(estimate):
+            raise ServiceError(503, "Over the memory budget, retry later", retry_after=1)
+        try:
+            deadline = time.monotonic() + args.request_timeout
+            return self.run_pipeline(image, plan, scratch, faces, deadline)
+        finally:
+            self.budget.release(estimate)
+
+    def run_pipeline(self, image: Image.Image, plan, scratch: bool, faces: bool, deadline: float) -> Image.Image:
+        if scratch:
+            scaled, mask_size = plan["scratch"]
+            logits = self.wait(self.stages["scratch_detect"].submit(tuple(scaled.shape[2:]), scaled, deadline), deadline)
+            mask = ScratchDetector.scratch_mask(logits, mask_size)
+            mask = Image.fromarray((mask[0].numpy() * 255).astype(np.uint8)).convert("RGB")
+            opt = self.restore_opts["scratch"]
+            input, mask, _ = Restorer.transform_image_and_mask(image, self.image_transform, mask, self.mask_transform, opt.mask_dilation)
+        else:
+            input, mask = plan["input"]
+
+        key = ("scratch" if scratch else "quality",) + plan["restore"]
+        restored = self.wait(self.stages["restore"].submit(key, (input, mask), deadline), deadline)
+        restored = Restorer.tensor_image((restored + 1.0) / 2.0)
+        if not faces:
+            return restored
+
+        restored = np.array(restored)
+        landmarks, aligned = self.wait(self.stages["face_detect"].submit(None, restored, deadline), deadline)
+        if len(landmarks) == 0:
+            return Image.fromarray(restored)
+        futures = [self.stages["face_enhance"].submit(None, self.face_input(face), deadline) for face in aligned]
+        enhanced = [to_numpy(self.wait(future, deadline)) for future in futures]
+        blended = self.wait(self.stages["blend"].submit(None, (restored, enhanced, landmarks), deadline), deadline)
+        return Image.fromarray((np.clip(blended, 0.0, 1.0) * 255.0).round().astype(np.uint8))
+
+    def record(self, status: int, latency_ms: float):
+        with self.requests_lock:
+            self.requests[status] = self.requests.get(status, 0) + 1
+            if status == 200:
+                self.latency_ms.append(latency_ms)
+
+    def metrics(self):
+        with self.requests_lock:
+            requests = {
+                "status": {str(status): count for status, count in sorted(self.requests.items())},
+                "latency_ms": percentiles(self.latency_ms),
+            }
+        return {
+            "uptime_s": time.monotonic() - self.started,
+            "admission": self.budget.snapshot(),
+            "requests": requests,
+            "stages": OrderedDict((name, stage.metrics.snapshot()) for name, stage in self.stages.items()),
+        }
+
+    def close(self):
+        for stage in self.stages.values():
+            stage.close()
+        self.tmp_dir.cleanup()
+
+
+def flag(query, name: str) -> bool:
+    return query.get(name, ["0"])[-1].lower() in ("1", "true", "yes")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self.send_json(200, self.service.metrics())
+        elif path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "Unknown path %s" % path})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != "/restore":
+            self.send_json(404, {"error": "Unknown path %s" % url.path})
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.send_json(411, {"error": "Content-Length is required"})
+            return
+        if int(length) > self.service.args.max_request_mb * 2**20:
+            self.close_connection = True
+            self.send_json(413, {"error": "The body is larger than --max_request_mb"})
+            return
+        data = self.rfile.read(int(length))
+        query = parse_qs(url.query)
+        try:
+            image = self.service.restore(data, flag(query, "scratch"), flag(query, "faces"))
+            output = io.BytesIO()
+            image.save(output, format="PNG")
+        except ServiceError as e:
+            self.service.record(e.status, 0.0)
+            headers = {"Retry-After": str(e.retry_after)} if e.retry_after else {}
+            self.send_json(e.status, {"error": str(e)}, headers)
+            return
+        except Exception as e:
+            self.service.record(500, 0.0)
+            self.send_json(500, {"error": "%s: %s" % (type(e).__name__, e)})
+            return
+        self.service.record(200, (time.perf_counter() - start) * 1000.0)
+        self.send_body(200, "image/png", output.getvalue())
+
+    def send_json(self, status: int, body, headers=None):
+        self.send_body(status, "application/json", json.dumps(body, indent=2).encode(), headers)
+
+    def send_body(self, status: int, content_type: str, body: bytes, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.service.args.access_log:
+            super().log_message(format, *args)
+
+
+def create_server(service: RestorationService, host: str, port: int):
+    handler = type("Handler", (RequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP restoration service batching requests across clients")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--device_ids", type=str, default="-1", help="-1 for CPU, 0 for the first gpu")
+    parser.add_argument("--cpu_threads", type=int, default=0, help="intra-op threads on CPU, 0 uses the torch default")
+    parser.add_argument("--cpu_interop_threads", type=int, default=0, help="inter-op threads on CPU, 0 uses the torch default")
+    parser.add_argument("--vae_a", type=str, default="", help="VAE A checkpoint")
+    parser.add_argument("--vae_b_quality", type=str, default="", help="VAE B checkpoint of the quality restoration")
+    parser.add_argument("--mapping_quality", type=str, default="", help="mapping checkpoint of the quality restoration; random weights without it")
+    parser.add_argument("--vae_b_scratch", type=str, default="", help="VAE B checkpoint of the scratch restoration")
+    parser.add_argument("--mapping_scratch", type=str, default="", help="mapping checkpoint of the scratch restoration; random weights without it")
+    parser.add_argument("--HR", action="store_true", help="the patch attention mapping network for the scratch restoration")
+    parser.add_argument("--scratch_checkpoint", type=str, default="", help="scratch detection checkpoint; random weights without it")
+    parser.add_argument("--no_scratch", action="store_true", help="do not load the scratch detection and restoration")
+    parser.add_argument("--shape_predictor", type=str, default="", help="dlib 68 landmarks model; faces are not enhanced without it")
+    parser.add_argument("--face_checkpoint", type=str, default="", help="face enhancer generator; random weights without it")
+    parser.add_argument("--face_size", type=int, default=256, help="256|512")
+    parser.add_argument("--max_faces", type=int, default=4, help="faces enhanced per photo, the largest are not picked first")
+    parser.add_argument("--max_batch_size", type=int, default=4, help="items a stage runs at once")
+    parser.add_argument("--max_batch_delay_ms", type=float, default=20.0, help="how long the first input of a size waits for others of the same size")
+    parser.add_argument("--memory_budget_mb", type=float, default=4096.0, help="sum of the memory estimates of the admitted requests, on the device that runs the networks")
+    parser.add_argument("--request_timeout", type=float, default=60.0, help="seconds a request may take before it fails with 504")
+    parser.add_argument("--max_request_mb", type=float, default=32.0, help="largest request body")
+    parser.add_argument("--max_pixels", type=int, default=4096 * 4096, help="largest photo")
+    parser.add_argument("--metrics_window", type=int, default=1024, help="latest samples the percentiles of /metrics are taken over")
+    parser.add_argument("--access_log", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    set_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+    service = RestorationService(args)
+    for name, memory in service.memory.items():
+        print("%-16s about %.0f MB at 256x256, %.0f MB at 512x512" % (name, memory(256 * 256) / 2**20, memory(512 * 512) / 2**20))
+    server = create_server(service, args.host, args.port)
+    print("Serving on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
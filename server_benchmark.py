@@ -0,0 +1,168 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import benchmark
+from server import percentiles
+
+## Load test of a running server.py on synthetic old photos:
+##   python server.py --no_scratch &
+##   python server_benchmark.py --requests 64 --concurrency 8 --resolutions 128,192
+## Without --rate every client sends its next request once the last one returned; with --rate the
+## requests arrive at random at that mean rate whatever the server does, and their latency counts
+## from the moment they were due, so a server falling behind shows up in the latency. The stage
+## metrics cover everything the server ran since it started.
+
+
+def synthesize_requests(args):
+    photos = []
+    for i in range(args.photos):
+        size = args.resolutions[i % len(args.resolutions)]
+        image, _ = benchmark.synthesize_old_photo(size)
+        data = io.BytesIO()
+        image.save(data, format="PNG")
+        photos.append((size, data.getvalue()))
+    requests = []
+    for _ in range(args.requests):
+        size, data = random.choice(photos)
+        scratch = random.random() < args.scratch_fraction
+        faces = random.random() < args.faces_fraction
+        requests.append((size, scratch, faces, data))
+    return requests
+
+
+def send(url: str, scratch: bool, faces: bool, data: bytes, timeout: float):
+    request = urllib.request.Request(
+        "%s/restore?scratch=%d&faces=%d" % (url, scratch, faces),
+        data=data,
+        headers={"Content-Type": "application/octet-stream"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+    except OSError:
+        return 0
+
+
+def run(args, requests):
+    results = [None] * len(requests)
+    start = time.perf_counter()
+
+    def call(i, due):
+        size, scratch, faces, data = requests[i]
+        status = send(args.url, scratch, faces, data, args.timeout)
+        results[i] = {
+            "resolution": size,
+            "scratch": scratch,
+            "faces": faces,
+            "status": status,
+            "latency_ms": (time.perf_counter() - due) * 1000.0,
+        }
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        if args.rate > 0:
+            due = start
+            for i in range(len(requests)):
+                due += random.expovariate(args.rate)
+                time.sleep(max(due - time.perf_counter(), 0.0))
+                executor.submit(call, i, due)
+        else:
+            next_request = iter(range(len(requests)))
+            lock = threading.Lock()
+
+            def client():
+                while True:
+                    with lock:
+                        i = next(next_request, None)
+                    if i is None:
+                        return
+                    call(i, time.perf_counter())
+
+            for _ in range(args.concurrency):
+                executor.submit(client)
+    return results, time.perf_counter() - start
+
+
+def fetch_metrics(url: str):
+    with urllib.request.urlopen(url + "/metrics") as response:
+        return json.load(response)
+
+
+def summarize(results, elapsed: float):
+    statuses = {}
+    for result in results:
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+    ok = [result["latency_ms"] for result in results if result["status"] == 200]
+    return {
+        "requests": len(results),
+        "elapsed_s": elapsed,
+        "status": statuses,
+        "images_per_s": len(ok) / elapsed,
+        "latency_ms": percentiles(ok),
+    }
+
+
+def print_report(summary, metrics):
+    latency = summary["latency_ms"] or {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    print("%d requests in %.1f s, status %s" % (summary["requests"], summary["elapsed_s"], summary["status"]))
+    print("%.2f img/s, latency p50 %.0f ms, p95 %.0f ms, p99 %.0f ms" % (summary["images_per_s"], latency["p50"], latency["p95"], latency["p99"]))
+    admission = metrics["admission"]
+    print("admitted %d, rejected %d, peak reserved %.0f of %.0f MB" % (admission["admitted"], admission["rejected"], admission["peak_reserved_mb"], admission["budget_mb"]))
+    print("%-14s %8s %8s %10s %12s %12s %12s" % ("stage", "items", "batches", "batch size", "queue p50", "queue p95", "run p50"))
+    for name, stage in metrics["stages"].items():
+        if stage["batches"] == 0:
+            continue
+        print("%-14s %8d %8d %10.2f %9.0f ms %9.0f ms %9.0f ms" % (
+            name,
+            stage["completed"] + stage["failed"],
+            stage["batches"],
+            stage["mean_batch_size"],
+            stage["queue_ms"]["p50"],
+            stage["queue_ms"]["p95"],
+            stage["run_ms"]["p50"],
+        ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of server.py on synthetic old photos")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8765")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8, help="clients sending requests, or the most requests in flight with --rate")
+    parser.add_argument("--rate", type=float, default=0.0, help="mean requests per second arriving at random; 0 runs closed loop clients")
+    parser.add_argument("--resolutions", type=str, default="128,192", help="comma separated square photo sizes")
+    parser.add_argument("--photos", type=int, default=8, help="distinct photos the requests pick from")
+    parser.add_argument("--scratch_fraction", type=float, default=0.0, help="share of the requests with scratch removal")
+    parser.add_argument("--faces_fraction", type=float, default=0.0, help="share of the requests with face enhancement")
+    parser.add_argument("--timeout", type=float, default=300.0, help="client timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="", help="write the results and the server metrics as JSON to this file")
+    args = parser.parse_args()
+    args.resolutions = [int(n) for n in args.resolutions.split(",")]
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    requests = synthesize_requests(args)
+    before = fetch_metrics(args.url)
+    results, elapsed = run(args, requests)
+    summary = summarize(results, elapsed)
+    metrics = fetch_metrics(args.url)
+    print_report(summary, metrics)
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "summary": summary, "results": results, "metrics_before": before, "metrics": metrics}, f, indent=2)
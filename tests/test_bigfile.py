@@ -0,0 +1,82 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+import os
+import sys
+import struct
+
+import numpy as np
+import pytest
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Global.data.Load_Bigfile import (BIGFILE_V2_LAYOUT, BIGFILE_V2_VERSION, BigFileMemoryLoader, BigFileWriter,
+                                      index_sidecar_path, read_index, write_index)
+
+
+def png_bytes(seed, size=8):
+    pixels = np.random.RandomState(seed).randint(0, 256, (size, size, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def write_bigfile(path, count=3):
+    with BigFileWriter(path) as writer:
+        for i in range(count):
+            writer.add('%d.png' % i, png_bytes(i))
+
+
+def test_v2_round_trip(tmp_path):
+    path = str(tmp_path / 'a.bigfile')
+    write_bigfile(path)
+    loader = BigFileMemoryLoader(path)
+    assert len(loader) == 3
+    assert loader.name(2) == '2.png'
+    assert bytes(loader.img_bytes(1)) == png_bytes(1)
+    assert loader.verify(0)
+    assert loader.sizes().tolist() == [[8, 8]] * 3
+
+
+@pytest.mark.parametrize('layout', [(BIGFILE_V2_VERSION + 1, None), (BIGFILE_V2_VERSION, 41)])
+def test_other_layout_is_rejected(tmp_path, layout):
+    path = str(tmp_path / 'a.bigfile')
+    write_bigfile(path)
+    version, itemsize = layout
+    with open(path, 'r+b') as fid:
+        fid.seek(8)
+        _, current_itemsize = BIGFILE_V2_LAYOUT.unpack(fid.read(BIGFILE_V2_LAYOUT.size))
+        fid.seek(8)
+        fid.write(BIGFILE_V2_LAYOUT.pack(version, itemsize or current_itemsize))
+    with pytest.raises(ValueError):
+        BigFileMemoryLoader(path)
+
+
+def test_index_without_layout_is_rejected(tmp_path):
+    ## the index files written before the layout was recorded: magic, uint64 size, index
+    path = str(tmp_path / 'a.index')
+    write_index(path, [], 123)
+    with open(path, 'rb') as fid:
+        header = fid.read()
+    with open(path, 'wb') as fid:
+        fid.write(header[:8] + struct.pack('<Q', 123))
+    with pytest.raises(ValueError):
+        read_index(path)
+
+
+def test_stale_sidecar_is_ignored(tmp_path):
+    path = str(tmp_path / 'v1.bigfile')
+    images = [png_bytes(i) for i in range(2)]
+    with open(path, 'wb') as fid:
+        fid.write(struct.pack('i', len(images)))
+        for i, img_bytes in enumerate(images):
+            name = ('%d.png' % i).encode('utf-8')
+            fid.write(struct.pack('i', len(name)) + name + struct.pack('i', len(img_bytes)) + img_bytes)
+    with open(index_sidecar_path(path), 'wb') as fid:
+        fid.write(b'BIGINDEX' + struct.pack('<Q', os.path.getsize(path)))
+    loader = BigFileMemoryLoader(path)
+    assert len(loader) == 2
+    assert loader.name(1) == '1.png'
@@ -0,0 +1,46 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import sys
+import itertools
+
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "Global"))
+
+from Global.models.networks import NonLocalBlock2D_with_mask_Res
+
+
+def random_block(renorm, use_self, cosin, channels=16):
+    block = NonLocalBlock2D_with_mask_Res(channels, channels, "combine", renorm, 1.0, use_self, cosin).eval()
+    ## W starts at zero, which would hide the attention output from the comparison
+    with torch.no_grad():
+        for param in block.parameters():
+            param.normal_(0, 0.2)
+    return block
+
+
+@pytest.mark.parametrize("renorm,use_self,cosin", list(itertools.product([True, False], repeat=3)))
+def test_inference_forward_matches_forward(renorm, use_self, cosin):
+    torch.manual_seed(0)
+    block = random_block(renorm, use_self, cosin)
+    x = torch.randn(3, 16, 12, 10)
+    mask = (torch.rand(3, 1, 48, 40) > 0.8).float()
+    mask[1] = 0  ## a sample without scratches in the batch
+    with torch.no_grad():
+        dense = block(x, mask)
+        ## a chunk size that does not divide H*W
+        chunked = block.inference_forward(x, mask, chunk_size=7)
+    torch.testing.assert_close(chunked, dense, rtol=1e-4, atol=1e-4)
+    assert torch.equal(chunked[1], x[1])
+
+
+def test_inference_forward_without_holes_returns_input():
+    block = random_block(True, False, False)
+    x = torch.randn(2, 16, 8, 8)
+    with torch.no_grad():
+        assert torch.equal(block.inference_forward(x, torch.zeros(2, 1, 32, 32)), x)
@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import sys
+import argparse
+
+import pytest
+import torch
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "Global"))
+
+import export_onnx
+
+
+def export_args(model, output, resolution=64):
+    ## random weights, like export_onnx.py without checkpoints
+    return argparse.Namespace(
+        model=model,
+        output=output,
+        resolution=resolution,
+        scratch_checkpoint="",
+        vae_a="",
+        vae_b="",
+        mapping_net="",
+    )
+
+
+def assert_matches(checks, mean_tolerance=1e-3):
+    assert len(checks) == 2  ## a square and a non square size
+    for name, reference, output in checks:
+        max_error, mean_error = export_onnx.difference(reference, output)
+        assert mean_error <= mean_tolerance, "%s: mean abs diff %g" % (name, mean_error)
+        assert max_error <= 100 * mean_tolerance, "%s: max abs diff %g" % (name, max_error)
+
+
+def test_scratch_export_matches_pytorch(tmp_path):
+    torch.manual_seed(0)
+    args = export_args("scratch", str(tmp_path / "scratch.onnx"))
+    with torch.no_grad():
+        checks = export_onnx.export_scratch(args, str(tmp_path))
+    assert_matches(checks)
+
+
+@pytest.mark.parametrize("scratch", [False, True])
+def test_restore_export_matches_pytorch(tmp_path, scratch):
+    torch.manual_seed(0)
+    model = "restore_scratch" if scratch else "restore_quality"
+    args = export_args(model, str(tmp_path / model))
+    with torch.no_grad():
+        checks = export_onnx.export_restore(scratch, args, str(tmp_path))
+    assert_matches(checks)